@@ -1,18 +1,34 @@
 import argparse
-import pickle
 from collections import defaultdict
+from functools import partial
+from multiprocessing import Pool
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pyopenms as ms
 from mpl_toolkits.mplot3d import Axes3D
-from scipy.signal import argrelextrema
+
+import cluster_finder_im as cfi
+import common_utils_im as util
+import compare_baseline as cmp
+import resources_im as rsc
+import species_store as store
 
 ISOLATION_WINDOWS = \
     {0: 0, 1: 437.5, 2: 487.5, 3: 537.5, 4: 587.5, 5: 637.5, 6: 687.5, \
      7: 737.5, 8: 787.5, 9: 837.5, 10: 887.5, 11: 937.5, 12: 987.5, \
      13: 1037.5, 14: 1087.5, 15: 1137.5, 16: 1187.5}
 
+# One row per feature found in a frame (the IM of a feature is its transposed RT)
+FEATURE_DTYPE = np.dtype([('frame', np.int32), ('mz', np.float64), ('im', np.float64),
+                          ('intensity', np.float64), ('charge', np.int32)])
+
+# One row per precursor/fragment link
+RESULT_DTYPE = np.dtype([('precursor', np.int64), ('fragment', np.int64)])
+
+# The input experiment opened by each frame worker process
+frame_exp = None
+
 def four_d_spectrum_to_experiment(spec):
     """Function that converts a 4D spectrum object which contains retention
     time, ion mobility, mass to charge, and intensity data, into a new
@@ -27,32 +43,28 @@ def four_d_spectrum_to_experiment(spec):
         spectrum from the original where the retention time and ion mobility
         has been swapped.
     """
-    ion_mobility_to_peaks = zip(spec.getFloatDataArrays()[0], *spec.get_peaks())
+    ims = np.asarray(spec.getFloatDataArrays()[0].get_data(), dtype=np.float64)
+    mzs, intensities = spec.get_peaks()
+
+    # Sort by IM, then m/z, then intensity, and split at every new IM value
+    order = np.lexsort((intensities, mzs, ims))
+    ims, mzs, intensities = ims[order], mzs[order], intensities[order]
+    unique_ims, starts = np.unique(ims, return_index=True)
+    ends = np.append(starts[1:], len(ims))
 
     new_exp = ms.MSExperiment()
-    new_mz, new_int = [], []
-    curr_im = None
-
-    for im, mz, intensity in sorted(
-        ion_mobility_to_peaks, key = lambda x: (x[0], x[1], x[2])):
-        if im != curr_im:
-            if curr_im:
-                new_spec = ms.MSSpectrum()
-                new_spec.setRT(curr_im)
-                new_spec.set_peaks((new_mz, new_int))
-
-                rt_fda = ms.FloatDataArray()
-                for i in new_mz:
-                    rt_fda.push_back(spec.getRT())
-
-                new_spec.setFloatDataArrays([rt_fda])
-                new_exp.addSpectrum(new_spec)
-                new_mz, new_int = [], []
-            
-            curr_im = im
-            
-        new_mz.append(mz)
-        new_int.append(intensity)
+    rt = spec.getRT()
+
+    for im, start, end in zip(unique_ims, starts, ends):
+        new_spec = ms.MSSpectrum()
+        new_spec.setRT(float(im))
+        new_spec.set_peaks((mzs[start:end], intensities[start:end]))
+
+        rt_fda = ms.FloatDataArray()
+        rt_fda.set_data(np.full(end - start, rt, dtype=np.float32))
+
+        new_spec.setFloatDataArrays([rt_fda])
+        new_exp.addSpectrum(new_spec)
 
     return new_exp
 
@@ -87,45 +99,319 @@ def run_feature_finder_centroided_on_experiment(input_map):
 
     return features
 
-def find_local_maxima_indices(feature_arrays):
-    """Function that finds local intensity maxima.
+def feature_map_to_array(features, frame):
+    """Function that converts the features found in a frame into rows of the
+    consolidated feature store.
 
     Args:
-        feature_arrays: Array of arrays of points.
+        features (FeatureMap): The features found in the transposed frame.
+        frame (int): The index of the frame in the original experiment.
 
     Returns:
-        Array of tuples, where the first element is
-        the index of the maxima, and the second element
-        is the point index.
+        ndarray: A structured array with FEATURE_DTYPE rows.
     """
-    max_ints, max_int_pt_idxs = [], []
+    array = np.zeros(features.size(), dtype=FEATURE_DTYPE)
+    array['frame'] = frame
+
+    for i, feature in enumerate(features):
+        array[i]['mz'] = feature.getMZ()
+        array[i]['im'] = feature.getRT()
+        array[i]['intensity'] = feature.getIntensity()
+        array[i]['charge'] = feature.getCharge()
 
-    for i in range(len(feature_arrays)):
-        if len(feature_arrays[i]) > 0:
-            pt_idx, max_val = max(
-                enumerate(feature_arrays[i]), key=lambda p:p[1][2])
+    return array
+
+def array_to_feature_map(array):
+    """Function that converts rows of the consolidated feature store back into
+    a FeatureMap (with IM as the retention time, as in the transposed frames).
+    """
+    features = ms.FeatureMap()
+
+    for row in array:
+        feature = ms.Feature()
+        feature.setMZ(float(row['mz']))
+        feature.setRT(float(row['im']))
+        feature.setIntensity(float(row['intensity']))
+        feature.setCharge(int(row['charge']))
+        features.push_back(feature)
+
+    features.setUniqueIds()
+
+    return features
 
-            max_ints.append(max_val[2])
-            max_int_pt_idxs.append(pt_idx)
-        else:
-            max_ints.append(0)
-            max_int_pt_idxs.append(None)
+def init_frame_worker(infile, omp_threads=0):
+    """Function that opens the input experiment once per frame worker, so that
+    frames are streamed from disk instead of being sent between processes.
 
-    max_ints, max_int_pt_idxs = np.array(max_ints), np.array(max_int_pt_idxs)
+    Args:
+        infile (str): The indexed mzML file to open.
+        omp_threads (int): The number of OpenMP threads of the worker (0 to
+            leave it unchanged).
+    """
+    if omp_threads > 0:
+        rsc.limit_threads(omp_threads)
+    global frame_exp
+    frame_exp = ms.OnDiscMSExperiment()
+    frame_exp.openFile(infile)
+
+def cluster_frame(spec, frame, cluster_params):
+    """Function that finds the features of a single (untransposed) frame by
+    clustering its peaks in m/z and IM (see cluster_finder_im).
+
+    Returns:
+        ndarray: The features of the frame as a FEATURE_DTYPE array.
+    """
+    mzs, intensities = spec.get_peaks()
+    ims = spec.getFloatDataArrays()[0].get_data()
+
+    clusters = cfi.find_frame_features(mzs, ims, intensities, **cluster_params)
+
+    features = np.zeros(len(clusters['mz']), dtype=FEATURE_DTYPE)
+    features['frame'] = frame
+    features['mz'], features['im'] = clusters['mz'], clusters['im']
+    features['intensity'] = clusters['intensity']
+
+    return features
+
+def process_frame(i, outdir, outfile, skip_frame_mzml, frame_ff='centroided',
+                  cluster_params=None, compression='none', found=None):
+    """Function that finds the features of a single frame and writes its
+    per-frame output files. With frame_ff 'centroided', the frame is
+    transposed and FeatureFinderCentroided is run on it; with 'cluster', its
+    peaks are clustered directly.
+
+    Args:
+        i (int): The index of the frame in the input experiment.
+        outdir (str): The directory to write the per-frame files to.
+        outfile (str): The suffix of the per-frame files.
+        skip_frame_mzml (bool): If True, the transposed frame is not stored.
+        frame_ff (str): The per-frame feature finder ('centroided' or
+            'cluster').
+        cluster_params (dict): Keyword arguments for
+            cluster_finder_im.find_frame_features.
+        compression (str): The compression of the transposed frame's mzML
+            file (see common_utils_im.mzml_compression).
+        found (tuple): The features of the frame, if they have already been
+            found (see find_single_frame_features).
+
+    Returns:
+        tuple: The frame index, its original RT and MS level, and its features
+        as a FEATURE_DTYPE array.
+    """
+    spec = frame_exp.getSpectrum(i)
+    new_exp = None if frame_ff == 'cluster' else four_d_spectrum_to_experiment(spec)
 
-    # determine the indices of the local maxima
-    max_int_idxs = argrelextrema(max_ints, np.greater)
+    if new_exp is not None and not skip_frame_mzml:
+        util.get_mzml_file(compression).store(outdir + '/' + str(i) + '_' + outfile + '.mzML',
+                                              new_exp)
 
-    # get the actual values using these indices
-    local_max_idxs = \
-        zip(*max_int_idxs, max_int_pt_idxs[max_int_idxs])
+    if found is None:
+        found = find_single_frame_features(spec, new_exp, i, cluster_params)
+    new_features, features = found
+    ms.FeatureXMLFile().store(outdir + '/' + str(i) + '_' + outfile + '.featureXML',
+                              new_features)
 
-    return local_max_idxs
+    return i, spec.getRT(), spec.getMSLevel(), features
+
+def find_single_frame_features(spec, new_exp, frame, cluster_params=None):
+    """Function that finds the features of a single frame, without writing
+    any files.
+
+    Args:
+        spec (MSSpectrum): The frame.
+        new_exp (MSExperiment): The transposed frame (see
+            four_d_spectrum_to_experiment), or None to cluster the frame's
+            peaks instead.
+        frame (int): The index of the frame in the input experiment.
+        cluster_params (dict): Keyword arguments for
+            cluster_finder_im.find_frame_features.
+
+    Returns:
+        tuple: The features of the frame as a FeatureMap and as a
+        FEATURE_DTYPE array.
+    """
+    if new_exp is None:
+        features = cluster_frame(spec, frame, cluster_params or {})
+        return array_to_feature_map(features), features
+
+    new_features = run_feature_finder_centroided_on_experiment(new_exp)
+    return new_features, feature_map_to_array(new_features, frame)
+
+def merge_frame_feature_maps(outdir, outfile, num_frames):
+    """Function that joins the per-frame featureXML files written by
+    process_frame into a single FeatureMap, in frame order, keeping all of the
+    information of the features found in each (transposed) frame.
+
+    Args:
+        outdir (str): The directory the per-frame files were written to.
+        outfile (str): The suffix of the per-frame files.
+        num_frames (int): The number of frames.
+
+    Returns:
+        FeatureMap: The features of all frames.
+    """
+    total_features = ms.FeatureMap()
+
+    for i in range(num_frames):
+        new_features = ms.FeatureMap()
+        ms.FeatureXMLFile().load(outdir + '/' + str(i) + '_' + outfile + '.featureXML',
+                                 new_features)
+        total_features += new_features
+
+    total_features.ensureUniqueId()  # Of the map itself; the features keep their own
+
+    return total_features
+
+def find_frame_features(args):
+    """Function that finds the features of every frame of the input experiment,
+    in parallel if more than one worker is requested. The cores are split
+    between the workers and their OpenMP threads (see resources_im), or with
+    --autotune, the split is picked by timing the feature finding of the
+    middle frame with each thread count. That frame is read and transposed
+    once, outside of the timed runs, and keeps the features of its last run.
+
+    Returns:
+        tuple: The consolidated feature store (a FEATURE_DTYPE array sorted by
+        frame) and counter_to_og_rt_ms (a FRAME_INFO_DTYPE array indexed by
+        frame).
+    """
+    infile = args.infile + '.mzML'
+    exp = ms.OnDiscMSExperiment()
+    if not exp.openFile(infile):
+        raise IOError(infile + ' is not an indexed mzML file')
+    num_frames = exp.getNrSpectra()
+
+    cluster_params = {'mz_tolerance': args.cluster_mz_tol,
+                      'im_tolerance': args.cluster_im_tol,
+                      'min_samples': args.cluster_min_samples,
+                      'background_threshold': args.cluster_background_threshold}
+    frame_func = partial(process_frame, outdir=args.outdir, outfile=args.outfile,
+                         skip_frame_mzml=args.skip_frame_mzml, frame_ff=args.frame_ff,
+                         cluster_params=cluster_params, compression=args.compression)
+    counter_to_og_rt_ms = np.zeros(num_frames, dtype=store.FRAME_INFO_DTYPE)
+    frame_features = []
+
+    def collect(results):
+        for i, rt, ms_level, features in results:
+            print("Processed frame", i, "of", num_frames)
+            counter_to_og_rt_ms[i] = (rt, ms_level)
+            frame_features.append(features)
+
+    cores = rsc.available_cores()
+    frames = list(range(num_frames))
+    if args.autotune and num_frames > 0:
+        init_frame_worker(infile)
+        frame = num_frames // 2
+        spec = frame_exp.getSpectrum(frame)
+        new_exp = None if args.frame_ff == 'cluster' else four_d_spectrum_to_experiment(spec)
+        calibrated = []
+
+        def calibration_task(threads, sample):
+            calibrated.append(find_single_frame_features(spec, sample, frame, cluster_params))
+
+        # The feature finder updates the ranges of its input, so each run gets a copy
+        num_workers, omp_threads = rsc.calibrate(
+            calibration_task, cores,
+            prepare=lambda: None if new_exp is None else ms.MSExperiment(new_exp))
+        if calibrated:
+            collect([frame_func(frame, found=calibrated[-1])])
+            frames.remove(frame)
+    else:
+        num_workers, omp_threads = rsc.split_cores(cores, args.num_workers,
+                                                   args.omp_threads)
+    print("Using", num_workers, "workers with", omp_threads, "OpenMP threads each")
+
+    if num_workers > 1:
+        with Pool(num_workers, initializer=init_frame_worker,
+                  initargs=(infile, omp_threads)) as pool:
+            collect(pool.imap_unordered(frame_func, frames, chunksize=4))
+    else:
+        init_frame_worker(infile, omp_threads)
+        collect(map(frame_func, frames))
+
+    features = np.concatenate(frame_features) if frame_features \
+        else np.zeros(0, dtype=FEATURE_DTYPE)
+    features = features[np.argsort(features['frame'], kind='stable')]
+
+    return features, counter_to_og_rt_ms
+
+class LinkingFrame:
+    """The features of a single frame that have not been linked into a species
+    yet. Features are kept in m/z-sorted arrays and removed by masking.
+    """
+
+    def __init__(self, features):
+        order = np.argsort(features['mz'], kind='stable')
+        self.mz = np.asarray(features['mz'][order], dtype=np.float64)
+        self.im = np.asarray(features['im'][order], dtype=np.float64)
+        self.intensity = np.asarray(features['intensity'][order], dtype=np.float64)
+        self.charge = np.asarray(features['charge'][order])
+
+        self.removed = np.zeros(len(order), dtype=bool)
+        self.num_left = len(order)
+
+        # Points in descending intensity order; max_ptr skips removed points
+        self.by_intensity = np.argsort(-self.intensity, kind='stable')
+        self.max_ptr = 0
+
+    def max_point(self):
+        """Returns the index of the most intense remaining point (or None)."""
+        while self.max_ptr < len(self.by_intensity) \
+        and self.removed[self.by_intensity[self.max_ptr]]:
+            self.max_ptr+= 1
+
+        if self.max_ptr == len(self.by_intensity):
+            return None
+        return self.by_intensity[self.max_ptr]
+
+    def max_intensity(self):
+        """Returns the intensity of the most intense remaining point (or 0)."""
+        pt_idx = self.max_point()
+        return 0 if pt_idx is None else self.intensity[pt_idx]
+
+    def point(self, pt_idx):
+        """Returns a point as [m/z, IM, intensity, charge]."""
+        return [float(self.mz[pt_idx]), float(self.im[pt_idx]),
+                float(self.intensity[pt_idx]), int(self.charge[pt_idx])]
+
+    def remove(self, pt_idx):
+        """Marks a point as linked and returns it."""
+        self.removed[pt_idx] = True
+        self.num_left-= 1
+        return self.point(pt_idx)
+
+    def find_point(self, peak, mz_epsilon, im_epsilon):
+        """Finds the remaining point closest in m/z to peak that is within the
+        m/z and IM tolerances, has the same charge, and is less intense.
+
+        Returns:
+            The index of the point, or None if there is no such point.
+        """
+        lo = np.searchsorted(self.mz, peak[0] - mz_epsilon, side='left')
+        hi = np.searchsorted(self.mz, peak[0] + mz_epsilon, side='right')
+
+        candidates = ~self.removed[lo:hi] \
+            & (np.abs(self.im[lo:hi] - peak[1]) <= im_epsilon) \
+            & (self.intensity[lo:hi] < peak[2]) \
+            & (self.charge[lo:hi] == peak[3])
+        candidates = np.flatnonzero(candidates)
+
+        if len(candidates) == 0:
+            return None
+        return lo + candidates[np.argmin(np.abs(self.mz[lo + candidates] - peak[0]))]
+
+def is_local_maximum(max_ints, rt_idx):
+    """Function that checks if the most intense point of a frame is more intense
+    than those of both adjacent frames (the first and last frames never are).
+    """
+    if rt_idx <= 0 or rt_idx >= len(max_ints) - 1:
+        return False
+    return max_ints[rt_idx] > max_ints[rt_idx - 1] \
+        and max_ints[rt_idx] > max_ints[rt_idx + 1]
 
 def link_to_peak(
-    rt_idx, pt_idx, \
-    rt_idx_to_points, \
-    rt_idx_to_num_points_left, \
+    rt_idx, \
+    frames, \
     possible_species, \
     species_counter, \
     rt_idx_to_rt, \
@@ -133,186 +419,195 @@ def link_to_peak(
     im_epsilon):
     """Function links points adjacent to a local maximum.
        Tries to link everything in a peak shape (e.g. decreasing on both sides)
+
+    Returns:
+        set: The indices of the frames that points were linked from.
     """
-    if rt_idx_to_num_points_left[rt_idx] > 0:
-        peak = rt_idx_to_points[rt_idx].pop(pt_idx)
-        possible_species[species_counter] = [[rt_idx_to_rt[rt_idx]], [peak]]
+    pt_idx = frames[rt_idx].max_point()
+    if pt_idx is None:
+        return set()
 
-        rt_idx_to_num_points_left[rt_idx]-= 1
+    peak = frames[rt_idx].remove(pt_idx)
+    possible_species[species_counter] = [[rt_idx_to_rt[rt_idx]], [peak]]
+    changed = {rt_idx}
 
-        walk_idx = rt_idx - 1
+    for step in (-1, 1):
+        walk_idx = rt_idx + step
         skipped = 0
-        while walk_idx >= 0:
-            if len(rt_idx_to_points[walk_idx]) == 0:
-                break
 
-            prev_val = peak[2]
-            point_found = False
-
-            for i in range(len(rt_idx_to_points[walk_idx])):
-                point = rt_idx_to_points[walk_idx][i]
-
-                if peak[0] - mz_epsilon <= point[0] <= peak[0] + mz_epsilon \
-                and peak[1] - im_epsilon <= point[1] <= peak[1] + im_epsilon \
-                and point[2] <= peak[2] and point[3] == peak[3] \
-                and point[2] < prev_val:
-                    point = rt_idx_to_points[walk_idx].pop(i)
-                    possible_species[species_counter][0].append(
-                        rt_idx_to_rt[walk_idx])
-                    possible_species[species_counter][1].append(point)
-                    rt_idx_to_num_points_left[walk_idx]-= 1
-                    prev_val = point[2]
-                    point_found = True
-                    walk_idx-= 1
-                    break
-            
-            if not point_found:
-                skipped+= 1
-                if skipped > 2:
-                    break
-                else:
-                    walk_idx-= 1
-
-
-        walk_idx = rt_idx + 1
-        skipped = 0
-        while walk_idx < len(rt_idx_to_points):
-            if len(rt_idx_to_points[walk_idx]) == 0:
+        while 0 <= walk_idx < len(frames):
+            if frames[walk_idx].num_left == 0:
                 break
 
-            prev_val = peak[2]
-            point_found = False
-
-            for i in range(len(rt_idx_to_points[walk_idx])):
-                point = rt_idx_to_points[walk_idx][i]
-
-                if peak[0] - mz_epsilon <= point[0] <= peak[0] + mz_epsilon \
-                and peak[1] - im_epsilon <= point[1] <= peak[1] + im_epsilon \
-                and point[2] <= peak[2] and point[3] == peak[3] \
-                and point[2] < prev_val:
-                    point = rt_idx_to_points[walk_idx].pop(i)
-                    possible_species[species_counter][0].append(
-                        rt_idx_to_rt[walk_idx])
-                    possible_species[species_counter][1].append(point)
-                    rt_idx_to_num_points_left[walk_idx]-= 1
-                    prev_val = point[2]
-                    point_found = True
-                    walk_idx+= 1
-                    break
-            
-            if not point_found:
+            pt_idx = frames[walk_idx].find_point(peak, mz_epsilon, im_epsilon)
+
+            if pt_idx is not None:
+                point = frames[walk_idx].remove(pt_idx)
+                possible_species[species_counter][0].append(rt_idx_to_rt[walk_idx])
+                possible_species[species_counter][1].append(point)
+                changed.add(walk_idx)
+            else:
                 skipped+= 1
                 if skipped > 2:
                     break
-                else:
-                    walk_idx+= 1
 
-def link_between_frames(feature_maps, rt_idx_to_rt, mz_epsilon, im_epsilon):
-    """Function that extracts possible species of targets from feature maps.
-    """
-    rt_idx_to_points = []
-    rt_idx_to_num_points_left, possible_species = {}, {}
-    num_unclassified, species_counter = None, 0
-
-    for i in range(len(feature_maps)):
-        rt = []
+            walk_idx+= step
 
-        for feature in feature_maps[i]:
-            point = []
+    return changed
 
-            point.append(feature.getMZ())
-            point.append(feature.getRT())
-            point.append(feature.getIntensity())
-            point.append(feature.getCharge())
+def link_between_frames(frame_features, rt_idx_to_rt, mz_epsilon, im_epsilon):
+    """Function that extracts possible species of targets from the features of
+    each frame (FEATURE_DTYPE arrays, in linking order).
 
-            rt.append(point)
+    Species are grown from the local maxima of the per-frame maximum
+    intensities. After each round, only the frames that lost points (and their
+    neighbours) have their maxima re-evaluated.
+    """
+    frames = [LinkingFrame(features) for features in frame_features]
+    possible_species, species_counter = {}, 0
 
-        rt_idx_to_points.append(rt)
-        rt_idx_to_num_points_left[i] = len(rt)
+    max_ints = np.array([frame.max_intensity() for frame in frames], dtype=np.float64)
+    is_max = np.array(
+        [is_local_maximum(max_ints, i) for i in range(len(frames))], dtype=bool)
 
-    num_unclassified = len([key for key in rt_idx_to_num_points_left \
-        if rt_idx_to_num_points_left[key] > 0])
-    while num_unclassified > 0:
-        local_maxima = list(find_local_maxima_indices(rt_idx_to_points))
+    while True:
+        local_maxima = np.flatnonzero(is_max)
 
-        if not local_maxima:
+        if len(local_maxima) == 0:
             break
 
-        for rt_idx, pt_idx in local_maxima:
-            link_to_peak(
+        dirty = set()
+        for rt_idx in local_maxima:
+            changed = link_to_peak(
                 rt_idx, \
-                pt_idx, \
-                rt_idx_to_points, \
-                rt_idx_to_num_points_left, \
+                frames, \
                 possible_species, \
                 species_counter, \
                 rt_idx_to_rt, \
                 mz_epsilon, \
                 im_epsilon)
 
-            species_counter+= 1
+            if changed:
+                species_counter+= 1
+            dirty.update(changed)
 
-    for key in [key for key in rt_idx_to_num_points_left \
-        if rt_idx_to_num_points_left[key] > 0]:
-        points = rt_idx_to_points[key]
+        for rt_idx in dirty:
+            max_ints[rt_idx] = frames[rt_idx].max_intensity()
 
-        for point in points:
-            possible_species[species_counter] = [[rt_idx_to_rt[key]], [point]]
+        for rt_idx in {i + d for i in dirty for d in (-1, 0, 1)}:
+            if 0 <= rt_idx < len(frames):
+                is_max[rt_idx] = is_local_maximum(max_ints, rt_idx)
+
+    for rt_idx in range(len(frames)):
+        for pt_idx in np.flatnonzero(~frames[rt_idx].removed):
+            possible_species[species_counter] = \
+                [[rt_idx_to_rt[rt_idx]], [frames[rt_idx].point(pt_idx)]]
             species_counter+= 1
 
     return possible_species
 
 def split_precursors_and_fragments(
     possible_species, window_size, rt_length, counter_to_og_rt_ms):
-    """Function that splits the list of possible species into precursors and
-    fragments.
+    """Function that splits the possible species into precursors and
+    fragments, depending on the MS level of the frame each species starts in.
+    Species spanning rt_length frames or less are dropped.
+
+    Args:
+        possible_species (ndarray): A SPECIES_DTYPE array.
+        counter_to_og_rt_ms (ndarray): A FRAME_INFO_DTYPE array.
+
+    Returns:
+        tuple: The precursors and fragments, as SPECIES_DTYPE arrays with
+        species renumbered from 0.
     """
-    precursors, fragments = {}, {}
-    precursor_counter, fragment_counter = 0, 0
+    summary = store.summarize_species(possible_species)
+    bounds = store.species_bounds(possible_species)
 
-    for species in possible_species:
-        rts = possible_species[species][0]
+    long_enough = summary['size'] > rt_length
+    first_level = counter_to_og_rt_ms['ms_level'][summary['rt_first'].astype(np.int64)]
 
-        if len(rts) > rt_length:
-            for rt in rts:
-                if counter_to_og_rt_ms[rt][1] == 1:
-                    precursors[precursor_counter] = possible_species[species]
-                    precursor_counter+= 1
-                    break
-                else:
-                    fragments[fragment_counter] = possible_species[species]
-                    fragment_counter+= 1
-                    break
+    def select(mask):
+        idxs = np.flatnonzero(mask)
+        sizes = summary['size'][idxs]
+        offsets = np.cumsum(sizes) - sizes
+
+        rows = np.repeat(bounds[idxs] - offsets, sizes) + np.arange(sizes.sum())
+        selected = np.array(possible_species[rows])
+        selected['species'] = np.repeat(np.arange(len(idxs)), sizes)
+
+        return selected
+
+    return select(long_enough & (first_level == 1)), \
+        select(long_enough & (first_level != 1))
 
-    return precursors, fragments
+class RTIntervalIndex:
+    """A static index over RT intervals that finds every interval strictly
+    containing a given RT. Intervals are sorted by start, and the longest
+    interval bounds how far back a query has to look.
+    """
+
+    def __init__(self, starts, ends):
+        self.order = np.argsort(starts, kind='stable')
+        self.starts, self.ends = starts[self.order], ends[self.order]
+        self.max_span = np.max(ends - starts) if len(starts) > 0 else 0
+
+    def containing(self, rt):
+        """Returns the (input) positions of all intervals with start < rt < end."""
+        lo = np.searchsorted(self.starts, rt - self.max_span, side='left')
+        hi = np.searchsorted(self.starts, rt, side='left')
+
+        return self.order[lo + np.flatnonzero(self.ends[lo:hi] > rt)]
 
-def link_frag_to_prec(dir, fragments, precursors, window_size, im_epsilon, threshold):
+def link_frag_to_prec(dir, fragments, precursors, window_size, im_epsilon, threshold,
+                      dump_text=False):
+    """Function that links fragments to the precursors that were isolated for
+    them: the fragment must start within the RT range of the precursor, have
+    a similar IM, and the precursor must lie within the isolation window of
+    the frame that the fragment starts in.
+
+    The links are written to results.npy (and results.txt if dump_text).
+    """
     precursor_to_fragments = defaultdict(list)
+    lower, upper = 25, 25
+
+    prec = store.summarize_species(precursors)
+    frag = store.summarize_species(fragments)
+    frag_windows = frag['rt_first'].astype(np.int64) % window_size
+
+    pairs = []
 
-    for precursor in precursors:
-        precursor_rt_range, precursor_points = precursors[precursor]
+    for window in np.unique(frag_windows):
+        isolation_mz = ISOLATION_WINDOWS[window]
 
-        for fragment in fragments:
-            fragment_rt_range, fragment_points = fragments[fragment]
-            isolation_mz = ISOLATION_WINDOWS[fragment_rt_range[0] % window_size]
-            lower, upper = 25, 25
+        # Only precursors inside this isolation window can match its fragments
+        in_window = np.flatnonzero(
+            (isolation_mz - lower <= prec['mz']) & (prec['mz'] <= isolation_mz + upper))
+        if len(in_window) == 0:
+            continue
 
-            if min(precursor_rt_range) < fragment_rt_range[0] < max(precursor_rt_range) \
-            and np.abs(
-                np.mean(
-                    [x[1] for x in precursor_points]) - np.mean(
-                    [x[1] for x in fragment_points])) <= im_epsilon \
-            and isolation_mz - lower <= np.mean(
-                [x[0] for x in precursor_points]) <= isolation_mz + upper:
-                precursor_to_fragments[precursor].append(fragment)
+        index = RTIntervalIndex(prec['rt_min'][in_window], prec['rt_max'][in_window])
 
-    with open(dir + '/results.txt', 'w') as outfile:
-        for precursor in precursor_to_fragments:
-            outfile.write(str(precursor) + ': ' + str(precursor_to_fragments[precursor]) +
-                          '\r\n')
+        for frag_pos in np.flatnonzero(frag_windows == window):
+            candidates = in_window[index.containing(frag['rt_first'][frag_pos])]
+            candidates = candidates[
+                np.abs(prec['im'][candidates] - frag['im'][frag_pos]) <= im_epsilon]
 
-    with open(dir + '/results.pkl', 'wb') as handle:
-        pickle.dump(precursor_to_fragments, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            pairs.extend((prec_pos, frag_pos) for prec_pos in candidates)
+
+    pairs.sort()
+    results = np.zeros(len(pairs), dtype=RESULT_DTYPE)
+
+    for i, (prec_pos, frag_pos) in enumerate(pairs):
+        results[i] = (prec['id'][prec_pos], frag['id'][frag_pos])
+        precursor_to_fragments[int(prec['id'][prec_pos])].append(int(frag['id'][frag_pos]))
+
+    store.save_array(dir + '/results.npy', results)
+
+    if dump_text:
+        with open(dir + '/results.txt', 'w') as outfile:
+            for precursor in precursor_to_fragments:
+                outfile.write(str(precursor) + ': ' + str(precursor_to_fragments[precursor]) +
+                              '\r\n')
 
     return precursor_to_fragments
 
@@ -345,259 +640,69 @@ def plot_3d_intensity_map(feature_maps, rt_idx_to_rt, mode='3d'):
 
     plt.show()
 
-def parse_openms(openms_filename):
-    prec_id_to_mz, prec_id_to_frag_anno = {}, {}
-    with open(openms_filename, 'r') as infile:
-        next(infile)
-        for line in infile:
-            line = line.rstrip('\n')
-            line = line.split(',')
-            prec_id_to_mz[line[1]] = float(line[9])
-            prec_id_to_frag_anno[line[1]] = line[60]
-                    
-    return prec_id_to_mz, prec_id_to_frag_anno
-
-def process_openms_frag_anno(anno):
-    anno = [float(x.split('_')[2]) for x in anno.split(';')]
-
-    return anno
-
-def compare_baseline_to_openms(
-    args, precursors, fragments, results, openms_filename):
-    num_openms = 0
-    shared_pairs = []
-
-    openms_id_to_mz, openms_id_to_frag_anno = parse_openms(openms_filename)
-
-    for openms_id in openms_id_to_mz:
-        openms_precursor_mz = openms_id_to_mz[openms_id]
-        match_found = False
-
-        for precursor in precursors:
-            _, precursor_points = precursors[precursor]
-            precursor_mz = np.mean([x[0] for x in precursor_points])
-
-            if np.abs(precursor_mz - openms_precursor_mz) < args.mz_epsilon:
-                shared_pairs.append((openms_id, precursor))
-                match_found = True
-
-        if match_found:
-            num_openms+= 1
-
-    print('Number of precursors detected in both OpenMS and Baseline: ' + \
-        str(num_openms) + ' out of ' + str(len(openms_id_to_mz)) + '\n\r')
-    print(len(precursors))
-
-    num_openms = 0
-    openms_frag_mzs = []
-
-    for openms_id in openms_id_to_mz:
-        for openms_frag_mz in process_openms_frag_anno(
-            openms_id_to_frag_anno[openms_id]):
-            openms_frag_mzs.append(openms_frag_mz)
-
-    openms_frag_mzs = list(set(openms_frag_mzs))
-    openms_frag_mzs.sort()
-
-    baseline_frag_mzs = []
-
-    for fragment in fragments:
-        _, fragment_points = fragments[fragment]
-        fragment_mz = np.mean([x[0] for x in fragment_points])
-        baseline_frag_mzs.append(fragment_mz)
-
-    baseline_frag_mzs = list(set(baseline_frag_mzs))
-    baseline_frag_mzs.sort()
-
-    i, j = 0, 0
-
-    while i < len(openms_frag_mzs) and j < len(baseline_frag_mzs):
-        openms_frag_mz, baseline_frag_mz = (
-            openms_frag_mzs[i], baseline_frag_mzs[j])
-
-        if np.abs(baseline_frag_mz - openms_frag_mz) < args.mz_epsilon:
-            num_openms+= 1
-            i+= 1
-            j+= 1
-        elif min(openms_frag_mz, baseline_frag_mz) == openms_frag_mz:
-            i+= 1
-        else:
-            j+= 1
-
-    # for openms_frag_mz in openms_frag_mzs:
-    #     if counter % 100 == 0:
-    #         print(counter)
-    #     counter+= 1
-    #     match_found = False
-
-    #     for fragment in fragments:
-    #         _, fragment_points = fragments[fragment]
-    #         fragment_mz = np.mean([x[0] for x in fragment_points])
-
-    #         if np.abs(fragment_mz - openms_frag_mz) < args.mz_epsilon:
-    #             match_found = True
-
-    #     if match_found:
-    #         num_openms+= 1
-
-    print('Number of fragments detected in both OpenMS and Baseline: ' + \
-        str(num_openms) + ' out of ' + str(len(openms_frag_mzs)) + '\n\r')
-    
-    baseline_frag_mzs = list(set([float('%.6g' % x) for x in baseline_frag_mzs]))
-    print(len(baseline_frag_mzs))
-
-    # shared_pairs_to_counts = {}
-
-    # for pair in shared_pairs:
-    #     openms_id, prec_id = pair
-    #     openms_frag_mzs = process_openms_frag_anno(
-    #         openms_id_to_frag_anno[openms_id])
-    #     baseline_frags = results[prec_id]
-
-    #     total = len(openms_frag_mzs)
-    #     matching, extra = 0, 0
-
-    #     for openms_frag_mz in openms_frag_mzs:
-    #         match_found = False
-
-    #         for baseline_frag in baseline_frags:
-    #             _, frag_points = fragments[baseline_frag]
-    #             frag_mz = np.mean([x[0] for x in frag_points])
-
-    #             if np.abs(frag_mz - openms_frag_mz) < args.mz_epsilon:
-    #                 match_found = True
-
-    #         if match_found:
-    #             matching+= 1
-    #         else:
-    #             extra+= 1
-
-    #     shared_pairs_to_counts[pair] = [total, matching, extra]
-
-    # print(len(set([x[0] for x in shared_pairs if shared_pairs_to_counts[x][1] > 5])))
-    # print('\n\r')
-    # print(len(set([x[0] for x in shared_pairs if shared_pairs_to_counts[x][1] > 0])))
-    # print('\n\r')
-
-    # for pair in shared_pairs:
-    #     if shared_pairs_to_counts[pair][1] > 5:
-    #         print(str(pair) + ':' + str(shared_pairs_to_counts[pair]) + '\n\r')
-    #         openms_id, prec_id = pair
-    #         openms_frag_mzs = process_openms_frag_anno(
-    #             openms_id_to_frag_anno[openms_id])
-    #         print(str(openms_frag_mzs) + '\n\r')
-    #         baseline_frags = results[prec_id]
-    #         baseline_frag_mzs = []
-    #         for baseline_frag in baseline_frags:
-    #             _, frag_points = fragments[baseline_frag]
-    #             frag_mz = np.mean([x[0] for x in frag_points])
-    #             baseline_frag_mzs.append(frag_mz)
-    #         print(str(sorted(baseline_frag_mzs)) + '\n\r')
-
-    # return shared_pairs_to_counts
-    return
-
 def driver(args):
     # mode: 0 = do everything; 1 = only find features; 2 = only do linking
     if args.mode != 2:
-        exp = ms.MSExperiment()
-        ms.MzMLFile().load(args.infile + '.mzML', exp)
+        features, counter_to_og_rt_ms = find_frame_features(args)
 
-        counter_to_og_rt_ms = {}
-        start_idx = 0
-        spectra = exp.getSpectra()
-
-        total_features = ms.FeatureMap()
-
-        for i in range(start_idx, start_idx + exp.getNrSpectra()):
-            print("Processing frame", i, "of", exp.getNrSpectra())
-            spec = spectra[i]
-
-            new_exp = four_d_spectrum_to_experiment(spec)
-            ms.MzMLFile().store(args.outdir + '/' + str(i) + '_' + args.outfile +
-                                '.mzML', new_exp)
-
-            new_features = run_feature_finder_centroided_on_experiment(new_exp)
-            ms.FeatureXMLFile().store(args.outdir + '/' + str(i) + '_' + args.outfile +
-                                        '.featureXML', new_features)
-
-            total_features += new_features
-            counter_to_og_rt_ms[i] = [spec.getRT(), spec.getMSLevel()]
-
-        with open(args.outdir + '/counter_to_og_rt_ms.pkl', 'wb') as handle:
-            pickle.dump(counter_to_og_rt_ms, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        store.save_array(args.outdir + '/frame_features.npy', features)
+        store.save_array(args.outdir + '/frame_info.npy', counter_to_og_rt_ms)
 
+        # The frame workers only send back the columns of their features, so the
+        # full features are read back from the per-frame files
         ms.FeatureXMLFile().store(args.outdir + '/' + 'baseline.featureXML',
-                                    total_features)
+                                    merge_frame_feature_maps(args.outdir, args.outfile,
+                                                             len(counter_to_og_rt_ms)))
         if args.mode == 1:
             return
 
     #####################################################################################
 
-    feature_maps = []
-    rt_idx_to_rt, counter_to_og_rt_ms = {}, {}
+    frame_features = []
+    rt_idx_to_rt = {}
     counter = 0
 
-    with open(args.outdir + '/counter_to_og_rt_ms.pkl', 'rb') as handle:
-        counter_to_og_rt_ms = pickle.load(handle)
-
-    with open(args.outdir + '/frames.txt', 'w') as infile:
-        for i in range(0, args.window_size):
-            for j in range(i, args.num_frames, args.window_size):
-                infile.write(str(j) + "\r\n")
-                features = ms.FeatureMap()
-                ms.FeatureXMLFile().load(
-                    args.outdir + '/' + str(j) + '_' + args.outfile + '.featureXML',
-                    features)
-
-                for feature in features:
-                    infile.write(str(feature.getMZ()) \
-                    + ',' + str(feature.getRT()) + ',' \
-                    + str(feature.getIntensity()) + "\r\n")
-
-                feature_maps.append(features)
-                rt_idx_to_rt[counter] = j
-                counter+= 1
-
-    possible_species = \
-        link_between_frames(feature_maps, rt_idx_to_rt, args.mz_epsilon, args.im_epsilon)
+    counter_to_og_rt_ms = store.load_array(args.outdir + '/frame_info.npy')
+    features = store.load_array(args.outdir + '/frame_features.npy')
+    frame_starts = np.searchsorted(features['frame'], np.arange(args.num_frames + 1))
+
+    for i in range(0, args.window_size):
+        for j in range(i, args.num_frames, args.window_size):
+            frame_features.append(features[frame_starts[j]:frame_starts[j + 1]])
+            rt_idx_to_rt[counter] = j
+            counter+= 1
+
+    if args.dump_text:
+        with open(args.outdir + '/frames.txt', 'w') as outfile:
+            for rt_idx in range(len(frame_features)):
+                outfile.write(str(rt_idx_to_rt[rt_idx]) + "\r\n")
+
+                for feature in frame_features[rt_idx]:
+                    outfile.write(str(feature['mz']) \
+                    + ',' + str(feature['im']) + ',' \
+                    + str(feature['intensity']) + "\r\n")
+
+    possible_species = store.species_to_array(
+        link_between_frames(frame_features, rt_idx_to_rt, args.mz_epsilon, args.im_epsilon))
     # plot_3d_intensity_map(feature_maps, rt_idx_to_rt)
 
     precursors, fragments = split_precursors_and_fragments(
         possible_species, args.window_size, args.rt_length, counter_to_og_rt_ms)
 
-    with open(args.outdir + '/precursors.txt', 'w') as outfile:
-        outfile.write(str(len(precursors)) + "\r\n")
-        for precursor in precursors:
-            outfile.write(str(precursor) + ": " + str(precursors[precursor]) + "\r\n")
-
-    with open(args.outdir + '/precursors.pkl', 'wb') as handle:
-        pickle.dump(precursors, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-    with open(args.outdir + '/fragments.txt', 'w') as outfile:
-        outfile.write(str(len(fragments)) + "\r\n")
-        for fragment in fragments:
-            outfile.write(str(fragment) + ": " + str(fragments[fragment]) + "\r\n")
+    store.save_array(args.outdir + '/precursors.npy', precursors)
+    store.save_array(args.outdir + '/fragments.npy', fragments)
 
-    with open(args.outdir + '/fragments.pkl', 'wb') as handle:
-        pickle.dump(fragments, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    if args.dump_text:
+        store.write_species_text(args.outdir + '/precursors.txt', precursors)
+        store.write_species_text(args.outdir + '/fragments.txt', fragments)
 
     #####################################################################################
 
     link_frag_to_prec(args.outdir, fragments, precursors, args.window_size,
-                      args.im_epsilon, 0)
-
-    with open(args.outdir + '/precursors.pkl', 'rb') as handle:
-        precursors = pickle.load(handle)
-
-    with open(args.outdir + '/fragments.pkl', 'rb') as handle:
-        fragments = pickle.load(handle)
-
-    with open(args.outdir + '/results.pkl', 'rb') as handle:
-        results = pickle.load(handle)
-
-    compare_baseline_to_openms(args, precursors, fragments, results, 'D:/openms.csv')
+                      args.im_epsilon, 0, args.dump_text)
 
+    if args.openms is not None:
+        cmp.compare_baseline_to_openms(precursors, fragments, args.openms, args.mz_epsilon)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='FragToPre Clustering Baseline')
@@ -610,6 +715,27 @@ if __name__ == "__main__":
     parser.add_argument('--num_frames', action='store', required=False, type=int)
     parser.add_argument('--window_size', action='store', required=False, type=int)
     parser.add_argument('--rt_length', action='store', required=False, type=int)
+    parser.add_argument('--skip_frame_mzml', action='store_true', required=False,
+                        default=False)
+    parser.add_argument('--num_workers', action='store', required=False, type=int,
+                        default=1)
+    parser.add_argument('--omp_threads', action='store', required=False, type=int,
+                        default=0)
+    parser.add_argument('--autotune', action='store_true', required=False, default=False)
+    parser.add_argument('--openms', action='store', required=False, type=str)
+    parser.add_argument('--dump_text', action='store_true', required=False, default=False)
+    parser.add_argument('--frame_ff', action='store', required=False, type=str,
+                        default='centroided', choices=['centroided', 'cluster'])
+    parser.add_argument('--cluster_mz_tol', action='store', required=False, type=float,
+                        default=cfi.MZ_TOLERANCE)
+    parser.add_argument('--cluster_im_tol', action='store', required=False, type=float,
+                        default=cfi.IM_TOLERANCE)
+    parser.add_argument('--cluster_min_samples', action='store', required=False, type=int,
+                        default=cfi.MIN_SAMPLES)
+    parser.add_argument('--cluster_background_threshold', action='store', required=False,
+                        type=float, default=None)
+    parser.add_argument('--compression', action='store', required=False,
+                        type=util.mzml_compression, default='none')
 
     args = parser.parse_args()
     driver(args)
@@ -0,0 +1,192 @@
+"""Benchmarks for the LC-IMS-MS/MS feature finder, run on synthetic data (see synthetic_im).
+"""
+
+import argparse
+import csv
+import os
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+import pyopenms as ms
+
+import common_utils_im as util
+import feature_finder_im as ffim
+import synthetic_im as synth
+
+
+# The mzML compression settings compared by default
+COMPRESSIONS = ['none', 'zlib', 'linear', 'linear,zlib', 'linear,pic', 'linear,slof', 'linear,pic,zlib',
+                'linear,slof,zlib']
+
+# The RT:m/z tile sizes compared by default (0 does not split that dimension; see tiles_im)
+TILINGS = ['0:0', '60:0', '0:200', '60:200']
+
+
+def get_arrays(exp: ms.MSExperiment) -> Dict[str, np.ndarray]:
+    """Concatenates the m/z, intensity and IM values of every peak in an experiment."""
+    mzs, intensities, ims = [], [], []
+    for spec in exp:
+        spec_mzs, spec_intensities = spec.get_peaks()
+        mzs.append(spec_mzs)
+        intensities.append(spec_intensities)
+        ims.append(spec.getFloatDataArrays()[0].get_data())
+
+    return {'mz': np.concatenate(mzs), 'intensity': np.concatenate(intensities).astype(np.float64),
+            'im': np.concatenate(ims).astype(np.float64)}
+
+
+def max_relative_error(reference: np.ndarray, values: np.ndarray) -> float:
+    """Returns the largest relative error of values with respect to (nonzero) reference values."""
+    nonzero = reference != 0
+    if not np.any(nonzero):
+        return 0.0
+    return float(np.max(np.abs(values[nonzero] - reference[nonzero]) / np.abs(reference[nonzero])))
+
+
+def bench_compression(exp: ms.MSExperiment, compressions: List[str], dir: str, repeats: int = 3) -> \
+        List[Dict[str, Any]]:
+    """Measures the CPU time, file size and precision loss of storing an experiment as mzML with
+    each compression setting.
+
+    Keyword arguments:
+    exp: the experiment to store
+    compressions: the compression settings to compare (see common_utils_im.mzml_compression)
+    dir: the directory to write the mzML files to
+    repeats: the number of times to store and load each file (the fastest time is kept)
+
+    Returns: one dictionary of results per compression setting.
+    """
+    reference = get_arrays(exp)
+    results = []
+
+    for compression in compressions:
+        mzml = util.get_mzml_file(compression)
+        filename = os.path.join(dir, 'bench-' + compression.replace(',', '-') + '.mzML')
+        store_t, load_t = float('inf'), float('inf')
+
+        for _ in range(repeats):
+            start_t = time.process_time()
+            mzml.store(filename, exp)
+            store_t = min(store_t, time.process_time() - start_t)
+
+            loaded = ms.MSExperiment()
+            start_t = time.process_time()
+            ms.MzMLFile().load(filename, loaded)
+            load_t = min(load_t, time.process_time() - start_t)
+
+        arrays = get_arrays(loaded)
+        results.append({'compression': compression, 'bytes': os.path.getsize(filename),
+                        'store_cpu_s': store_t, 'load_cpu_s': load_t,
+                        'mz_error': max_relative_error(reference['mz'], arrays['mz']),
+                        'intensity_error': max_relative_error(reference['intensity'], arrays['intensity']),
+                        'im_error': max_relative_error(reference['im'], arrays['im'])})
+        os.remove(filename)
+
+    return results
+
+
+def bench_tiling(filename: str, tilings: List[str], dir: str, num_bins: int = 10, threads: int = 1,
+                 rt_halo: float = 30.0, mz_halo: float = 5.0) -> List[Dict[str, Any]]:
+    """Measures the wall time and the features found by the feature finder with each tiling of its
+    bins, compared to not tiling them.
+
+    Keyword arguments:
+    filename: the (indexed) mzML file to find features in
+    tilings: the tilings to compare, as 'RT:m/z' tile sizes (the untiled '0:0' is always run first)
+    dir: the directory to run the feature finder in
+    num_bins: the number of IM bins to use
+    threads: the number of tiles of a bin to feature find at once
+    rt_halo: the RT overlap between neighbouring tiles
+    mz_halo: the m/z overlap between neighbouring tiles
+
+    Returns: one dictionary of results per tiling.
+    """
+    exp = ms.OnDiscMSExperiment()
+    exp.openFile(filename)
+    tilings = ['0:0'] + [tiling for tiling in tilings if tiling != '0:0']
+    results, reference = [], None
+
+    for tiling in tilings:
+        tile_rt, tile_mz = (float(size) for size in tiling.split(':'))
+        run_dir = os.path.join(dir, 'tiling-' + tiling.replace(':', '-'))
+        os.makedirs(run_dir)
+
+        start_t = time.time()
+        features = ffim.FeatureFinderIonMobility().run(exp, num_bins, pp_type='none', dir=run_dir, tile_rt=tile_rt,
+                                                       tile_mz=tile_mz, tile_rt_halo=rt_halo, tile_mz_halo=mz_halo,
+                                                       tile_threads=threads)  # Synthetic peaks are centroided
+        wall_t = time.time() - start_t
+        features = [[feature.getRT(), feature.getMZ()] for feature in features]
+
+        if reference is None:
+            reference = (wall_t, features)
+        missing = sum(not any(util.similar_features(ref, feature) for feature in features) for ref in reference[1])
+        results.append({'tiling': tiling, 'wall_s': wall_t, 'speedup': reference[0] / wall_t,
+                        'features': len(features), 'feature_delta': len(features) - len(reference[1]),
+                        'missing': missing})
+
+    return results
+
+
+def write_results(results: List[Dict[str, Any]], filename: str) -> None:
+    """Prints a table of benchmark results and writes them to a csv file."""
+    columns = list(results[0].keys())
+    print(' '.join(f'{column:>16}' for column in columns))
+    for result in results:
+        print(' '.join(f'{value:>16.6g}' if isinstance(value, float) else f'{value:>16}'
+                       for value in result.values()))
+
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='LC-IMS-MS/MS feature finder benchmarks.')
+    parser.add_argument('benchmark', action='store', type=str, choices=['compression', 'tiling'],
+                        help='the benchmark to run')
+    parser.add_argument('-i', '--in', action='store', required=False, type=str, dest='in_',
+                        help='the input mzML file (a synthetic experiment is generated if not given)')
+    parser.add_argument('-d', '--dir', action='store', required=False, type=str, default='.',
+                        help='the output directory')
+    parser.add_argument('-f', '--num_frames', action='store', required=False, type=int, default=60,
+                        help='the number of MS1 frames of the synthetic experiment')
+    parser.add_argument('-c', '--compressions', action='store', required=False, type=util.mzml_compression,
+                        nargs='+', default=COMPRESSIONS, help='the mzML compression settings to compare')
+    parser.add_argument('-r', '--repeats', action='store', required=False, type=int, default=3,
+                        help='the number of repetitions of each measurement')
+    parser.add_argument('-t', '--tilings', action='store', required=False, type=str, nargs='+', default=TILINGS,
+                        help="the 'RT:m/z' tile sizes to compare")
+    parser.add_argument('-n', '--num_bins', action='store', required=False, type=int, default=10,
+                        help='the number of IM bins of the tiling benchmark')
+    parser.add_argument('--tile_threads', action='store', required=False, type=int, default=os.cpu_count(),
+                        help='the number of tiles of a bin to feature find at once')
+    parser.add_argument('--tile_rt_halo', action='store', required=False, type=float, default=30.0,
+                        help='the RT overlap (in seconds) between neighbouring tiles')
+    parser.add_argument('--tile_mz_halo', action='store', required=False, type=float, default=5.0,
+                        help='the m/z overlap between neighbouring tiles')
+
+    args = parser.parse_args()
+
+    exp = ms.MSExperiment()
+    if args.in_ is not None:
+        ms.MzMLFile().load(args.in_, exp)
+    else:
+        exp = synth.make_experiment(args.num_frames)
+
+    if args.benchmark == 'compression':
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+            results = bench_compression(exp, args.compressions, tmp_dir, args.repeats)
+        write_results(results, os.path.join(args.dir, 'benchmark-compression.csv'))
+    elif args.benchmark == 'tiling':
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+            filename = args.in_
+            if filename is None:
+                filename = os.path.join(tmp_dir, 'synthetic.mzML')
+                ms.MzMLFile().store(filename, exp)
+            results = bench_tiling(filename, args.tilings, tmp_dir, args.num_bins, args.tile_threads,
+                                   args.tile_rt_halo, args.tile_mz_halo)
+        write_results(results, os.path.join(args.dir, 'benchmark-tiling.csv'))
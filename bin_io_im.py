@@ -0,0 +1,105 @@
+"""Background I/O for the intermediate bins of the LC-IMS-MS/MS feature finder.
+
+WriteBehind flushes cached bins on a writer thread while binning continues, and prefetch loads the
+next bins on a reader thread while the current one is being processed. Both are bounded by a
+depth, so that at most that many bins wait in memory on top of the one being worked on.
+"""
+
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, Tuple
+
+
+class WriteBehind:
+    """A writer thread that runs write tasks in the order they are submitted.
+
+    Submitting blocks while depth tasks are already waiting, which caps the memory held by pending
+    writes. The first error raised by a task is re-raised by the next call to put() or close().
+    """
+
+    def __init__(self, write: Callable[..., None], depth: int = 1) -> None:
+        self.write = write
+        self.tasks = queue.Queue(maxsize=max(depth, 1))
+        self.error = None
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def work(self) -> None:
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            if self.error is None:  # Tasks after a failure are drained without being run
+                try:
+                    self.write(*task)
+                except BaseException as e:
+                    self.error = e
+
+    def check(self) -> None:
+        """Re-raises the error of a failed write task, if any."""
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def put(self, *task: Any) -> None:
+        """Queues a write task (the arguments to the write function)."""
+        self.check()
+        self.tasks.put(task)
+
+    def close(self) -> None:
+        """Waits for every queued write task to finish."""
+        self.tasks.put(None)
+        self.thread.join()
+        self.check()
+
+
+def prefetch(load: Callable[[Any], Any], keys: Iterable[Any], depth: int = 1) -> Iterator[Tuple[Any, Any]]:
+    """Loads items on a reader thread, ahead of their consumer.
+
+    Keyword arguments:
+    load: the function that loads the item of a key
+    keys: the keys of the items to load, in order
+    depth: the number of items that may be loaded ahead of the one being consumed (1 for double
+        buffering; 0 loads every item synchronously)
+
+    Returns: an iterator of (key, item) pairs, in the order of keys. Errors raised by load are
+        re-raised by the iterator.
+    """
+    if depth <= 0:
+        for key in keys:
+            yield key, load(key)
+        return
+
+    items = queue.Queue()
+    slots = threading.Semaphore(depth)  # Free buffers
+    stop = threading.Event()
+
+    def work() -> None:
+        try:
+            for key in keys:
+                slots.acquire()
+                if stop.is_set():
+                    return
+                items.put((key, load(key), None))
+        except BaseException as e:
+            items.put((None, None, e))
+            return
+        items.put(None)
+
+    thread = threading.Thread(target=work, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = items.get()
+            if item is None:
+                return
+            key, value, error = item
+            if error is not None:
+                raise error
+            slots.release()  # The consumer holds this item now, so the next one can be loaded
+            yield key, value
+            item = value = None  # Do not keep the consumed item alive while waiting for the next one
+    finally:
+        stop.set()
+        slots.release()  # Wakes up the reader if it is waiting for a buffer
@@ -0,0 +1,112 @@
+"""Scheduling of the per-bin feature finding tasks of the LC-IMS-MS/MS feature finder.
+
+IM bins are very unevenly sized: the central bins hold most of the signal and take far longer to
+feature find than the edge bins. Tasks are therefore dispatched longest-first (by their estimated
+cost) to workers that each take the next task as soon as they are done with their last one, so
+that a large bin is never started last. Costs are estimated from the occupancy statistics of the
+bins, with a model fitted to the task timings of previous runs with the same settings once there
+are enough of them.
+"""
+
+import csv
+import os
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+
+# The settings that a feature finding task was run with (tasks only predict the cost of tasks run
+# with the same settings)
+SETTINGS_DTYPE = np.dtype([('num_workers', np.int64), ('omp_threads', np.int64), ('tile_rt', np.float64),
+                           ('tile_mz', np.float64), ('tile_threads', np.int64), ('pp_type', 'U8'),
+                           ('filter', 'U8'), ('gauss_ppm', np.float64), ('sgolay_frame', np.int64),
+                           ('ff_type', 'U12')])
+
+# The timing of a feature finding task, as recorded in the timings file. Without workers, bins are
+# loaded in the background, so load_s is only the time spent waiting for the bin
+TIMING_DTYPE = np.dtype([('pass', np.int64), ('bin', np.int64), ('spectra', np.int64), ('peaks', np.int64)] +
+                        SETTINGS_DTYPE.descr + [('load_s', np.float64), ('find_s', np.float64)])
+
+MIN_TIMINGS = 8  # The fewest timings to fit a cost model to
+
+
+def load_timings(filename: str) -> np.ndarray:
+    """Reads the task timings recorded by previous runs (none if the file does not exist or is in
+    another format).
+    """
+    if not os.path.isfile(filename):
+        return np.zeros(0, dtype=TIMING_DTYPE)
+
+    with open(filename, newline='') as file:
+        reader = csv.DictReader(file)
+        if tuple(reader.fieldnames or ()) != TIMING_DTYPE.names:
+            return np.zeros(0, dtype=TIMING_DTYPE)
+        rows = [tuple(row[name] for name in TIMING_DTYPE.names) for row in reader]
+    return np.array(rows, dtype=TIMING_DTYPE) if rows else np.zeros(0, dtype=TIMING_DTYPE)
+
+
+def append_timings(filename: str, timings: np.ndarray) -> None:
+    """Appends task timings to a timings file, so that later runs can learn from them. A file in
+    another format is started over.
+    """
+    header = None
+    if os.path.isfile(filename):
+        with open(filename, newline='') as file:
+            header = tuple(next(csv.reader(file), ()))
+
+    with open(filename, 'a' if header == TIMING_DTYPE.names else 'w', newline='') as file:
+        writer = csv.writer(file)
+        if header != TIMING_DTYPE.names:
+            writer.writerow(TIMING_DTYPE.names)
+        writer.writerows(timings.tolist())
+
+
+def select_timings(timings: np.ndarray, settings: Dict[str, Any]) -> np.ndarray:
+    """Selects the task timings that were recorded with the given settings (see SETTINGS_DTYPE)."""
+    selected = np.ones(len(timings), dtype=bool)
+    for name in SETTINGS_DTYPE.names:
+        selected &= timings[name] == settings[name]
+    return timings[selected]
+
+
+class CostModel:
+    """Estimates the time a feature finding task takes from the spectra and peaks of its bin. Only
+    the feature finding time is modelled, as load times depend on whether bins are prefetched.
+
+    Until it is fitted (with at least MIN_TIMINGS timings), the cost of a task is its peak count.
+    """
+
+    def __init__(self) -> None:
+        self.coefs = None  # Seconds per task, spectrum, and peak
+
+    @staticmethod
+    def predictors(spectra: np.ndarray, peaks: np.ndarray) -> np.ndarray:
+        """Stacks the predictors of the model: a constant, and the spectra and peaks of each bin."""
+        return np.column_stack([np.ones(len(spectra)), spectra, peaks]).astype(np.float64)
+
+    def fit(self, timings: np.ndarray) -> bool:
+        """Fits the model to task timings by least squares. The timings should all come from tasks
+        run with the same settings (see select_timings).
+
+        Returns: True if the model was fitted, or False if there are too few timings (or they do
+            not vary in size) and peak counts are still used.
+        """
+        if len(timings) < MIN_TIMINGS or len(np.unique(timings['peaks'])) < 2:
+            return False
+
+        x = self.predictors(timings['spectra'], timings['peaks'])
+        self.coefs = np.linalg.lstsq(x, timings['find_s'], rcond=None)[0]
+        return True
+
+    def predict(self, spectra: np.ndarray, peaks: np.ndarray) -> np.ndarray:
+        """Estimates the cost of the tasks of bins with the given spectra and peak counts."""
+        if self.coefs is None:
+            return np.asarray(peaks, dtype=np.float64)
+        # Ties and negative estimates (for tiny bins) are broken by peak count
+        return np.maximum(self.predictors(spectra, peaks) @ self.coefs, 0) + 1e-12 * np.asarray(peaks)
+
+
+def largest_first(tasks: Sequence[Any], costs: Sequence[float]) -> List[Any]:
+    """Orders tasks by descending estimated cost (tasks of equal cost keep their order)."""
+    order = np.argsort(-np.asarray(costs, dtype=np.float64), kind='stable')
+    return [tasks[k] for k in order]
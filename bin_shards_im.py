@@ -0,0 +1,198 @@
+"""A compact binary format for the intermediate IM bins of the LC-IMS-MS/MS feature finder.
+
+A shard holds the binned spectra of a single (sub-)bin as four flat files that share a prefix
+(e.g. run/h-3):
+    <prefix>.spec: one (RT, offset, length) row per spectrum
+    <prefix>.mz: the float64 m/z of every peak
+    <prefix>.int: the float32 intensity of every peak
+    <prefix>.im: the float32 IM of every peak
+
+The peaks of a spectrum are contiguous, starting at its offset. Every file is a raw little-endian
+array, so shards can be appended to without being read and can be memory-mapped.
+
+BinBuffer holds binned spectra in memory in the same layout, until they are appended to a shard.
+"""
+
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pyopenms as ms
+
+
+SPECTRUM_DTYPE = np.dtype([('rt', '<f8'), ('offset', '<i8'), ('length', '<i8')])
+PEAK_DTYPES = {'mz': np.dtype('<f8'), 'int': np.dtype('<f4'), 'im': np.dtype('<f4')}
+
+
+def _grow(array: np.ndarray, size: int, capacity: int) -> np.ndarray:
+    grown = np.empty(capacity, dtype=array.dtype)  # The unused tail is left untouched (and not resident)
+    grown[:size] = array[:size]
+    return grown
+
+
+class BinBuffer:
+    """A growable in-memory buffer of binned spectra, laid out like a shard: one SPECTRUM_DTYPE row
+    per spectrum and flat m/z (float64), intensity and IM (float32) columns. Capacity doubles when
+    full, so appending is amortized constant time.
+    """
+
+    def __init__(self, spectrum_capacity: int = 64, peak_capacity: int = 1024) -> None:
+        self.spectra = np.empty(spectrum_capacity, dtype=SPECTRUM_DTYPE)
+        self.peaks = {name: np.empty(peak_capacity, dtype=dtype) for name, dtype in PEAK_DTYPES.items()}
+        self.num_spectra, self.num_peaks = 0, 0
+
+    @property
+    def nbytes(self) -> int:
+        """The allocated size of the buffer, in bytes."""
+        return self.spectra.nbytes + sum(column.nbytes for column in self.peaks.values())
+
+    def append(self, rt: float, mzs: np.ndarray, intensities: np.ndarray, ims: np.ndarray) -> None:
+        """Appends a spectrum to the buffer."""
+        if self.num_spectra == len(self.spectra):
+            self.spectra = _grow(self.spectra, self.num_spectra, 2 * len(self.spectra))
+
+        end = self.num_peaks + len(mzs)
+        if end > len(self.peaks['mz']):
+            capacity = max(2 * len(self.peaks['mz']), end)
+            self.peaks = {name: _grow(column, self.num_peaks, capacity) for name, column in self.peaks.items()}
+
+        self.spectra[self.num_spectra] = (rt, self.num_peaks, len(mzs))
+        for name, values in (('mz', mzs), ('int', intensities), ('im', ims)):
+            self.peaks[name][self.num_peaks:end] = values
+        self.num_spectra, self.num_peaks = self.num_spectra + 1, end
+
+    def columns(self) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Returns views of the buffered spectra, as the columns of a shard (see load_shard)."""
+        return self.spectra[:self.num_spectra], {name: column[:self.num_peaks] for name, column in self.peaks.items()}
+
+
+def shard_prefix(dir: str, sub_bin: int) -> str:
+    """Returns the file prefix of the shard of a given sub-bin."""
+    return dir + '/h-' + str(sub_bin)
+
+
+def shard_files(prefix: str) -> List[str]:
+    """Returns the files that make up a shard."""
+    return [prefix + '.spec'] + [prefix + '.' + name for name in PEAK_DTYPES]
+
+
+def remove_shard(prefix: str) -> None:
+    """Deletes a shard, if it exists."""
+    for filename in shard_files(prefix):
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+
+def num_shard_peaks(prefix: str) -> int:
+    """Returns the number of peaks already stored in a shard."""
+    filename = prefix + '.mz'
+    return os.path.getsize(filename) // PEAK_DTYPES['mz'].itemsize if os.path.isfile(filename) else 0
+
+
+def append_spectra(prefix: str, rts: np.ndarray, lengths: np.ndarray, mzs: np.ndarray, intensities: np.ndarray,
+                   ims: np.ndarray) -> None:
+    """Appends spectra to a shard (creating it if needed).
+
+    Keyword arguments:
+    prefix: the file prefix of the shard
+    rts: the RT of each spectrum
+    lengths: the number of peaks of each spectrum
+    mzs: the m/zs of the peaks of all spectra, concatenated
+    intensities: the intensities of the peaks of all spectra, concatenated
+    ims: the IMs of the peaks of all spectra, concatenated
+    """
+    if len(rts) == 0:
+        return
+
+    lengths = np.asarray(lengths, dtype=np.int64)
+    spectra = np.zeros(len(rts), dtype=SPECTRUM_DTYPE)
+    spectra['rt'], spectra['length'] = rts, lengths
+    spectra['offset'] = num_shard_peaks(prefix) + np.cumsum(lengths) - lengths
+
+    columns = {'mz': mzs, 'int': intensities, 'im': ims}
+    for name, dtype in PEAK_DTYPES.items():
+        with open(prefix + '.' + name, 'ab') as f:
+            np.asarray(columns[name], dtype=dtype).tofile(f)
+    with open(prefix + '.spec', 'ab') as f:
+        spectra.tofile(f)
+
+
+def experiment_columns(exp: ms.MSExperiment) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """Converts the spectra of an experiment (with IM values in their first float data arrays) to
+    the columns of a shard, as returned by load_shard.
+    """
+    spectra = np.zeros(exp.getNrSpectra(), dtype=SPECTRUM_DTYPE)
+    mzs, intensities, ims = [np.zeros(0)], [np.zeros(0)], [np.zeros(0)]
+
+    for i, spec in enumerate(exp):
+        spec_mzs, spec_intensities = spec.get_peaks()
+        spectra[i]['rt'], spectra[i]['length'] = spec.getRT(), len(spec_mzs)
+        mzs.append(spec_mzs)
+        intensities.append(spec_intensities)
+        ims.append(spec.getFloatDataArrays()[0].get_data() if len(spec_mzs) > 0 else np.zeros(0))
+
+    spectra['offset'] = np.cumsum(spectra['length']) - spectra['length']
+    peaks = {'mz': np.concatenate(mzs), 'int': np.concatenate(intensities), 'im': np.concatenate(ims)}
+    return spectra, {name: peaks[name].astype(dtype) for name, dtype in PEAK_DTYPES.items()}
+
+
+def append_buffer(prefix: str, buffer: BinBuffer) -> None:
+    """Appends the spectra of a bin buffer to a shard."""
+    spectra, peaks = buffer.columns()
+    append_spectra(prefix, spectra['rt'], spectra['length'], peaks['mz'], peaks['int'], peaks['im'])
+
+
+def append_experiment(prefix: str, exp: ms.MSExperiment) -> None:
+    """Appends the spectra of an experiment (with IM values in their first float data arrays) to a
+    shard.
+    """
+    spectra, peaks = experiment_columns(exp)
+    append_spectra(prefix, spectra['rt'], spectra['length'], peaks['mz'], peaks['int'], peaks['im'])
+
+
+def _map(filename: str, dtype: np.dtype, mmap: bool) -> np.ndarray:
+    if not os.path.isfile(filename) or os.path.getsize(filename) == 0:  # Empty files cannot be mapped
+        return np.zeros(0, dtype=dtype)
+    if mmap:
+        return np.memmap(filename, dtype=dtype, mode='r')
+    return np.fromfile(filename, dtype=dtype)
+
+
+def load_shard(prefix: str, mmap: bool = True) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """Reads a shard (a missing shard is read as an empty one).
+
+    Keyword arguments:
+    prefix: the file prefix of the shard
+    mmap: determines if the files should be memory-mapped instead of read into memory
+
+    Returns: the SPECTRUM_DTYPE rows of the shard's spectra, and a dictionary holding the 'mz',
+    'int' and 'im' arrays of its peaks.
+    """
+    spectra = _map(prefix + '.spec', SPECTRUM_DTYPE, mmap)
+    peaks = {name: _map(prefix + '.' + name, dtype, mmap) for name, dtype in PEAK_DTYPES.items()}
+    return spectra, peaks
+
+
+def columns_to_experiment(spectra: np.ndarray, peaks: Dict[str, np.ndarray]) -> ms.MSExperiment:
+    """Materializes the columns of a shard (or bin buffer) as an experiment (e.g. for a pyOpenMS
+    algorithm). IM values are stored in the first float data array of each spectrum.
+    """
+    exp = ms.MSExperiment()
+
+    for rt, offset, length in spectra.tolist():
+        spec = ms.MSSpectrum()
+        spec.setRT(rt)
+        spec.set_peaks((np.array(peaks['mz'][offset:offset + length]),
+                        np.array(peaks['int'][offset:offset + length])))
+
+        im_fda = ms.FloatDataArray()
+        im_fda.set_data(np.array(peaks['im'][offset:offset + length]))
+        spec.setFloatDataArrays([im_fda])
+        exp.addSpectrum(spec)
+
+    return exp
+
+
+def load_experiment(prefix: str) -> ms.MSExperiment:
+    """Materializes a shard as an experiment (see columns_to_experiment)."""
+    return columns_to_experiment(*load_shard(prefix))
@@ -0,0 +1,315 @@
+"""A clustering-based (DBSCAN-style) feature finder for single LC-IMS-MS frames.
+
+Peaks are clustered in (m/z, IM[, intensity]) space after dividing each axis by its tolerance, so
+that a distance of 1 corresponds to "within tolerance". Neighbours are found with a uniform grid
+of unit cells, so only points in adjacent cells are ever compared.
+"""
+
+from itertools import product
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+MZ_TOLERANCE = 0.01
+IM_TOLERANCE = 0.005
+MIN_SAMPLES = 5
+MAX_PAIRS = 1 << 24  # Candidate pairs generated at once (bounds memory use)
+
+RANSAC_ITERATIONS = 1000
+RANSAC_BATCH_SIZE = 64  # Candidate planes evaluated at once
+RANSAC_CHUNK_SIZE = 1 << 16  # Points evaluated at once
+RANSAC_CONFIDENCE = 0.99
+
+NOISE = -1
+
+
+def grid_cells(coords: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Assigns points to unit grid cells.
+
+    Keyword arguments:
+    coords: the scaled coordinates of the points (one row per point)
+
+    Returns: a tuple of the point indices sorted by cell, the (sorted, unique) linearized cell keys,
+    the offset of each cell into the sorted point indices, and the key strides of each axis.
+    """
+    cells = np.floor(coords).astype(np.int64)
+    cells -= cells.min(axis=0) - 1  # Leave an empty layer of cells below and above each axis
+    dims = cells.max(axis=0) + 2
+
+    strides = np.ones(coords.shape[1], dtype=np.int64)
+    for d in range(coords.shape[1] - 2, -1, -1):
+        strides[d] = strides[d + 1] * dims[d + 1]
+
+    keys = cells @ strides
+    order = np.argsort(keys, kind='stable')
+    unique_keys, starts = np.unique(keys[order], return_index=True)
+
+    return order, unique_keys, np.append(starts, len(order)), strides
+
+
+def expand_cell_pairs(cell_a: np.ndarray, cell_b: np.ndarray, starts: np.ndarray) -> \
+        Tuple[np.ndarray, np.ndarray]:
+    """Expands pairs of cells into all pairs of (sorted) point positions between them."""
+    counts_a = starts[cell_a + 1] - starts[cell_a]
+    counts_b = starts[cell_b + 1] - starts[cell_b]
+    sizes = counts_a * counts_b
+
+    owner = np.repeat(np.arange(len(sizes)), sizes)
+    offset = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+    pos_a = starts[cell_a][owner] + offset // counts_b[owner]
+    pos_b = starts[cell_b][owner] + offset % counts_b[owner]
+
+    return pos_a, pos_b
+
+
+def neighbor_pairs(coords: np.ndarray, max_pairs: int = MAX_PAIRS) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds every unordered pair of points within a (Euclidean) distance of 1.
+
+    Keyword arguments:
+    coords: the scaled coordinates of the points (one row per point)
+    max_pairs: the maximum number of candidate pairs to generate at once
+
+    Returns: two arrays of point indices, where (i[k], j[k]) is a neighbouring pair and i[k] < j[k].
+    """
+    if len(coords) < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    order, keys, starts, strides = grid_cells(coords)
+    sorted_coords = coords[order]
+    found_a, found_b = [], []
+
+    # Half of the adjacent cells (plus the cell itself), so that every pair is visited once
+    for offset in product((-1, 0, 1), repeat=coords.shape[1]):
+        delta = int(np.dot(offset, strides))
+        if delta < 0:
+            continue
+
+        pos = np.searchsorted(keys, keys + delta)
+        valid = pos < len(keys)
+        valid[valid] = keys[pos[valid]] == keys[valid] + delta
+        cell_a, cell_b = np.flatnonzero(valid), pos[valid]
+
+        sizes = (starts[cell_a + 1] - starts[cell_a]) * (starts[cell_b + 1] - starts[cell_b])
+        total_sizes = np.cumsum(sizes)
+        chunk_start = 0
+
+        while chunk_start < len(cell_a):
+            done = total_sizes[chunk_start - 1] if chunk_start > 0 else 0
+            chunk_end = max(np.searchsorted(total_sizes, done + max_pairs, side='right'), chunk_start + 1)
+
+            pos_a, pos_b = expand_cell_pairs(cell_a[chunk_start:chunk_end], cell_b[chunk_start:chunk_end], starts)
+            chunk_start = chunk_end
+
+            if delta == 0:
+                keep = pos_a < pos_b
+                pos_a, pos_b = pos_a[keep], pos_b[keep]
+
+            diff = sorted_coords[pos_a] - sorted_coords[pos_b]
+            close = np.einsum('ij,ij->i', diff, diff) <= 1.0
+
+            found_a.append(order[pos_a[close]])
+            found_b.append(order[pos_b[close]])
+
+    i, j = np.concatenate(found_a), np.concatenate(found_b)
+    return np.minimum(i, j), np.maximum(i, j)
+
+
+def dbscan(coords: np.ndarray, min_samples: int = MIN_SAMPLES) -> np.ndarray:
+    """Clusters points with DBSCAN (eps = 1, in scaled units).
+
+    Keyword arguments:
+    coords: the scaled coordinates of the points (one row per point)
+    min_samples: the number of neighbours (including itself) that makes a point a core point
+
+    Returns: the cluster label of every point (NOISE for noise points).
+    """
+    num_points = len(coords)
+    labels = np.full(num_points, NOISE, dtype=np.int64)
+    if num_points == 0:
+        return labels
+
+    i, j = neighbor_pairs(coords)
+    num_neighbors = 1 + np.bincount(i, minlength=num_points) + np.bincount(j, minlength=num_points)
+    core = num_neighbors >= min_samples
+
+    # Clusters are the connected components of the core points
+    core_edges = core[i] & core[j]
+    graph = coo_matrix((np.ones(np.count_nonzero(core_edges), dtype=np.int8), (i[core_edges], j[core_edges])),
+                       shape=(num_points, num_points))
+    _, components = connected_components(graph, directed=False)
+
+    _, labels[core] = np.unique(components[core], return_inverse=True)
+
+    # Border points join the cluster of (one of) their core neighbours
+    border = core[i] & ~core[j]
+    labels[j[border]] = labels[i[border]]
+    border = core[j] & ~core[i]
+    labels[i[border]] = labels[j[border]]
+
+    return labels
+
+
+def cluster_apexes(labels: np.ndarray, intensity: np.ndarray) -> Dict[str, np.ndarray]:
+    """Finds the apex (most intense point) of every cluster.
+
+    Keyword arguments:
+    labels: the cluster label of every point
+    intensity: the intensity of every point
+
+    Returns: a dictionary of arrays (one entry per cluster) holding the index of the apex point, the
+    apex intensity, the summed intensity and the number of points of each cluster.
+    """
+    clustered = np.flatnonzero(labels != NOISE)
+    num_clusters = int(labels.max()) + 1 if len(clustered) > 0 else 0
+
+    # Sort by label, then intensity: the apex is the last point of each label
+    order = clustered[np.lexsort((intensity[clustered], labels[clustered]))]
+    sizes = np.bincount(labels[order], minlength=num_clusters)
+    apexes = order[np.cumsum(sizes) - 1]
+
+    max_intensity = np.zeros(num_clusters)
+    np.maximum.at(max_intensity, labels[clustered], intensity[clustered])
+
+    return {'apex': apexes,
+            'intensity': max_intensity,
+            'total_intensity': np.bincount(labels[clustered], weights=intensity[clustered], minlength=num_clusters),
+            'size': sizes}
+
+
+def fit_plane_ransac(points: np.ndarray, threshold: float, num_iters: int = RANSAC_ITERATIONS,
+                     goal_inliers: Optional[int] = None, confidence: float = RANSAC_CONFIDENCE,
+                     batch_size: int = RANSAC_BATCH_SIZE, chunk_size: int = RANSAC_CHUNK_SIZE,
+                     random_seed: int = 0, vertical: bool = False) -> Tuple[np.ndarray, int]:
+    """Fits a plane to 3D points with RANSAC, evaluating batches of candidate planes against all
+    points as a matrix product.
+
+    Stops early once a plane explains goal_inliers points, or once enough candidates have been
+    tried to find the best plane with the given confidence (using the best inlier ratio so far).
+
+    Keyword arguments:
+    points: the points to fit (one row per point)
+    threshold: the maximum distance of an inlier from the plane
+    num_iters: the maximum number of candidate planes to try
+    goal_inliers: if given, stop as soon as a plane has at least this many inliers
+    confidence: the probability of having sampled an all-inlier triple before stopping early
+    batch_size: the number of candidate planes evaluated at once
+    chunk_size: the number of points evaluated at once
+    random_seed: the seed for sampling candidate planes
+    vertical: if true, distances are measured along the third axis instead of along the normal
+        (for planes through axes with different units, e.g. intensity over m/z and IM)
+
+    Returns: a tuple of the plane coefficients (a, b, c, d), with (a, b, c) a unit normal (or with
+    |c| = 1 if vertical), and the number of inliers of that plane.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    rng = np.random.default_rng(random_seed)
+    best_coeffs, best_count = np.zeros(4), 0
+    max_iters, tried = num_iters, 0
+
+    if len(points) < 3:
+        return best_coeffs, best_count
+
+    while tried < max_iters:
+        size = min(batch_size, max_iters - tried)
+        tried += size
+
+        samples = points[rng.integers(0, len(points), (size, 3))]
+        normals = np.cross(samples[:, 1] - samples[:, 0], samples[:, 2] - samples[:, 0])
+        norms = np.abs(normals[:, 2]) if vertical else np.linalg.norm(normals, axis=1)
+        valid = norms > 0  # Skip collinear (or, if vertical, vertical) samples
+        if not np.any(valid):
+            continue
+
+        normals = normals[valid] / norms[valid, None]
+        offsets = -np.einsum('ij,ij->i', normals, samples[valid, 0])
+
+        counts = np.zeros(len(normals), dtype=np.int64)
+        for start in range(0, len(points), chunk_size):
+            distances = points[start:start + chunk_size] @ normals.T + offsets
+            counts += np.count_nonzero(np.abs(distances) < threshold, axis=0)
+
+        best = np.argmax(counts)
+        if counts[best] > best_count:
+            best_count = int(counts[best])
+            best_coeffs = np.append(normals[best], offsets[best])
+
+            if goal_inliers is not None and best_count >= goal_inliers:
+                break
+
+            inlier_ratio = best_count / len(points)
+            if inlier_ratio >= 1:
+                break
+            needed = np.log(1 - confidence) / np.log(1 - inlier_ratio ** 3)
+            max_iters = min(max_iters, int(np.ceil(needed)))
+
+    return best_coeffs, best_count
+
+
+def remove_background(mz: np.ndarray, im: np.ndarray, intensity: np.ndarray, threshold: float,
+                      random_seed: int = 0) -> np.ndarray:
+    """Finds the peaks of a frame that lie above its background plane (intensity as a plane over
+    m/z and IM, fitted with RANSAC).
+
+    Keyword arguments:
+    mz: the m/z of every peak
+    im: the IM of every peak
+    intensity: the intensity of every peak
+    threshold: the intensity above the plane up to which peaks are considered background
+    random_seed: the seed for RANSAC
+
+    Returns: a boolean mask of the peaks to keep.
+    """
+    points = np.column_stack((mz, im, intensity)).astype(np.float64)
+    coeffs, _ = fit_plane_ransac(points, threshold, random_seed=random_seed, vertical=True)
+    if not np.any(coeffs[:3]):
+        return np.ones(len(points), dtype=bool)
+
+    if coeffs[2] < 0:  # Orient the normal towards increasing intensity
+        coeffs = -coeffs
+
+    return points @ coeffs[:3] + coeffs[3] >= threshold
+
+
+def find_frame_features(mz: np.ndarray, im: np.ndarray, intensity: np.ndarray, mz_tolerance: float = MZ_TOLERANCE,
+                        im_tolerance: float = IM_TOLERANCE, intensity_tolerance: Optional[float] = None,
+                        min_samples: int = MIN_SAMPLES, background_threshold: Optional[float] = None) -> \
+        Dict[str, np.ndarray]:
+    """Finds features in a single frame by clustering its peaks.
+
+    Keyword arguments:
+    mz: the m/z of every peak
+    im: the IM of every peak
+    intensity: the intensity of every peak
+    mz_tolerance: the m/z distance that corresponds to one DBSCAN eps
+    im_tolerance: the IM distance that corresponds to one DBSCAN eps
+    intensity_tolerance: if given, intensity is used as a third clustering axis with this scale
+    min_samples: the number of neighbours (including itself) that makes a peak a core point
+    background_threshold: if given, peaks within this distance of (or below) the RANSAC background
+        plane of the frame are removed before clustering
+
+    Returns: a dictionary of arrays (one entry per feature) holding the m/z, IM and intensity of the
+    apex of each feature, its summed intensity, and its number of peaks.
+    """
+    mz, im = np.asarray(mz, dtype=np.float64), np.asarray(im, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+
+    if background_threshold is not None:
+        keep = remove_background(mz, im, intensity, background_threshold)
+        mz, im, intensity = mz[keep], im[keep], intensity[keep]
+
+    axes = [mz / mz_tolerance, im / im_tolerance]
+    if intensity_tolerance is not None:
+        axes.append(intensity / intensity_tolerance)
+
+    labels = dbscan(np.column_stack(axes), min_samples)
+    apexes = cluster_apexes(labels, intensity)
+
+    return {'mz': mz[apexes['apex']],
+            'im': im[apexes['apex']],
+            'intensity': apexes['intensity'],
+            'total_intensity': apexes['total_intensity'],
+            'size': apexes['size']}
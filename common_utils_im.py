@@ -1,11 +1,71 @@
 """Common utilities for the LC-IMS-MS/MS feature finder and peak picker.
 """
 
-from typing import Any, List, Tuple
+from typing import Any, List, Optional, Tuple
 
+import numpy as np
 import pyopenms as ms
 
 
+# The mzML compression methods accepted by get_mzml_file (see mzml_compression)
+MZML_COMPRESSIONS = ['zlib', 'linear', 'pic', 'slof']
+
+
+def mzml_compression(compression: str) -> str:
+    """Validates an mzML compression setting: 'none', or a comma-separated combination of 'zlib'
+    (for every array), 'linear' (numpress for m/z arrays), and one of 'pic' or 'slof' (numpress
+    for intensity arrays). IM arrays are never numpressed, as linear prediction fails on their
+    unsorted values. Usable as an argparse type.
+    """
+    if compression == 'none':
+        return compression
+
+    methods = compression.split(',')
+    for method in methods:
+        if method not in MZML_COMPRESSIONS:
+            raise ValueError('unknown mzML compression: ' + method)
+    if 'pic' in methods and 'slof' in methods:
+        raise ValueError('pic and slof cannot be combined')
+
+    return compression
+
+
+def get_mzml_file(compression: str = 'none') -> ms.MzMLFile:
+    """Creates an MzMLFile that stores peak data with the given compression.
+
+    Keyword arguments:
+    compression: the compression setting to use (see mzml_compression)
+
+    Returns: the configured MzMLFile (loading is unaffected, as compression is detected on read).
+    """
+    mzml = ms.MzMLFile()
+    if mzml_compression(compression) == 'none':
+        return mzml
+
+    methods = compression.split(',')
+    coders = ms.MSNumpressCoder.NumpressCompression
+    options = mzml.getOptions()
+    options.setCompression('zlib' in methods)
+
+    def numpress_config(coder: Any) -> ms.NumpressConfig:
+        config = ms.NumpressConfig()
+        config.np_compression = coder
+        config.estimate_fixed_point = True
+        return config
+
+    if 'linear' in methods:
+        options.setNumpressConfigurationMassTime(numpress_config(coders.LINEAR))
+    if 'pic' in methods:
+        options.setNumpressConfigurationIntensity(numpress_config(coders.PIC))
+    elif 'slof' in methods:
+        config = numpress_config(coders.SLOF)
+        config.numpressErrorTolerance = -1.0  # Its log-scale rounding is expected; skip the round-trip check
+        options.setNumpressConfigurationIntensity(config)
+
+    mzml.setOptions(options)
+    return mzml
+
+
 def get_spectrum_points(spec: ms.MSSpectrum) -> List[List[float]]:
     """Extracts the retention times, mass to charges, intensities, and ion mobility values of all
     peaks in a spectrum.
@@ -20,23 +80,44 @@ def get_spectrum_points(spec: ms.MSSpectrum) -> List[List[float]]:
     return [[spec.getRT(), mz, intensity, im] for mz, intensity, im in point_data]
 
 
-def get_im_extrema(exp: ms.OnDiscMSExperiment) -> Tuple[float, float]:
+def get_spectrum_indices(exp: ms.OnDiscMSExperiment, ms_level: Optional[int] = 1) -> List[int]:
+    """Finds the spectra of an MS level using only the experiment's metadata, so that no peak data
+    is decoded.
+
+    Keyword arguments:
+    exp: the experiment to search through
+    ms_level: the MS level of the spectra to find, or None for all spectra
+
+    Returns: the indices of the matching spectra, in ascending order.
+    """
+    if ms_level is None:
+        return list(range(exp.getNrSpectra()))
+
+    meta = exp.getMetaData()
+    return [i for i, spec in enumerate(meta.getSpectra()) if spec.getMSLevel() == ms_level]
+
+
+def get_im_extrema(exp: ms.OnDiscMSExperiment, indices: Optional[List[int]] = None) -> Tuple[float, float]:
     """Finds the smallest and largest IM values in a list of spectra.
 
     Keyword arguments:
     exp: the experiment containing spectra with IM data to scan through
+    indices: the spectra to scan through (defaults to all of them)
 
     Returns: a tuple of the smallest and largest IM values, in that order.
     """
     smallest_im, largest_im = float('inf'), float('-inf')
+    if indices is None:
+        indices = range(exp.getNrSpectra())
 
-    for i in range(exp.getNrSpectra()):
-        points = get_spectrum_points(exp.getSpectrum(i))
-        for point in points:
-            if point[3] < smallest_im:
-                smallest_im = point[3]
-            if point[3] > largest_im:
-                largest_im = point[3]
+    for i in indices:
+        spec = exp.getSpectrum(i)
+        if spec.size() == 0:
+            continue
+
+        ims = spec.getFloatDataArrays()[0].get_data()
+        smallest_im = min(smallest_im, float(ims.min()))
+        largest_im = max(largest_im, float(ims.max()))
 
     return smallest_im, largest_im
 
@@ -82,6 +163,40 @@ def has_peaks(exp: ms.MSExperiment) -> bool:
     return False
 
 
+def merge_mz_slices(mzs: np.ndarray, intensities: np.ndarray, ims: np.ndarray, epsilon: float) -> \
+        Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Merges the peaks of a spectrum into m/z slices. Starting from the lowest m/z, a slice holds
+    its first peak and every following peak within epsilon of its m/z.
+
+    Keyword arguments:
+    mzs: the m/z values of the peaks, in ascending order
+    intensities: the intensities of the peaks
+    ims: the IM values of the peaks
+    epsilon: the m/z width of a slice
+
+    Returns: the m/z values, total intensities and IM values of the slices (each slice takes the
+        m/z and IM values of its first peak).
+    """
+    if len(mzs) == 0:
+        return mzs, intensities, ims
+
+    ends = np.searchsorted(mzs, mzs + epsilon, side='right').tolist()  # The next slice after each peak
+    starts, start = [], 0
+    while start < len(ends):
+        starts.append(start)
+        start = ends[start]
+
+    # Intensities are summed in order (as a running total, in their own precision) across all slices at once
+    starts = np.array(starts)
+    lengths = np.diff(np.append(starts, len(mzs)))
+    totals = intensities[starts].copy()
+    for k in range(1, lengths.max()):
+        active = lengths > k
+        totals[active] += intensities[starts[active] + k]
+
+    return mzs[starts], totals, ims[starts]
+
+
 def combine_experiments(exp1: ms.MSExperiment, exp2: ms.MSExperiment) -> None:
     """Merges two experiments (putting the second into the first)."""
     for i in range(exp2.getNrSpectra()):
@@ -0,0 +1,121 @@
+"""A comparison tool used to benchmark the baseline against OpenMS (e.g. OpenSWATH) output.
+"""
+
+import argparse
+import os
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+import species_store as store
+
+
+def parse_openms(openms_filename: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Reads the precursor ids, precursor m/zs and fragment annotations from an OpenMS csv file.
+
+    Keyword arguments:
+    openms_filename: the csv file to read from (with a header row; the id, m/z and fragment
+        annotation columns are the 2nd, 10th and 61st columns, respectively)
+
+    Returns: a tuple of arrays holding the ids, m/zs and fragment annotations of each precursor,
+    in that order. If an id appears multiple times, its last row is kept.
+    """
+    table = np.loadtxt(openms_filename, dtype=str, delimiter=',', skiprows=1, usecols=(1, 9, 60),
+                       comments=None, ndmin=2)
+    ids = table[:, 0]
+
+    # Keep the last occurrence of every id (in file order)
+    _, last = np.unique(ids[::-1], return_index=True)
+    keep = np.sort(len(ids) - 1 - last)
+
+    return ids[keep], table[keep, 1].astype(np.float64), table[keep, 2]
+
+
+def process_openms_frag_annos(annos: np.ndarray) -> np.ndarray:
+    """Extracts the fragment m/zs from OpenMS fragment annotations (e.g. 'y_1_300.15;b_2_251.1').
+
+    Keyword arguments:
+    annos: the fragment annotations of each precursor
+
+    Returns: the fragment m/zs of all precursors, concatenated.
+    """
+    if len(annos) == 0:
+        return np.zeros(0)
+    return np.array([x.split('_')[2] for x in ';'.join(annos).split(';')], dtype=np.float64)
+
+
+def count_within(sorted_ref: np.ndarray, queries: np.ndarray, epsilon: float) -> np.ndarray:
+    """Counts, for each query, the number of reference values strictly within epsilon of it.
+
+    Keyword arguments:
+    sorted_ref: the reference values, in ascending order
+    queries: the values to look up
+    epsilon: the (exclusive) tolerance
+
+    Returns: the number of matching reference values for each query.
+    """
+    return np.searchsorted(sorted_ref, queries + epsilon, side='left') - \
+        np.searchsorted(sorted_ref, queries - epsilon, side='right')
+
+
+def compare_baseline_to_openms(precursors: np.ndarray, fragments: np.ndarray, openms_filename: str,
+                               mz_epsilon: float) -> Dict[str, Any]:
+    """Compares the precursors and fragments found by the baseline with those identified by
+    OpenMS, by m/z.
+
+    Keyword arguments:
+    precursors: the precursors found by the baseline (a species array)
+    fragments: the fragments found by the baseline (a species array)
+    openms_filename: the OpenMS csv file to compare against
+    mz_epsilon: the (exclusive) m/z tolerance
+
+    Returns: a dictionary of overlap statistics.
+    """
+    openms_ids, openms_mzs, openms_frag_annos = parse_openms(openms_filename)
+
+    precursor_mzs = np.sort(store.summarize_species(precursors)['mz'])
+    num_matches = count_within(precursor_mzs, openms_mzs, mz_epsilon)
+
+    stats = {'openms_precursors': len(openms_ids),
+             'shared_precursors': int(np.count_nonzero(num_matches)),
+             'shared_pairs': int(num_matches.sum()),
+             'baseline_precursors': len(precursor_mzs)}
+
+    print('Number of precursors detected in both OpenMS and Baseline: ' +
+          str(stats['shared_precursors']) + ' out of ' + str(stats['openms_precursors']) + '\n\r')
+    print(stats['baseline_precursors'])
+
+    openms_frag_mzs = np.unique(process_openms_frag_annos(openms_frag_annos))
+    baseline_frag_mzs = np.unique(store.summarize_species(fragments)['mz'])
+
+    stats['openms_fragments'] = len(openms_frag_mzs)
+    stats['shared_fragments'] = int(np.count_nonzero(
+        count_within(baseline_frag_mzs, openms_frag_mzs, mz_epsilon)))
+    stats['baseline_fragments'] = len(np.unique([float('%.6g' % x) for x in baseline_frag_mzs]))
+
+    print('Number of fragments detected in both OpenMS and Baseline: ' +
+          str(stats['shared_fragments']) + ' out of ' + str(stats['openms_fragments']) + '\n\r')
+    print(stats['baseline_fragments'])
+
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Baseline/OpenMS comparison tool.')
+    parser.add_argument('-d', '--dir', action='store', required=True, type=str,
+                        help='the baseline output directory (containing precursors.npy and fragments.npy)')
+    parser.add_argument('-r', '--openms', action='store', required=True, type=str,
+                        help='the OpenMS csv file to compare against')
+    parser.add_argument('-m', '--mz_epsilon', action='store', required=False, type=float, default=0.01,
+                        help='the m/z tolerance to use')
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.openms):
+        print('Error:', args.openms, 'is not a file')
+        exit(1)
+
+    precursors = store.load_array(args.dir + '/precursors.npy')
+    fragments = store.load_array(args.dir + '/fragments.npy')
+
+    compare_baseline_to_openms(precursors, fragments, args.openms, args.mz_epsilon)
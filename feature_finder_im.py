@@ -5,16 +5,22 @@ Extends OpenMS (via pyOpenMS) feature finding capabilities to work on 4D LC-IMS-
 
 import argparse
 import csv
-from operator import itemgetter
 import os
 import psutil  # Can be removed if benchmarking is not required
 import time
-from typing import List, Optional, Tuple
+from multiprocessing import Pool
+from typing import Any, Dict, List, Optional, Tuple
 
+import numpy as np
 import pyopenms as ms
 
+import bin_io_im as bio
+import bin_schedule_im as bsched
+import bin_shards_im as shards
 import common_utils_im as util
 import peak_picker_im as ppim
+import resources_im as rsc
+import tiles_im as tiles
 
 
 class FeatureFinderIonMobility:
@@ -30,6 +36,13 @@ class FeatureFinderIonMobility:
     MIN_INTENSITY = 0.1  # For the custom peak picker
     RT_THRESHOLD = 5.0  # For feature matching
     MZ_THRESHOLD = 0.01  # For feature matching
+    MIN_SPECTRA = 7  # mass_trace:min_spectra of FeatureFinderCentroided; bins with fewer spectra are skipped
+
+    # Occupancy statistics of a bin, recorded while binning (peaks are counted before m/z slice merging)
+    BIN_STATS_DTYPE = np.dtype([('spectra', np.int64), ('peaks', np.int64), ('tic', np.float64),
+                                ('im_sum', np.float64),  # Sum of intensity * IM, for the bin's average IM
+                                ('max_run', np.int64),  # Most consecutive (binned) input spectra with peaks
+                                ('run', np.int64), ('last', np.int64)])  # The current run, and where it ends
 
     def __init__(self) -> None:
         self.reset()
@@ -40,183 +53,307 @@ class FeatureFinderIonMobility:
         self.im_start, self.im_end = 0, 0
         self.im_delta, self.im_offset = 0, 0
         self.im_scan_nums = [[], []]  # Keep the intensity-weighted average IM value for each bin
-        self.exps = [[], [ms.MSExperiment()]]  # To "cache" mzML writes
+        self.buffers = []  # To "cache" sub-bin writes
+        self.bin_stats = [np.zeros(0, dtype=self.BIN_STATS_DTYPE)] * 2  # Occupancy statistics of each bin
+        self.num_binned = 0  # The number of spectra binned so far
+        self.cache_bytes, self.max_cache_bytes = 0, 8 * 2 ** 30  # Allocated size of the cache
+        self.cache_flushes, self.cache_flushed_bytes, self.cache_peak_bytes = 0, 0, 0  # For benchmarking
+        self.bin_format = 'shard'  # The format of the intermediate bin files ('shard' or 'mzml')
+        self.compression = 'none'
+        self.mzml = ms.MzMLFile()  # For writing intermediate and debug mzML files (with compression)
+        self.io_depth = 1  # The number of bin writes and loads that may be pending in the background
+        self.writer = None  # The write-behind thread, while binning
+        self.num_workers = 1  # The number of processes that feature find bins
+        self.omp_threads = 0  # The number of OpenMP threads of each worker (0 for OpenMP's default)
+        self.autotune = False  # Determines if the workers and threads are calibrated on a sample bin
+        self.tile_rt, self.tile_mz = 0.0, 0.0  # The core size of the RT and m/z tiles of a bin (0 to not split)
+        self.tile_rt_halo, self.tile_mz_halo = 30.0, 5.0  # How far each tile extends past its core
+        self.tile_threads = 1  # The number of tiles of a bin that are feature found at once
+        self.gauss_ppm = 20.0  # The m/z width (in ppm) of the Gaussian noise filter
+        self.sgolay_frame = 7  # The number of points of the Savitzky-Golay noise filter
+        self.bin_timings = np.zeros(0, dtype=bsched.TIMING_DTYPE)  # For benchmarking
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Drops the pyOpenMS objects and the cache, so that the feature finder can be sent to
+        worker processes.
+        """
+        state = self.__dict__.copy()
+        state.update(mzml=None, writer=None, buffers=[])
+        return state
 
-    def reset_write_cache(self) -> None:
-        """Resets the disk write "cache"."""
-        for i in range(self.num_bins):
-            self.exps[0][i].clear(True)
-            self.exps[1][i].clear(True)
-        self.exps[1][self.num_bins].clear(True)
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self.mzml = util.get_mzml_file(self.compression)
 
-    def setup_bins(self, exp: ms.OnDiscMSExperiment) -> None:
+    def new_write_cache(self) -> List[shards.BinBuffer]:
+        """Creates an empty disk write "cache" (one bin buffer per sub-bin)."""
+        return [shards.BinBuffer() for _ in range(2 * self.num_bins)]
+
+    def setup_bins(self, exp: ms.OnDiscMSExperiment, indices: Optional[List[int]] = None) -> None:
         """Sets up the IM bins for feature finding.
 
         Keyword arguments:
         exp: the experiment containing spectra to bin
+        indices: the spectra that will be binned (defaults to all of them)
         """
         print('Getting IM bounds.', end=' ', flush=True)
-        self.im_start, self.im_end = util.get_im_extrema(exp)
+        self.im_start, self.im_end = util.get_im_extrema(exp, indices)
         #self.im_start, self.im_end = 0.6011273264884949, 1.5448821783065796  # For debugging 2768-800-860.mzML
 
         self.im_delta = self.im_end - self.im_start
         self.bin_size = self.im_delta / self.num_bins
         self.im_offset = self.im_start + self.bin_size / 2.0
-
-        for i in range(self.num_bins):
-            self.exps[0].append(ms.MSExperiment())
-            self.exps[1].append(ms.MSExperiment())
+        self.buffers = self.new_write_cache()
+        self.bin_stats = [np.zeros(self.num_bins, dtype=self.BIN_STATS_DTYPE),
+                          np.zeros(self.num_bins + 1, dtype=self.BIN_STATS_DTYPE)]
+        for stats in self.bin_stats:
+            stats['last'] = -2
+        self.num_binned = 0
+        self.cache_bytes = sum(buffer.nbytes for buffer in self.buffers)
 
         print('Done', flush=True)
 
-    def within_epsilon(self, target: float, var: float) -> bool:
-        """Checks if var is within the m/z epsilon of target."""
-        return target - self.MZ_EPSILON <= var <= target + self.MZ_EPSILON
+    def sub_bins(self, run: int, bin: int) -> List[int]:
+        """Returns the half-width sub-bins that make up a bin of a pass.
+
+        Sub-bin s holds the IM range [im_start + s * bin_size / 2, im_start + (s + 1) * bin_size / 2),
+        so bin i of the first pass is made of sub-bins 2i and 2i + 1, and bin i of the second pass
+        (offset by half a bin) of sub-bins 2i - 1 and 2i (only one at either end).
+        """
+        if run == 0:
+            return [2 * bin, 2 * bin + 1]
+        return [sub for sub in (2 * bin - 1, 2 * bin) if 0 <= sub < 2 * self.num_bins]
 
     def bin_spectrum(self, spec: ms.MSSpectrum) -> None:
-        """Bins a single spectrum in two passes.
+        """Bins a single spectrum for both passes.
+
+        Every peak is stored once, in the sub-bin shared by the bins of the two passes that it falls
+        into (see sub_bins). The peaks of a sub-bin are kept in ascending m/z order (ties in
+        ascending IM), and are only merged into m/z slices when a bin is assembled (see load_bin).
 
         Keyword arguments:
         spec: the spectrum to bin
         """
-        points = util.get_spectrum_points(spec)
-        points.sort(key=itemgetter(3))  # Ascending IM
+        seq, self.num_binned = self.num_binned, self.num_binned + 1
+        mzs, intensities = spec.get_peaks()
+        if len(mzs) == 0:
+            return
+        ims = np.asarray(spec.getFloatDataArrays()[0].get_data(), dtype=np.float64)
+
+        order = np.argsort(ims, kind='stable')  # Ascending IM
+        mzs, intensities, ims = mzs[order], intensities[order], ims[order]
+
+        # The bins of both passes, from which the sub-bin follows
+        bins0 = np.minimum(((ims - self.im_start) / self.bin_size).astype(np.int64), self.num_bins - 1)
+        bins1 = np.minimum(((ims - self.im_offset) / self.bin_size).astype(np.int64) + 1, self.num_bins)
+        bins1[ims < self.im_offset] = 0
+        subs = 2 * bins0 + np.clip(bins1 - bins0, 0, 1)
+
+        order = np.lexsort((mzs, subs))  # Stable, so peaks with equal m/z stay in ascending IM order
+        mzs, intensities, ims, subs = mzs[order], intensities[order], ims[order], subs[order]
+
+        rt = spec.getRT()
+        bounds = (np.flatnonzero(np.diff(subs)) + 1).tolist()
+        for start, end in zip([0] + bounds, bounds + [len(subs)]):
+            buffer = self.buffers[int(subs[start])]
+            nbytes = buffer.nbytes
+            buffer.append(rt, mzs[start:end], intensities[start:end], ims[start:end])
+            self.cache_bytes += buffer.nbytes - nbytes
+
+        self.cache_peak_bytes = max(self.cache_peak_bytes, self.cache_bytes)
+        self.update_bin_stats(seq, subs, intensities, ims)
+
+    def update_bin_stats(self, seq: int, subs: np.ndarray, intensities: np.ndarray, ims: np.ndarray) -> None:
+        """Adds a binned spectrum to the occupancy statistics of the bins of both passes.
 
-        temp_bins = [[], [[]]]  # 2D spectra
-        new_bins = [[], [[]]]  # Final 1D spectra
-
-        for i in range(self.num_bins):
+        Keyword arguments:
+        seq: the position of the spectrum among the binned spectra
+        subs: the sub-bin of each peak of the spectrum
+        intensities: the intensity of each peak
+        ims: the IM value of each peak
+        """
+        intensities = intensities.astype(np.float64)
+        for stats, bins in zip(self.bin_stats, (subs // 2, (subs + 1) // 2)):  # See sub_bins
+            peaks = np.bincount(bins, minlength=len(stats))
+            stats['peaks'] += peaks
+            stats['tic'] += np.bincount(bins, intensities, minlength=len(stats))
+            stats['im_sum'] += np.bincount(bins, intensities * ims, minlength=len(stats))
+
+            occupied = np.flatnonzero(peaks)
+            stats['spectra'][occupied] += 1
+            runs = np.where(stats['last'][occupied] == seq - 1, stats['run'][occupied] + 1, 1)
+            stats['run'][occupied], stats['last'][occupied] = runs, seq
+            stats['max_run'][occupied] = np.maximum(stats['max_run'][occupied], runs)
+
+    def productive_bin(self, run: int, bin: int, ff_type: str) -> bool:
+        """Checks if a bin can hold any features, from its occupancy statistics alone: a mass trace
+        of FeatureFinderCentroided needs peaks in MIN_SPECTRA different spectra of its bin.
+        """
+        stats = self.bin_stats[run][bin]
+        if ff_type == 'centroided':
+            return stats['spectra'] >= self.MIN_SPECTRA
+        return stats['peaks'] > 0
+
+    def write_bin_stats(self, filename: str) -> None:
+        """Writes the occupancy statistics of every bin to a csv file."""
+        with open(filename, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['pass', 'bin', 'spectra', 'peaks', 'tic', 'max_run'])
             for j in range(2):
-                temp_bins[j].append([])
-                new_bins[j].append([])
-
-        for i in range(len(points)):  # Assign points to bins
-            bin_idx = int((points[i][3] - self.im_start) / self.bin_size)
-            if bin_idx >= self.num_bins:
-                bin_idx = self.num_bins - 1
-            temp_bins[0][bin_idx].append(points[i])
-
-            bin_idx = int((points[i][3] - self.im_offset) / self.bin_size) + 1
-            if points[i][3] < self.im_offset:
-                bin_idx = 0
-            elif bin_idx > self.num_bins:
-                bin_idx = self.num_bins
-            temp_bins[1][bin_idx].append(points[i])
-
-        for i in range(self.num_bins):  # First pass
-            if len(temp_bins[0][i]) == 0:
-                continue
+                for i, stats in enumerate(self.bin_stats[j].tolist()):
+                    writer.writerow([j, i] + list(stats[:3]) + [stats[4]])
+
+    def sub_bin_files(self, sub: int, dir: str) -> List[str]:
+        """Returns the intermediate files of a given sub-bin."""
+        if self.bin_format == 'shard':
+            return shards.shard_files(shards.shard_prefix(dir, sub))
+        return [dir + '/h-' + str(sub) + '.mzML']
+
+    def remove_bins(self, dir: str) -> None:
+        """Deletes the intermediate files of every sub-bin."""
+        for sub in range(2 * self.num_bins):
+            for filename in self.sub_bin_files(sub, dir):
+                if os.path.isfile(filename):
+                    os.remove(filename)
+
+    def load_sub_bin(self, sub: int, dir: str) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Reads the spectra of a given sub-bin, as the columns of a shard (see
+        bin_shards_im.load_shard).
+        """
+        if self.bin_format == 'shard':
+            return shards.load_shard(shards.shard_prefix(dir, sub))
 
-            temp_bins[0][i].sort(key=itemgetter(1))  # Ascending m/z
-            mz_start, curr_mz = 0, temp_bins[0][i][0][1]
-            running_intensity = 0
-
-            for j in range(len(temp_bins[0][i])):
-                if self.within_epsilon(curr_mz, temp_bins[0][i][j][1]):
-                    running_intensity += temp_bins[0][i][j][2]
-                else:  # Reached a new m/z slice
-                    point = list(temp_bins[0][i][mz_start])  # Prevents aliasing
-                    point[2] = running_intensity
-                    new_bins[0][i].append(point)
-                    mz_start, curr_mz = j, temp_bins[0][i][j][1]
-                    running_intensity = temp_bins[0][i][j][2]
-
-            point = list(temp_bins[0][i][mz_start])  # Take care of the last slice
-            point[2] = running_intensity
-            new_bins[0][i].append(point)
-
-            transpose = list(zip(*new_bins[0][i]))
-            new_spec = ms.MSSpectrum()  # The final binned spectrum
-            im_fda = ms.FloatDataArray()
-            for im in transpose[3]:
-                im_fda.push_back(im)
+        exp = ms.MSExperiment()
+        filename = self.sub_bin_files(sub, dir)[0]
+        if os.path.isfile(filename):
+            ms.MzMLFile().load(filename, exp)
+        return shards.experiment_columns(exp)
 
-            new_spec.setRT(spec.getRT())
-            new_spec.set_peaks((list(transpose[1]), list(transpose[2])))
-            new_spec.setFloatDataArrays([im_fda])
-            self.exps[0][i].addSpectrum(new_spec)
+    def load_bin(self, run: int, bin: int, dir: str) -> ms.MSExperiment:
+        """Assembles a bin of a pass from its sub-bins.
 
-        for i in range(self.num_bins + 1):  # Second pass
-            if len(temp_bins[1][i]) == 0:
-                continue
+        The spectra of the sub-bins that come from the same input spectrum (i.e. have the same RT)
+        are combined, and their peaks are merged into m/z slices: starting from the lowest m/z,
+        every peak within MZ_EPSILON of the first peak of a slice is added to it, and the slice
+        becomes a single peak (with the m/z and IM of its first peak and the total intensity).
+
+        Keyword arguments:
+        run: the pass that the bin is in (0 or 1)
+        bin: the bin to assemble
+        dir: the directory to read the sub-bins from
+
+        Returns: the binned spectra of the bin, with IM values in their first float data arrays.
+        """
+        parts = [self.load_sub_bin(sub, dir) for sub in self.sub_bins(run, bin)]
+        rows = sorted((rt, k, offset, length) for k, (spectra, _) in enumerate(parts)
+                      for rt, offset, length in spectra.tolist())  # Lower sub-bins first for equal RTs
 
-            temp_bins[1][i].sort(key=itemgetter(1))
-            mz_start, curr_mz = 0, temp_bins[1][i][0][1]
-            running_intensity = 0
-
-            for j in range(len(temp_bins[1][i])):
-                if self.within_epsilon(curr_mz, temp_bins[1][i][j][1]):
-                    running_intensity += temp_bins[1][i][j][2]
-                else:
-                    point = list(temp_bins[1][i][mz_start])
-                    point[2] = running_intensity
-                    new_bins[1][i].append(point)
-                    mz_start, curr_mz = j, temp_bins[1][i][j][1]
-                    running_intensity = temp_bins[1][i][j][2]
-
-            point = list(temp_bins[1][i][mz_start])
-            point[2] = running_intensity
-            new_bins[1][i].append(point)
-
-            transpose = list(zip(*new_bins[1][i]))
-            new_spec = ms.MSSpectrum()
+        exp = ms.MSExperiment()
+        start = 0
+        while start < len(rows):
+            end = start + 1
+            while end < len(rows) and rows[end][0] == rows[start][0]:
+                end += 1
+
+            columns = {name: np.concatenate([parts[k][1][name][offset:offset + length]
+                                             for _, k, offset, length in rows[start:end]])
+                       for name in ('mz', 'int', 'im')}
+            order = np.argsort(columns['mz'], kind='stable')  # Peaks with equal m/z stay in ascending IM order
+            mzs, intensities, ims = util.merge_mz_slices(columns['mz'][order], columns['int'][order],
+                                                         columns['im'][order], self.MZ_EPSILON)
+
+            spec = ms.MSSpectrum()
+            spec.setRT(rows[start][0])
+            spec.set_peaks((mzs, intensities))
             im_fda = ms.FloatDataArray()
-            for im in transpose[3]:
-                im_fda.push_back(im)
-
-            new_spec.setRT(spec.getRT())
-            new_spec.set_peaks((list(transpose[1]), list(transpose[2])))
-            new_spec.setFloatDataArrays([im_fda])
-            self.exps[1][i].addSpectrum(new_spec)
-
-    def write_exps(self, dir: str) -> None:
-        """Writes the "cached" experiments to disk."""
-        exp = ms.MSExperiment()  # Maybe use an OnDiscExperiment?
-        for i in range(self.num_bins):
-            try:
-                ms.MzMLFile().load(dir + '/b-0-' + str(i) + '.mzML', exp)
-            except:
-                pass
-            util.combine_experiments(exp, self.exps[0][i])
-            ms.MzMLFile().store(dir + '/b-0-' + str(i) + '.mzML', exp)
-
-        for i in range(self.num_bins + 1):
-            try:
-                ms.MzMLFile().load(dir + '/b-1-' + str(i) + '.mzML', exp)
-            except:
-                pass
-            util.combine_experiments(exp, self.exps[1][i])
-            ms.MzMLFile().store(dir + '/b-1-' + str(i) + '.mzML', exp)
-
-        self.reset_write_cache()
-
-    def compute_bin_im(self, run: int, bin: int, dir: str = '.') -> float:
-        """Computes the intensity-weighted average IM value for a given bin.
+            im_fda.set_data(np.asarray(ims, dtype=np.float32))
+            spec.setFloatDataArrays([im_fda])
+            exp.addSpectrum(spec)
+
+            start = end
+
+        return exp
+
+    def write_bins(self, bins: List[Tuple[int, shards.BinBuffer]], dir: str) -> None:
+        """Appends cached binned spectra to the sub-bins on disk.
 
         Keyword arguments:
-        run: the pass that the bin is in (1 or 2)
-        bin: the bin to compute the average IM for
-        dir: the directory to write and read temporary files to
+        bins: the (sub-bin, bin buffer) of each sub-bin to append to
+        dir: the directory to write the sub-bins to
+        """
+        for sub, buffer in bins:
+            if self.bin_format == 'shard':  # Shards are appended to, so the sub-bins on disk are never re-read
+                shards.append_buffer(shards.shard_prefix(dir, sub), buffer)
+                continue
 
-        Returns: the intensity-weighted average IM value for a given bin.
+            filename = self.sub_bin_files(sub, dir)[0]
+            exp = ms.MSExperiment()  # Maybe use an OnDiscExperiment?
+            if os.path.isfile(filename):
+                ms.MzMLFile().load(filename, exp)
+            util.combine_experiments(exp, shards.columns_to_experiment(*buffer.columns()))
+            self.mzml.store(filename, exp)
+
+    def write_buffers(self, dir: str, bins: Optional[List[int]] = None) -> None:
+        """Writes "cached" bin buffers to disk (in the background if the write-behind thread is
+        running), replacing them with empty ones.
+
+        Keyword arguments:
+        dir: the directory to write the sub-bins to
+        bins: the sub-bins to write (defaults to all of them)
         """
-        exp = ms.MSExperiment()
-        ms.MzMLFile().load(dir + '/b-' + str(run) + '-' + str(bin) + '.mzML', exp)
-        total_intensity, average_im = 0, 0
+        if bins is None:
+            bins = list(range(len(self.buffers)))
+
+        tasks = []
+        for sub in bins:
+            buffer, self.buffers[sub] = self.buffers[sub], shards.BinBuffer()
+            tasks.append((sub, buffer))
+            self.cache_bytes += self.buffers[sub].nbytes - buffer.nbytes
+            self.cache_flushed_bytes += buffer.nbytes
+        self.cache_flushes += 1
+
+        if self.writer is None:
+            self.write_bins(tasks, dir)
+        else:  # Blocks if io_depth writes are already pending
+            self.writer.put(tasks, dir)
+
+    def flush_write_cache(self, dir: str) -> None:
+        """Writes the largest cached sub-bins to disk, until the cache is down to half of its
+        budget (which leaves room for the flushed sub-bins while they are written in the
+        background).
+        """
+        sizes = sorted(((buffer.nbytes, sub) for sub, buffer in enumerate(self.buffers)), reverse=True)
 
-        all_points = []
-        for i in range(exp.getNrSpectra()):
-            spec = exp.getSpectrum(i)
-            all_points.extend(util.get_spectrum_points(spec))
+        bins, remaining, empty_bytes = [], self.cache_bytes, shards.BinBuffer().nbytes
+        for size, sub in sizes:
+            if remaining <= self.max_cache_bytes / 2:
+                break
+            if self.buffers[sub].num_spectra > 0:
+                bins.append(sub)
+                remaining -= size - empty_bytes  # Flushed buffers are replaced by empty ones
 
-        for i in range(len(all_points)):
-            total_intensity += all_points[i][2]
+        self.write_buffers(dir, bins)
 
-        if total_intensity != 0:
-            for i in range(len(all_points)):
-                average_im += all_points[i][3] * (all_points[i][2] / total_intensity)
+    def compute_bin_im(self, exp: ms.MSExperiment) -> float:
+        """Computes the intensity-weighted average IM value of an (assembled) bin.
 
-        return average_im
+        Keyword arguments:
+        exp: the binned spectra of the bin (see load_bin)
+
+        Returns: the intensity-weighted average IM value of all peaks in the bin (0 if it has no
+            intensity).
+        """
+        intensities, ims = [np.zeros(0)], [np.zeros(0)]
+        for spec in exp:
+            intensities.append(spec.get_peaks()[1])
+            ims.append(spec.getFloatDataArrays()[0].get_data())
+
+        intensities = np.concatenate(intensities).astype(np.float64)
+        total_intensity = intensities.sum()
+        if total_intensity == 0:
+            return 0
+
+        return float(np.dot(np.concatenate(ims).astype(np.float64), intensities / total_intensity))
 
     def match_features_internal(self, features: ms.FeatureMap) -> ms.FeatureMap:
         """Matches features in a single bin; intended to correct satellite features.
@@ -422,7 +559,8 @@ class FeatureFinderIonMobility:
         return cleaned, clean_bins
 
     def run_ff(self, exp: ms.MSExperiment, type: str = 'centroided') -> ms.FeatureMap:
-        """Runs an existing OpenMS feature finder on an experiment.
+        """Runs an existing OpenMS feature finder on an experiment. If tiles are set, the experiment
+        is split into overlapping RT and m/z tiles that are feature found in parallel (see tiles_im).
 
         Keyword arguments:
         exp: the experiment to run the existing feature finder on
@@ -430,21 +568,37 @@ class FeatureFinderIonMobility:
 
         Returns: the features in the experiment.
         """
-        if type == 'multiplex':
-            return self.run_ffm(exp)
+        run = self.run_ffm if type == 'multiplex' else self.run_ffc
+        if self.tile_rt <= 0 and self.tile_mz <= 0:
+            return run(exp)
+
+        exp_tiles = tiles.make_tiles(exp, self.tile_rt, self.tile_mz, self.tile_rt_halo, self.tile_mz_halo)
+        if len(exp_tiles) <= 1:
+            return run(exp)
+        omp_threads = max(self.omp_threads // self.tile_threads, 1) if self.omp_threads > 0 else 0  # Per tile
+        return tiles.run_tiled(exp, run, exp_tiles, self.tile_threads, self.RT_THRESHOLD, self.MZ_THRESHOLD,
+                               omp_threads)
+
+    def run_ffc(self, exp: ms.MSExperiment) -> ms.FeatureMap:
+        """Runs FeatureFinderCentroided on an experiment.
+
+        Keyword arguments:
+        exp: the experiment to run the feature finder on
 
+        Returns: the features in the experiment.
+        """
         ff = ms.FeatureFinder()
         ff.setLogType(ms.LogType.NONE)
         features, seeds = ms.FeatureMap(), ms.FeatureMap()
 
-        params = ms.FeatureFinder().getParameters(type)  # default (Leon's) (modified)
-        params.__setitem__(b'mass_trace:min_spectra', 7)  # 10 (5) (7)
+        params = ms.FeatureFinder().getParameters('centroided')  # default (Leon's) (modified)
+        params.__setitem__(b'mass_trace:min_spectra', self.MIN_SPECTRA)  # 10 (5) (7)
         params.__setitem__(b'mass_trace:max_missing', 1)  # 1 (2) (1)
         params.__setitem__(b'seed:min_score', 0.65)  # 0.8 (0.5) (0.65)
         params.__setitem__(b'feature:min_score', 0.6)  # 0.7 (0.5) (0.6)
     
         exp.updateRanges()
-        ff.run(type, exp, features, params, seeds)
+        ff.run('centroided', exp, features, params, seeds)
 
         features.setUniqueIds()
         return features
@@ -468,95 +622,192 @@ class FeatureFinderIonMobility:
 
         return ffm.getFeatureMap()
 
-    def find_features(self, pp_type: str, peak_radius: int, window_radius: float, pp_mode: str, ff_type: str,
-                      dir: str, filter: str, debug: bool) -> List[List[ms.FeatureMap]]:
-        """Runs optional peak picking and then an existing feature finder on each IM bin.
+    def find_bin_features(self, run: int, bin: int, exp: ms.MSExperiment, pp_type: str, peak_radius: int,
+                          window_radius: float, pp_mode: str, ff_type: str, dir: str, filter: str,
+                          debug: bool) -> ms.FeatureMap:
+        """Runs optional noise filtering and peak picking, and then an existing feature finder on a
+        single (assembled) bin.
 
         Keyword arguments:
-        pp_type: the peak picker to use ('none', 'pphr', or 'custom')
-        peak_radius: for the custom peak picker, the minimum peak radius of a peak set
-        window_radius: for the custom peak picker, the maximum m/z window radius to consider
-        pp_mode: for the custom peak picker, the mode to use ('ltr' or 'int')
-        ff_type: the existing feature finder to use ('centroided' or 'multiplex')
-        dir: the directory to write the intermediate output files to
-        filter: the noise filter to use ('none', 'gauss', or 'sgolay')
-        debug: determines if intermediate output files should be written
+        run: the pass that the bin is in (0 or 1)
+        bin: the bin to feature find
+        exp: the binned spectra of the bin (see load_bin), which are filtered in place
+        (the remaining arguments are as in find_features)
 
-        Returns: a list of two lists (for the passes), each containing the features for all of
-            their bins.
+        Returns: the features found in the bin.
         """
-        features = [[], []]
-        total_features = [ms.FeatureMap(), ms.FeatureMap()]  # Only used for debug output
+        new_exp = ms.MSExperiment()
+        prefix = dir + '/pass' + str(run) + '-bin' + str(bin)
 
+        # Optional noise filtering
         if filter == 'gauss':
             filter_g = ms.GaussFilter()
             params_g = filter_g.getDefaults()
-            params_g.setValue(b'ppm_tolerance', 20.0)
+            params_g.setValue(b'ppm_tolerance', float(self.gauss_ppm))
             params_g.setValue(b'use_ppm_tolerance', b'true')
             filter_g.setParameters(params_g)
-        
-        if filter == 'sgolay':
+            filter_g.filterExperiment(exp)
+        elif filter == 'sgolay':
             filter_s = ms.SavitzkyGolayFilter()
             params_s = filter_s.getDefaults()
-            params_s.setValue(b'frame_length', 7)
+            params_s.setValue(b'frame_length', self.sgolay_frame)
             params_s.setValue(b'polynomial_order', 3)
             filter_s.setParameters(params_s)
+            filter_s.filterExperiment(exp)
 
-        pick_hr = ms.PeakPickerHiRes()
-        pick_im = ppim.PeakPickerIonMobility()
+        if filter != 'none' and debug:
+            self.mzml.store(prefix + '-filtered.mzML', exp)
 
-        nb = [self.num_bins, 0 if self.num_bins == 1 else self.num_bins + 1]  # Size of each pass
+        # Optional peak picking
+        if pp_type == 'pphr':
+            ms.PeakPickerHiRes().pickExperiment(exp, new_exp)
+        elif pp_type == 'custom':
+            new_exp = ppim.PeakPickerIonMobility().pick_experiment(exp, peak_radius, window_radius, pp_mode,
+                                                                   self.MIN_INTENSITY, strict=True)
+        else:
+            new_exp = exp
 
-        for j in range(2):  # Pass index
-            for i in range(nb[j]):  # Bin index
-                exp, new_exp = ms.MSExperiment(), ms.MSExperiment()
-                ms.MzMLFile().load(dir + '/b-' + str(j) + '-' + str(i) + '.mzML', exp)
+        if pp_type != 'none' and debug:
+            self.mzml.store(prefix + '-picked.mzML', new_exp)
 
-                # Optional noise filtering
-                if filter == 'gauss':
-                    filter_g.filterExperiment(exp)
-                elif filter == 'sgolay':
-                    filter_s.filterExperiment(exp)
+        # Feature finding
+        features = ms.FeatureMap()
+        if util.has_peaks(new_exp):
+            features = self.run_ff(new_exp, ff_type)
 
-                if filter != 'none' and debug:
-                    ms.MzMLFile().store(dir + '/pass' + str(j) + '-bin' + str(i) + '-filtered.mzML', exp)
+        features = self.match_features_internal(features)
+        features.setUniqueIds()
 
-                # Optional peak picking
-                if pp_type == 'pphr':
-                    pick_hr.pickExperiment(exp, new_exp)
-                elif pp_type == 'custom':
-                    new_exp = pick_im.pick_experiment(exp, peak_radius, window_radius, pp_mode, self.MIN_INTENSITY,
-                                                      strict=True)
-                else:
-                    new_exp = exp
+        if debug:
+            ms.FeatureXMLFile().store(prefix + '.featureXML', features)
 
-                if pp_type != 'none' and debug:
-                    ms.MzMLFile().store(dir + '/pass' + str(j) + '-bin' + str(i) + '-picked.mzML', new_exp)
+        return features
 
-                # Feature finding
-                temp_features = ms.FeatureMap()
-                if util.has_peaks(new_exp):
-                    temp_features = self.run_ff(new_exp, ff_type)
+    def find_features(self, pp_type: str, peak_radius: int, window_radius: float, pp_mode: str, ff_type: str,
+                      dir: str, filter: str, debug: bool) -> List[List[ms.FeatureMap]]:
+        """Runs optional peak picking and then an existing feature finder on each IM bin.
 
-                temp_features = self.match_features_internal(temp_features)
-                temp_features.setUniqueIds()
+        With more than one worker, bins are feature found by a pool of worker processes, largest
+        (by estimated cost; see bin_schedule_im) first. The time taken by each bin is appended to
+        bin-timings.csv, which later runs in the same directory learn their cost estimates from.
 
-                if debug:
-                    ms.FeatureXMLFile().store(dir + '/pass' + str(j) + '-bin' + str(i) + '.featureXML', temp_features)
+        Keyword arguments:
+        pp_type: the peak picker to use ('none', 'pphr', or 'custom')
+        peak_radius: for the custom peak picker, the minimum peak radius of a peak set
+        window_radius: for the custom peak picker, the maximum m/z window radius to consider
+        pp_mode: for the custom peak picker, the mode to use ('ltr' or 'int')
+        ff_type: the existing feature finder to use ('centroided' or 'multiplex')
+        dir: the directory to write the intermediate output files to
+        filter: the noise filter to use ('none', 'gauss', or 'sgolay')
+        debug: determines if intermediate output files should be written
 
-                features[j].append(temp_features)
-                total_features[j] += temp_features
+        Returns: a list of two lists (for the passes), each containing the features for all of
+            their bins.
+        """
+        nb = [self.num_bins, 0 if self.num_bins == 1 else self.num_bins + 1]  # Size of each pass
+        features = [[ms.FeatureMap() for _ in range(nb[j])] for j in range(2)]
+        settings = {'pp_type': pp_type, 'peak_radius': peak_radius, 'window_radius': window_radius,
+                    'pp_mode': pp_mode, 'ff_type': ff_type, 'dir': dir, 'filter': filter, 'debug': debug}
+
+        # Bins that cannot hold any features are never loaded (see productive_bin)
+        bins = [(j, i) for j in range(2) for i in range(nb[j]) if self.productive_bin(j, i, ff_type)]
+        for j in range(2):
+            for i in range(nb[j]):
+                if not self.productive_bin(j, i, ff_type):
+                    stats = self.bin_stats[j][i]
+                    self.im_scan_nums[j][i] = float(stats['im_sum'] / stats['tic']) if stats['tic'] > 0 else 0
+                    if debug:
+                        ms.FeatureXMLFile().store(dir + '/pass' + str(j) + '-bin' + str(i) + '.featureXML',
+                                                  features[j][i])
+
+        records = []  # The pass, bin, load time and feature finding time of each bin
+        timings_file = dir + '/bin-timings.csv'
+
+        if self.autotune and bins:
+            # Calibrated on the bin with the median number of peaks. It is loaded once, outside of the
+            # timed runs, and keeps the features of its last run (the thread count does not change them)
+            j, i = sorted(bins, key=lambda bin: self.bin_stats[bin[0]][bin[1]]['peaks'])[len(bins) // 2]
+            exp = self.load_bin(j, i, dir)
+            self.im_scan_nums[j][i] = self.compute_bin_im(exp)
+            calibrated = []
+
+            def calibration_task(threads: int, sample: ms.MSExperiment) -> None:
+                self.omp_threads = threads
+                features[j][i] = self.find_bin_features(j, i, sample, **dict(settings, debug=False))
+                calibrated.append(threads)
+
+            # Noise filters work in place, so each run gets its own copy of the bin
+            prepare = (lambda: ms.MSExperiment(exp)) if filter != 'none' else (lambda: exp)
+            self.num_workers, self.omp_threads = rsc.calibrate(calibration_task, rsc.available_cores(),
+                                                               prepare=prepare)
+            exp = None
+            if calibrated:  # Its timings were taken with other thread counts, so they are not recorded
+                bins.remove((j, i))
+                if debug:
+                    ms.FeatureXMLFile().store(dir + '/pass' + str(j) + '-bin' + str(i) + '.featureXML',
+                                              features[j][i])
+        rsc.limit_threads(self.omp_threads)
+
+        # Timings are only comparable between runs with the same settings
+        run_settings = {'num_workers': self.num_workers, 'omp_threads': self.omp_threads, 'tile_rt': self.tile_rt,
+                        'tile_mz': self.tile_mz, 'tile_threads': self.tile_threads, 'pp_type': pp_type,
+                        'filter': filter, 'gauss_ppm': self.gauss_ppm, 'sgolay_frame': self.sgolay_frame,
+                        'ff_type': ff_type}
+
+        if self.num_workers > 1:
+            model = bsched.CostModel()
+            model.fit(bsched.select_timings(bsched.load_timings(timings_file), run_settings))
+            stats = np.array([self.bin_stats[j][i] for j, i in bins], dtype=self.BIN_STATS_DTYPE)
+            tasks = bsched.largest_first(bins, model.predict(stats['spectra'], stats['peaks']))
+
+            # Workers take the next task as soon as they finish one, so tasks are handed out one at a time
+            with Pool(self.num_workers, initializer=init_bin_worker, initargs=(self, settings)) as pool:
+                for j, i, im, load_t, find_t in pool.imap_unordered(find_bin_task, tasks, chunksize=1):
+                    filename = dir + '/pass' + str(j) + '-bin' + str(i) + '.featureXML'
+                    ms.FeatureXMLFile().load(filename, features[j][i])
+                    if not debug:
+                        os.remove(filename)
+                    self.im_scan_nums[j][i] = im
+                    records.append((j, i, load_t, find_t))
+        else:
+            # The next bins are loaded in the background while the current one is processed, so the
+            # load time of a bin is only the time spent waiting for it
+            start_t = time.time()
+            for (j, i), exp in bio.prefetch(lambda bin: self.load_bin(*bin, dir), bins, self.io_depth):
+                load_t = time.time() - start_t
+                self.im_scan_nums[j][i] = self.compute_bin_im(exp)
+                features[j][i] = self.find_bin_features(j, i, exp, **settings)
+                exp = None
+                records.append((j, i, load_t, time.time() - start_t - load_t))
+                start_t = time.time()
+
+        timings = np.zeros(len(records), dtype=bsched.TIMING_DTYPE)
+        for timing, (j, i, load_t, find_t) in zip(timings, records):
+            stats = self.bin_stats[j][i]
+            timing['pass'], timing['bin'], timing['spectra'], timing['peaks'] = j, i, stats['spectra'], stats['peaks']
+            timing['load_s'], timing['find_s'] = load_t, find_t
+            for name, value in run_settings.items():
+                timing[name] = value
+        bsched.append_timings(timings_file, timings)
+        self.bin_timings = timings
 
         if debug:
             for j in range(2):
-                total_features[j].setUniqueIds()
-                ms.FeatureXMLFile().store(dir + '/pass' + str(j) + '.featureXML', total_features[j])
+                total_features = ms.FeatureMap()
+                for bin_features in features[j]:
+                    total_features += bin_features
+                total_features.setUniqueIds()
+                ms.FeatureXMLFile().store(dir + '/pass' + str(j) + '.featureXML', total_features)
 
         return features[0], features[1]
 
     def run(self, exp: ms.OnDiscMSExperiment, num_bins: int = 50, pp_type: str = 'pphr', peak_radius: int = 1,
             window_radius: float = 0.015, pp_mode: str = 'int', ff_type: str = 'centroided', dir: str = '.',
-            filter: str = 'none', debug: bool = False, bench: bool = False) -> ms.FeatureMap:
+            filter: str = 'none', debug: bool = False, bench: bool = False, ms_level: int = 1,
+            bin_format: str = 'shard', compression: str = 'none', io_depth: int = 1,
+            max_cache_gib: float = 8.0, num_workers: int = 1, tile_rt: float = 0.0, tile_mz: float = 0.0,
+            tile_rt_halo: float = 30.0, tile_mz_halo: float = 5.0, tile_threads: int = 1, omp_threads: int = 0,
+            autotune: bool = False, gauss_ppm: float = 20.0, sgolay_frame: int = 7) -> ms.FeatureMap:
         """Runs the feature finder on an experiment.
 
         Keyword arguments:
@@ -571,6 +822,29 @@ class FeatureFinderIonMobility:
         filter: the noise filter to use ('none', 'gauss', or 'sgolay')
         debug: determines if intermediate output files should be written
         bench: determines if the program should be benchmarked
+        ms_level: the MS level of the spectra to bin (1, or 2 for the MS2 track)
+        bin_format: the format of the intermediate bin files ('shard' or 'mzml'; see bin_shards_im)
+        compression: the compression of intermediate and debug mzML files (see
+            common_utils_im.mzml_compression)
+        io_depth: the number of bin writes (while binning) and bin loads (while feature finding)
+            that may be pending on background I/O threads (0 does all I/O in the foreground)
+        max_cache_gib: the memory budget (in GiB) of binned spectra cached before being written to
+            disk; the largest bins are written out whenever it is exceeded
+        num_workers: the number of processes that feature find bins (largest bins first; 0 to fit as
+            many as omp_threads allow)
+        tile_rt: the RT size (in seconds) of the tiles that each bin is split into for feature
+            finding (0 to not split by RT)
+        tile_mz: the m/z size of the tiles (0 to not split by m/z)
+        tile_rt_halo: the RT distance by which each tile overlaps its neighbours
+        tile_mz_halo: the m/z distance by which each tile overlaps its neighbours
+        tile_threads: the number of tiles of a bin that are feature found at once
+        omp_threads: the number of OpenMP threads of each worker, shared by its tile threads (0 to
+            share the cores between the workers; see resources_im)
+        autotune: determines if the number of workers and threads is instead picked by timing a
+            sample bin with each thread count
+        gauss_ppm: for the Gaussian filter, its m/z width (in ppm)
+        sgolay_frame: for the Savitzky-Golay filter, the number of points it fits (odd, and more
+            than its polynomial order of 3)
 
         Returns: the features found by the feature finder.
         """
@@ -583,9 +857,22 @@ class FeatureFinderIonMobility:
 
         self.reset()
         self.num_bins = num_bins
+        self.bin_format = bin_format
+        self.compression = compression
+        self.mzml = util.get_mzml_file(compression)
+        self.io_depth = io_depth
+        self.num_workers, self.omp_threads = rsc.split_cores(rsc.available_cores(), num_workers, omp_threads)
+        self.autotune = autotune
+        self.tile_rt, self.tile_mz = tile_rt, tile_mz
+        self.tile_rt_halo, self.tile_mz_halo = tile_rt_halo, tile_mz_halo
+        self.tile_threads = tile_threads
+        self.gauss_ppm, self.sgolay_frame = gauss_ppm, sgolay_frame
+        self.max_cache_bytes = max_cache_gib * 2 ** 30
 
         if bench: start_t = time.time()
-        self.setup_bins(exp)
+        # Spectra of other MS levels are skipped using only the metadata, without decoding their peaks
+        indices = util.get_spectrum_indices(exp, ms_level)
+        self.setup_bins(exp, indices)
 
         if bench:
             total_t = time.time() - start_t
@@ -595,46 +882,46 @@ class FeatureFinderIonMobility:
 
         print('Starting binning.', flush=True)
         if bench: start_t = time.time()
-        for i in range(exp.getNrSpectra()):
-            spec = exp.getSpectrum(i)
-            if spec.getMSLevel() != 1:  # Currently only works on MS1 scans
-                continue
-            print('Binning RT', spec.getRT(), flush=True)
-            self.bin_spectrum(spec)
-            if i % 500 == 0:  # Requires slightly less than 16 GiB of RAM on a full-length run
-                self.write_exps(dir)
-        self.write_exps(dir)
-
-        print('Getting bin average IM values.', end=' ', flush=True)
-        for i in range(self.num_bins):
-            self.im_scan_nums[0].append(self.compute_bin_im(0, i, dir))
-            self.im_scan_nums[1].append(self.compute_bin_im(1, i, dir))
-        self.im_scan_nums[1].append(self.compute_bin_im(1, self.num_bins, dir))
-
-        with open(dir + '/bins-im.txt', 'w') as file:
-            for i in range(self.num_bins):
-                file.write(str(self.im_scan_nums[0][i]) + '\n')
-            for i in range(self.num_bins + 1):
-                file.write(str(self.im_scan_nums[1][i]) + '\n')
-        #with open(dir + '/bins-im.txt', 'r') as file:  # To speed up debugging
-        #    for i in range(self.num_bins):
-        #        x = float(file.readline().strip())
-        #        self.im_scan_nums[0].append(x)
-        #    for i in range(self.num_bins + 1):
-        #        x = float(file.readline().strip())
-        #        self.im_scan_nums[1].append(x)
-        print('Done')
+        self.remove_bins(dir)  # Bins are appended to, so leftovers from a previous run must go
+        if self.io_depth > 0:  # Cached bins are written in the background while binning continues
+            self.writer = bio.WriteBehind(self.write_bins, self.io_depth)
+        try:
+            for spec_idx in indices:
+                spec = exp.getSpectrum(spec_idx)
+                print('Binning RT', spec.getRT(), flush=True)
+                self.bin_spectrum(spec)
+                if self.cache_bytes > self.max_cache_bytes:
+                    self.flush_write_cache(dir)
+            self.write_buffers(dir)
+        finally:
+            if self.writer is not None:  # Waits for the pending writes
+                writer, self.writer = self.writer, None
+                writer.close()
 
         if bench:
             total_t = time.time() - start_t
             time_out.write(f'binning: {total_t}s\n')
             mem_use = pymem.memory_info()[0] / 2.0 ** 30
             time_out.write(f'binning: {mem_use} GiB\n')
+            time_out.write(f'write cache: {self.cache_flushes} flushes, '
+                           f'{self.cache_flushed_bytes / 2.0 ** 30} GiB flushed, '
+                           f'{self.cache_peak_bytes / 2.0 ** 30} GiB max allocated\n')
+        self.write_bin_stats(dir + '/bins-stats.csv')
 
         print('Starting feature finding.', flush=True)
         if bench: start_t = time.time()
+        # The intensity-weighted average IM value of each bin is computed when the bin is assembled
+        self.im_scan_nums = [[0.0] * self.num_bins, [0.0] * (self.num_bins + 1)]
         features1, features2 = self.find_features(pp_type, peak_radius, window_radius, pp_mode, ff_type, dir, filter,
                                                   debug)
+        if self.num_bins == 1:  # The second pass is not feature found, but its bin IMs are still reported
+            self.im_scan_nums[1] = [self.compute_bin_im(self.load_bin(1, i, dir)) for i in range(2)]
+
+        with open(dir + '/bins-im.txt', 'w') as file:
+            for i in range(self.num_bins):
+                file.write(str(self.im_scan_nums[0][i]) + '\n')
+            for i in range(self.num_bins + 1):
+                file.write(str(self.im_scan_nums[1][i]) + '\n')
         #features1, features2 = [], []  # To speed up debugging
         #for i in range(self.num_bins):
         #    x = ms.FeatureMap()
@@ -651,6 +938,10 @@ class FeatureFinderIonMobility:
             time_out.write(f'feature finding: {total_t}s\n')
             mem_use = pymem.memory_info()[0] / 2.0 ** 30
             time_out.write(f'feature finding: {mem_use} GiB\n')
+            time_out.write(f'feature finding tasks: {len(self.bin_timings)} bins, {self.num_workers} workers '
+                           f'({self.omp_threads} OpenMP threads each), '
+                           f'{self.bin_timings["load_s"].sum()}s loading, {self.bin_timings["find_s"].sum()}s '
+                           f'finding\n')
 
         if self.num_bins == 1:  # Matching between passes for one bin results in no features
             features1[0].setUniqueIds()
@@ -680,14 +971,46 @@ class FeatureFinderIonMobility:
             time_out.close()
 
         if not debug:  # Clean up the temporary files
-            for j in range(2):
-                for i in range(self.num_bins):
-                    os.remove(dir + '/b-' + str(j) + '-' + str(i) + '.mzML')
-            os.remove(dir + '/b-1-' + str(self.num_bins) + '.mzML')
+            self.remove_bins(dir)
 
         return all_features
 
 
+bin_worker = None  # The feature finder and find_bin_features settings of a worker process
+
+
+def init_bin_worker(finder: FeatureFinderIonMobility, settings: Dict[str, Any]) -> None:
+    """Initializes a worker process of FeatureFinderIonMobility.find_features."""
+    global bin_worker
+    bin_worker = (finder, settings)
+    rsc.limit_threads(finder.omp_threads)
+
+
+def find_bin_task(bin: Tuple[int, int]) -> Tuple[int, int, float, float, float]:
+    """Loads and feature finds a bin in a worker process. FeatureMaps cannot be sent between
+    processes, so the features are stored in the bin's featureXML file for the main process.
+
+    Keyword arguments:
+    bin: the pass and bin to feature find
+
+    Returns: the pass and bin, the intensity-weighted average IM of the bin, and the time taken
+        to load and to feature find it.
+    """
+    finder, settings = bin_worker
+    run, i = bin
+    dir = settings['dir']
+
+    start_t = time.time()
+    exp = finder.load_bin(run, i, dir)
+    load_t = time.time() - start_t
+    im = finder.compute_bin_im(exp)
+    features = finder.find_bin_features(run, i, exp, **settings)
+    if not settings['debug']:  # Otherwise it is already stored
+        ms.FeatureXMLFile().store(dir + '/pass' + str(run) + '-bin' + str(i) + '.featureXML', features)
+
+    return run, i, im, load_t, time.time() - start_t - load_t
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='LC-IMS-MS/MS Feature Finder.')
 
@@ -713,6 +1036,46 @@ if __name__ == "__main__":
                         choices=['centroided', 'multiplex'], help='the existing feature finder to use')
     parser.add_argument('-e', '--filter', action='store', required=False, type=str, default='none',
                         choices=['none', 'gauss', 'sgolay'], help='the noise filter to use')
+    parser.add_argument('--gauss_ppm', action='store', required=False, type=float, default=20.0,
+                        help='the m/z width (in ppm) of the Gaussian filter')
+    parser.add_argument('--sgolay_frame', action='store', required=False, type=int, default=7,
+                        help='the number of points of the Savitzky-Golay filter (odd, and more than 3)')
+
+    parser.add_argument('-l', '--ms_level', action='store', required=False, type=int, default=1, choices=[1, 2],
+                        help='the MS level of the spectra to bin (2 runs the MS2 track)')
+
+    parser.add_argument('-b', '--bin_format', action='store', required=False, type=str, default='shard',
+                        choices=['shard', 'mzml'], help='the format of the intermediate bin files')
+
+    parser.add_argument('-c', '--compression', action='store', required=False, type=util.mzml_compression,
+                        default='none', help="the compression of intermediate and debug mzML files ('none', or a "
+                                             "comma-separated combination of zlib, linear, and pic or slof)")
+
+    parser.add_argument('--io_depth', action='store', required=False, type=int, default=1,
+                        help='the number of bin writes and loads that may be pending in the background (0 '
+                             'disables background I/O)')
+
+    parser.add_argument('--max_cache_gib', action='store', required=False, type=float, default=8.0,
+                        help='the memory budget (in GiB) of binned spectra waiting to be written to disk')
+
+    parser.add_argument('--num_workers', action='store', required=False, type=int, default=1,
+                        help='the number of processes that feature find bins (0 to fit as many as --omp_threads '
+                             'allow)')
+    parser.add_argument('--omp_threads', action='store', required=False, type=int, default=0,
+                        help='the number of OpenMP threads of each worker (0 to share the cores between the workers)')
+    parser.add_argument('--autotune', action='store_true', required=False, default=False,
+                        help='pick the number of workers and threads by timing a sample bin')
+
+    parser.add_argument('--tile_rt', action='store', required=False, type=float, default=0.0,
+                        help='split each bin into RT tiles of this size (in seconds) for feature finding')
+    parser.add_argument('--tile_mz', action='store', required=False, type=float, default=0.0,
+                        help='split each bin into m/z tiles of this size for feature finding')
+    parser.add_argument('--tile_rt_halo', action='store', required=False, type=float, default=30.0,
+                        help='the RT overlap (in seconds) between neighbouring tiles')
+    parser.add_argument('--tile_mz_halo', action='store', required=False, type=float, default=5.0,
+                        help='the m/z overlap between neighbouring tiles')
+    parser.add_argument('--tile_threads', action='store', required=False, type=int, default=1,
+                        help='the number of tiles of a bin to feature find at once')
 
     parser.add_argument('--debug', action='store_true', required=False, default=False,
                         help='write intermediate mzML and featureXML files')
@@ -749,7 +1112,10 @@ if __name__ == "__main__":
 
     ff = FeatureFinderIonMobility()
     features = ff.run(exp, args.num_bins, args.pp_type, args.peak_radius, args.window_radius, args.pp_mode,
-                      args.ff_type, args.dir, args.filter, args.debug, args.bench)
+                      args.ff_type, args.dir, args.filter, args.debug, args.bench, args.ms_level,
+                      args.bin_format, args.compression, args.io_depth, args.max_cache_gib, args.num_workers,
+                      args.tile_rt, args.tile_mz, args.tile_rt_halo, args.tile_mz_halo, args.tile_threads,
+                      args.omp_threads, args.autotune, args.gauss_ppm, args.sgolay_frame)
 
     ms.FeatureXMLFile().store(args.dir + '/' + args.out, features)
     print('Found', features.size(), 'features')
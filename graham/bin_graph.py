@@ -9,11 +9,12 @@ print('Done', flush=True)
 
 results = []  # List of lists (number of bins, number of features)
 ff = ffim.FeatureFinderIonMobility()
+RESOURCES = {'num_workers': 0, 'omp_threads': 1}  # A single-threaded bin worker per core (see resources_im)
 
-features = ff.run(exp, 1, 'pphr', 0, 0, 0, 'centroided', 'runs', 'none', False)
+features = ff.run(exp, 1, 'pphr', 0, 0, 0, 'centroided', 'runs', 'none', False, **RESOURCES)
 results.append([1, features.size()])
 for i in range(5, 76, 5):
-    features = ff.run(exp, i, 'pphr', 0, 0, 0, 'centroided', 'runs', 'none', False)
+    features = ff.run(exp, i, 'pphr', 0, 0, 0, 'centroided', 'runs', 'none', False, **RESOURCES)
     results.append([i, features.size()])
 
 with open('runs/bin_counts_pphr.csv', 'w', newline='') as file:
@@ -23,10 +24,10 @@ with open('runs/bin_counts_pphr.csv', 'w', newline='') as file:
 
 results = []
 
-features = ff.run(exp, 1, 'custom', 1, 0.015, 'int', 'centroided', 'runs', 'none', False)
+features = ff.run(exp, 1, 'custom', 1, 0.015, 'int', 'centroided', 'runs', 'none', False, **RESOURCES)
 results.append([1, features.size()])
 for i in range(5, 76, 5):
-    features = ff.run(exp, i, 'custom', 1, 0.015, 'int', 'centroided', 'runs', 'none', False)
+    features = ff.run(exp, i, 'custom', 1, 0.015, 'int', 'centroided', 'runs', 'none', False, **RESOURCES)
     results.append([i, features.size()])
 
 with open('runs/bin_counts_custom.csv', 'w', newline='') as file:
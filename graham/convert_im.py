@@ -1,27 +1,123 @@
+"""Converts the scan numbers in MaxQuant exports (e.g. allPeptides.txt or evidence.txt projected to
+csv files) to ion mobility (1/K0) values, using the calibration of the raw (.d) file they came from.
+
+The scan number -> 1/K0 table of each raw file is cached in a small .npy file, so reruns do not
+touch the Bruker library or the raw file's SQLite database.
+"""
+
+import argparse
 import csv
-import pyopenms as ms
+import itertools
+import os
+from typing import Callable, Optional
+
 import numpy as np
-import diapysef.timsdata as tims
 
-td = tims.TimsData('raw-files/20180819_TIMS2_12-2_AnBr_SA_200ng_HeLa_50cm_120min_100ms_11CT_2_A1_01_2768.d')
-conn = td.conn
+# Maps a raw (.d) directory to its 1/K0 value for every scan number
+Calibration = Callable[[str], np.ndarray]
+
+
+def timsdata_calibration(raw_dir: str) -> np.ndarray:
+    """Builds the scan number -> 1/K0 table of a raw file with the Bruker timsdata library.
+
+    Keyword arguments:
+    raw_dir: the raw (.d) directory
+
+    Returns: the 1/K0 value of each scan number (calibrated on the first frame).
+    """
+    import diapysef.timsdata as tims  # Only needed when a table is not cached yet
+
+    td = tims.TimsData(raw_dir)
+    num_scans = td.conn.execute('SELECT COUNT(*) FROM Frames').fetchone()[0]
+
+    return np.asarray(td.scanNumToOneOverK0(1, np.arange(num_scans, dtype=np.float64)), dtype=np.float64)
+
+
+def table_filename(raw_dir: str) -> str:
+    """Returns the cache file of a raw file's 1/K0 table (next to the raw directory)."""
+    return os.path.normpath(raw_dir) + '.ook0.npy'
+
+
+def load_ook0_table(raw_dir: str, calibration: Calibration = timsdata_calibration, cache: Optional[str] = None,
+                    rebuild: bool = False) -> np.ndarray:
+    """Loads the scan number -> 1/K0 table of a raw file, building and caching it if needed.
+
+    Keyword arguments:
+    raw_dir: the raw (.d) directory
+    calibration: the function used to build a missing table
+    cache: the .npy file to cache the table in (defaults to table_filename(raw_dir))
+    rebuild: if True, the table is rebuilt even if it is cached
+
+    Returns: the (memory-mapped) 1/K0 value of each scan number.
+    """
+    if cache is None:
+        cache = table_filename(raw_dir)
+
+    if rebuild or not os.path.isfile(cache):
+        np.save(cache, np.asarray(calibration(raw_dir), dtype=np.float64), allow_pickle=False)
+
+    return np.load(cache, mmap_mode='r', allow_pickle=False)
+
+
+def convert_csv(in_filename: str, out_filename: str, ook0_table: np.ndarray, column: int = 2,
+                chunk_size: int = 100000, header: bool = False) -> int:
+    """Replaces the scan numbers in a column of a csv file with their 1/K0 values, a chunk of rows
+    at a time.
+
+    Keyword arguments:
+    in_filename: the csv file to read from
+    out_filename: the csv file to write to
+    ook0_table: the 1/K0 value of each scan number
+    column: the (0-based) index of the scan number column
+    chunk_size: the number of rows to convert at once
+    header: if True, the first row is copied over unchanged
+
+    Returns: the number of converted rows.
+    """
+    num_rows = 0
+
+    with open(in_filename, 'r', newline='') as infile, open(out_filename, 'w', newline='') as outfile:
+        reader, writer = csv.reader(infile), csv.writer(outfile)
+        if header:
+            writer.writerow(next(reader))
+
+        while True:
+            chunk = list(itertools.islice(reader, chunk_size))
+            if not chunk:
+                break
+
+            scans = np.array([row[column] for row in chunk], dtype=np.int64)
+            for row, ook0 in zip(chunk, ook0_table[scans].tolist()):
+                row[column] = ook0
+
+            writer.writerows(chunk)
+            num_rows += len(chunk)
 
-q = conn.execute('SELECT COUNT(*) FROM Frames')
-row = q.fetchone()
-N = row[0]
+    return num_rows
 
-scan_number_axis = np.arange(N, dtype=np.float64)
-ook0_axis = td.scanNumToOneOverK0(1, scan_number_axis)
 
-lines = []
-with open('csv-files/allPeptides-projected.csv', 'r') as file:
-    reader = csv.reader(file)
-    for line in reader:
-        lines.append(line)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scan number to ion mobility (1/K0) converter for MaxQuant '
+                                                 'exports.')
+    parser.add_argument('-r', '--raw', action='store', required=True, type=str,
+                        help='the raw (.d) directory the export was made from')
+    parser.add_argument('-i', '--in', action='store', required=True, type=str, dest='in_',
+                        help='the csv file to convert')
+    parser.add_argument('-o', '--out', action='store', required=True, type=str,
+                        help='the csv file to write to')
+    parser.add_argument('-c', '--column', action='store', required=False, type=int, default=2,
+                        help='the (0-based) index of the scan number column')
+    parser.add_argument('-s', '--chunk_size', action='store', required=False, type=int, default=100000,
+                        help='the number of rows to convert at once')
+    parser.add_argument('--header', action='store_true', required=False, default=False,
+                        help='copy the first row over unchanged')
+    parser.add_argument('--cache', action='store', required=False, type=str,
+                        help='the .npy file to cache the 1/K0 table in (defaults to <raw>.ook0.npy)')
+    parser.add_argument('--rebuild', action='store_true', required=False, default=False,
+                        help='rebuild the cached 1/K0 table')
 
-for i in range(len(lines)):
-    lines[i][2] = ook0_axis[int(lines[i][2])]
+    args = parser.parse_args()
 
-with open('csv-files/allPeptides-projected-im.csv', 'w', newline='') as file:
-    writer = csv.writer(file)
-    writer.writerows(lines)
+    table = load_ook0_table(args.raw, cache=args.cache, rebuild=args.rebuild)
+    num_rows = convert_csv(args.in_, args.out, table, args.column, args.chunk_size, args.header)
+    print('Converted', num_rows, 'rows')
@@ -9,9 +9,10 @@ print('Done', flush=True)
 
 results = []  # List of lists (ppm, number of features)
 ff = ffim.FeatureFinderIonMobility()
+RESOURCES = {'num_workers': 0, 'omp_threads': 1}  # A single-threaded bin worker per core (see resources_im)
 
 for i in range(2, 30, 2):
-    features = ff.run(exp, 10, 'pphr', 0, 0, 0, 'centroided', 'runs', 'gauss', False, i)
+    features = ff.run(exp, 10, 'pphr', 0, 0, 0, 'centroided', 'runs', 'gauss', False, gauss_ppm=i, **RESOURCES)
     results.append([i, features.size()])
     
 with open('runs/gauss_ppm_pphr.csv', 'w', newline='') as file:
@@ -21,8 +22,8 @@ with open('runs/gauss_ppm_pphr.csv', 'w', newline='') as file:
 
 results = []
 
-for i in range(3, 15, 1):
-    features = ff.run(exp, 10, 'pphr', 0, 0, 0, 'centroided', 'runs', 'sgolay', False, 0, i)
+for i in range(5, 15, 2):  # The number of points must be odd and more than the polynomial order (3)
+    features = ff.run(exp, 10, 'pphr', 0, 0, 0, 'centroided', 'runs', 'sgolay', False, sgolay_frame=i, **RESOURCES)
     results.append([i, features.size()])
     
 with open('runs/sgolay_pts_pphr.csv', 'w', newline='') as file:
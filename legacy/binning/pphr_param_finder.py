@@ -1,9 +1,57 @@
+# Run with the repository root on PYTHONPATH
 import argparse
+import itertools
+from multiprocessing import Pool
 
 import pyopenms as ms
 import numpy as np
 
-from im_binning import run_ff
+import feature_finder_im as ffim
+import resources_im as rsc
+
+# The input experiment (inherited by the forked worker processes)
+exp = None
+
+def init_worker(omp_threads):
+    rsc.limit_threads(omp_threads)
+
+def try_params(param_set):
+    """Runs PeakPickerHiRes with a set of parameters and FeatureFinderCentroided on the result, and
+    returns the parameter set with the number of features found."""
+    stn, wl, bc, mre = param_set
+    params = ms.PeakPickerHiRes().getParameters()
+
+    params.__setitem__(b'ms_levels', ms_levels)
+
+    params.__setitem__(b'spacing_difference_gap', spacing_difference_gap)
+    params.__setitem__(b'spacing_difference', spacing_difference)
+    params.__setitem__(b'missing', missing)
+
+    params.__setitem__(b'signal_to_noise', stn)
+    params.__setitem__(b'SignalToNoise:win_len', wl)
+    params.__setitem__(b'SignalToNoise:bin_count', bc)
+    params.__setitem__(b'SignalToNoise:min_required_elements', mre)
+
+    pp = ms.PeakPickerHiRes()
+    pp.setParameters(params)
+    new_exp = ms.MSExperiment()
+
+    pp.pickExperiment(exp, new_exp)
+    features = ffim.FeatureFinderIonMobility().run_ff(new_exp, 'centroided')
+
+    return param_set, features.size()
+
+# Parameters, default [type, constraints, default value]
+signal_to_noise = 0.0 # float, 0+, 0
+ms_levels = [ 1 ]
+win_len = 100.0 # float, 1+, 200
+bin_count = 20 # int, 3+, 30
+min_required_elements = 5 # int, 1+, 10
+
+# Parameters, advanced (not currently iterating through these)
+spacing_difference_gap = 4.0 # float, 0+, 4
+spacing_difference = 1.5 # float, 0+, 1.5
+missing = 1 # int, 0+, 1
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='PeakPickerHiRes brute-force parameter \
@@ -11,6 +59,8 @@ if __name__ == '__main__':
     parser.add_argument('--input', action='store', required=True, type=str)
     parser.add_argument('--output', action='store', required=True, type=str)
     parser.add_argument('--target', action='store', required=False, type=int, default=250)
+    parser.add_argument('--num_workers', action='store', required=False, type=int, default=0)
+    parser.add_argument('--omp_threads', action='store', required=False, type=int, default=1)
 
     args = parser.parse_args()
 
@@ -25,55 +75,33 @@ if __name__ == '__main__':
             print("A spectrum is not sorted")
             quit()
 
-    # Parameters, default [type, constraints, default value]
-    signal_to_noise = 0.0 # float, 0+, 0
-    ms_levels = [ 1 ]
-    win_len = 100.0 # float, 1+, 200
-    bin_count = 20 # int, 3+, 30
-    min_required_elements = 5 # int, 1+, 10
-
-    # Parameters, advanced (not currently iterating through these)
-    spacing_difference_gap = 4.0 # float, 0+, 4
-    spacing_difference = 1.5 # float, 0+, 1.5
-    missing = 1 # int, 0+, 1
-
-    params = ms.PeakPickerHiRes().getParameters()
-    
-    params.__setitem__(b'ms_levels', ms_levels)
-
-    params.__setitem__(b'spacing_difference_gap', spacing_difference_gap)
-    params.__setitem__(b'spacing_difference', spacing_difference)
-    params.__setitem__(b'missing', missing)
-
     # Iterate through the params, and for each set, run PeakPickerHiRes and
     # FeatureFinderCentroided, and save the param sets for those that find at least the
-    # target number of features
-    file = open(args.output + "/suitable_params.txt", "w+")
-
-    for stn in np.arange(signal_to_noise, 1.5, 0.25):
-        params.__setitem__(b'signal_to_noise', stn)
-
-        for wl in np.arange(win_len, 301.0, 25.0):
-            params.__setitem__(b'SignalToNoise:win_len', wl)
+    # target number of features. The param sets are split between worker processes, which
+    # share the cores with their OpenMP threads (by default, one single-threaded worker per core)
+    param_sets = itertools.product(np.arange(signal_to_noise, 1.5, 0.25),
+                                   np.arange(win_len, 301.0, 25.0),
+                                   range(bin_count, 41, 1),
+                                   range(min_required_elements, 15, 1))
+    num_workers, omp_threads = rsc.split_cores(rsc.available_cores(), args.num_workers,
+                                               args.omp_threads)
 
-            for bc in range(bin_count, 41, 1):
-                params.__setitem__(b'SignalToNoise:bin_count', bc)
-
-                for mre in range(min_required_elements, 15, 1):
-                    params.__setitem__(b'SignalToNoise:min_required_elements', mre)
-
-                    pp = ms.PeakPickerHiRes()
-                    pp.setParameters(params)
-                    new_exp = ms.MSExperiment()
+    file = open(args.output + "/suitable_params.txt", "w+")
 
-                    pp.pickExperiment(exp, new_exp)
-                    features = run_ff(new_exp, 'centroided')
+    def write_results(results):
+        for (stn, wl, bc, mre), num_features in results:
+            if num_features >= args.target:
+                file.write("Number of features: " + str(num_features) + "\n")
+                file.write("signal_to_noise:    " + str(stn) + "\n")
+                file.write("win_len:            " + str(wl) + "\n")
+                file.write("bin_count:          " + str(bc) + "\n")
+                file.write("min_req_elements:   " + str(mre) + "\n\n")
+
+    if num_workers > 1:
+        with Pool(num_workers, initializer=init_worker, initargs=(omp_threads,)) as pool:
+            write_results(pool.imap(try_params, param_sets))
+    else:
+        init_worker(omp_threads)
+        write_results(map(try_params, param_sets))
 
-                    if features.size() >= args.target:
-                        file.write("Number of features: " + str(features.size()) + "\n")
-                        file.write("signal_to_noise:    " + str(stn) + "\n")
-                        file.write("win_len:            " + str(wl) + "\n")
-                        file.write("bin_count:          " + str(bc) + "\n")
-                        file.write("min_req_elements:   " + str(mre) + "\n\n")
-                        
     file.close()
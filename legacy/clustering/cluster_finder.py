@@ -1,11 +1,14 @@
 from baseline import *
 
+import csv
+
+import baseline
 import ransac
-from plane_fitting import estimate, is_inlier
+from plane_fitter import estimate, is_inlier
 
 import random
 import math
-from sklearn.cluster import DBSCAN
+import cluster_finder_im as cfi
 
 # Data preprocessing
 def get_points(spec):
@@ -14,55 +17,21 @@ def get_points(spec):
 
 # Data postprocessing
 def rm_outliers(points, coeffs, threshold):
-    for i in reversed(range(len(points))):
-        if not is_inlier(coeffs, points[i], threshold):
-            del points[i]
+    inliers = is_inlier(coeffs, np.asarray(points), threshold)
+    points[:] = [point for point, inlier in zip(points, inliers) if inlier]
     return points
 
 def extract_outliers(points, coeffs, threshold):
-    outl = []
-    for i in reversed(range(len(points))):
-        if not is_inlier(coeffs, points[i], threshold):
-            outl.append(points[i])
-    return outl
+    inliers = is_inlier(coeffs, np.asarray(points), threshold)
+    return [points[i] for i in reversed(np.flatnonzero(~inliers))]
 
-# Custom plane fitting (needs testing)
+# Custom plane fitting (batched; see cluster_finder_im.fit_plane_ransac)
 def cus_ransac(points, epsilon, num_iters):
-    a, b, c, d = 0, 0, 0, 0
-    max_inliers = []
-    max_inlier_count = 0
-
-    for i in range(num_iters):
-        sample = random.choices(points, k=3)
-        p1, p2, p3 = sample[0], sample[1], sample[2]
-        inliers = []
-        inlier_count = 0
-
-        v1 = (p2[0] - p1[0], p2[1] - p1[1], p2[2] - p1[2])
-        v2 = (p3[0] - p1[0], p3[1] - p1[1], p3[2] - p1[2])
-        # Normal vector
-        v3 = (v1[1] * v2[2] - v1[2] * v2[1],
-              v1[2] * v2[0] - v1[0] * v2[2],
-              v1[0] * v2[1] - v1[1] * v2[0])
-        # Compute D
-        cd = v3[0] * p1[0] + v3[1] * p1[1] + v3[2] * p1[2]
-        # Coefficients A, B, C, D
-        m = (v3[0], v3[1], v3[2], cd)
-
-        for j in range(len(points)):
-            s = points[j]
-            dist = (m[0] * s[0] + m[1] * s[1] + m[2] * s[2] + m[3]) / (
-                   math.sqrt(m[0] * m[0] + m[1] * m[1] + m[2] * m[2]))
-            if dist < epsilon:
-                inlier_count += 1
-                inliers.append(s)
-
-        if (inlier_count > max_inlier_count):
-            max_inlier_count = inlier_count
-            max_inliers = inliers
-            a, b, c, d = m
-
-    return (a, b, c, d), max_inliers
+    points = np.asarray(points, dtype=np.float64)
+    coeffs, _ = cfi.fit_plane_ransac(points, epsilon, num_iters)
+    max_inliers = points[is_inlier(coeffs, points, epsilon)].tolist()
+
+    return tuple(coeffs), max_inliers
 
 def find_features(coords, spec):
     lxyzs = [list(x) for x in coords]
@@ -128,44 +97,25 @@ def find_features(coords, spec):
     #ax.plot_surface(xx, yy, zz, color=(0, 1, 0, 0.5))
     #plt.show()
 
-    # DBSCAN clustering
-    db = DBSCAN(eps=1, min_samples=5).fit(lxyzs)
-    core_samples_mask = np.zeros_like(db.labels_, dtype=bool)
-    core_samples_mask[db.core_sample_indices_] = True
-    labels = db.labels_
+    # DBSCAN-style clustering on tolerance-scaled axes (see cluster_finder_im)
+    ims, mzs, intensities = np.array(lxyzs, dtype=np.float64).T
+    clusters = cfi.find_frame_features(mzs, ims, intensities)
 
-    n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
-    n_noise_ = list(labels).count(-1)
+    n_clusters_ = len(clusters['mz'])
+    n_noise_ = len(lxyzs) - int(clusters['size'].sum())
 
     print("Estimated number of clusters: %d" % n_clusters_)
     print("Estimated number of noise points: %d" % n_noise_)
 
-    # Group by cluster
-    f_groups = []
-    for i in range(len(coords)):
-        f_groups.append([])
-
-    for i in range(len(coords)):
-        if labels[i] != -1:
-            f_groups[labels[i]].append(coords[i])
-
     features = ms.FeatureMap()
 
     # Attempt 1: only include apex points
-    for i in range(len(coords)):
-        if len(f_groups[i]) == 0:
-            continue
-
-        apex = f_groups[i][0]
-        for j in range(len(f_groups[i])):
-            if f_groups[i][j][2] > apex[2]:
-                apex = f_groups[i][j]
-
+    for mz, intensity in zip(clusters['mz'], clusters['intensity']):
         f = ms.Feature()
-        f.setMZ(apex[1])
+        f.setMZ(float(mz))
         f.setCharge(1)
         f.setRT(spec.getRT())
-        f.setIntensity(apex[2])
+        f.setIntensity(float(intensity))
         f.setOverallQuality(10)
 
         features.push_back(f)
@@ -173,54 +123,97 @@ def find_features(coords, spec):
     features.setUniqueIds()
     return features
 
-# Begin execution
-def init(args):
-    exp = ms.MSExperiment()
-    ms.MzMLFile().load(args.infile + '.mzML', exp)
-
-    counter_to_og_rt_ms = {}
-    start_idx = 0
-    spectra = exp.getSpectra()
-
-    for i in range(start_idx, start_idx + args.num_frames):
-        spec = spectra[i]
-        points = get_points(spec)
+# Worker: cluster frame i of the experiment opened by baseline.init_frame_worker
+def cluster_spectrum(i, cluster_params):
+    spec = baseline.frame_exp.getSpectrum(i)
+    return i, spec.getRT(), spec.getMSLevel(), cluster_frame(spec, i, cluster_params)
 
-        # Quick graph of data
-        #fig = plt.figure()
-        #ax = fig.add_subplot(111, projection='3d')
-        #cxyz = list(zip(*coords))
-        #x, y, z = list(cxyz[0]), list(cxyz[1]), list(cxyz[2])
-        #ax.scatter(x, y, z, c='r', marker='o')
-        #ax.set_xlabel('IM')
-        #ax.set_ylabel('MZ')
-        #ax.set_zlabel('Intensity')
-        #plt.show()
+# Consolidated output: one featureXML (at the original RTs) and a features-im.csv
+def write_features(args, features, counter_to_og_rt_ms):
+    rts = counter_to_og_rt_ms['rt'][features['frame']]
 
-        new_features = find_features(points, spec)
-
-        break
+    feature_map = ms.FeatureMap()
+    for row, rt in zip(features, rts):
+        f = ms.Feature()
+        f.setMZ(float(row['mz']))
+        f.setCharge(1)
+        f.setRT(float(rt))
+        f.setIntensity(float(row['intensity']))
+        f.setOverallQuality(10)
+        f.setMetaValue('im', float(row['im']))
+        feature_map.push_back(f)
 
-        ms.FeatureXMLFile().store(args.outdir + '/' + str(i) + '_' + args.outfile +
-                                  '.featureXML', new_features)
+    feature_map.setUniqueIds()
+    ms.FeatureXMLFile().store(args.outdir + '/' + args.outfile + '.featureXML', feature_map)
 
-        counter_to_og_rt_ms[i] = [spec.getRT(), spec.getMSLevel()]
+    with open(args.outdir + '/features-im.csv', 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['RT', 'm/z', 'im'])
+        writer.writerows(zip(rts.tolist(), features['mz'].tolist(), features['im'].tolist()))
 
-    with open(args.outdir + '/counter_to_og_rt_ms.pkl', 'wb') as handle:
-        pickle.dump(counter_to_og_rt_ms, handle, protocol=pickle.HIGHEST_PROTOCOL)
+# Begin execution
+def init(args):
+    # Frames are streamed from disk, so the input must be an indexed mzML file
+    infile = args.infile + '.mzML'
+    exp = ms.OnDiscMSExperiment()
+    if not exp.openFile(infile):
+        raise IOError(infile + ' is not an indexed mzML file')
+
+    num_spectra = exp.getNrSpectra()
+    start_idx = args.start_frame
+    end_idx = num_spectra if args.num_frames is None else min(num_spectra, start_idx + args.num_frames)
+    frames = range(start_idx, end_idx)
+
+    cluster_params = {'mz_tolerance': args.cluster_mz_tol,
+                      'im_tolerance': args.cluster_im_tol,
+                      'min_samples': args.cluster_min_samples,
+                      'background_threshold': args.cluster_background_threshold}
+    frame_func = partial(cluster_spectrum, cluster_params=cluster_params)
+
+    # Indexed by frame; frames outside of [start_idx, end_idx) are left zeroed
+    counter_to_og_rt_ms = np.zeros(num_spectra, dtype=store.FRAME_INFO_DTYPE)
+    frame_features = []
+
+    def collect(results):
+        for i, rt, ms_level, features in results:
+            print("Clustered frame", i, "(" + str(len(features)), "features)")
+            counter_to_og_rt_ms[i] = (rt, ms_level)
+            frame_features.append(features)
+
+    if args.num_workers > 1:
+        with Pool(args.num_workers, initializer=init_frame_worker, initargs=(infile,)) as pool:
+            collect(pool.imap_unordered(frame_func, frames, chunksize=4))
+    else:
+        init_frame_worker(infile)
+        collect(map(frame_func, frames))
+
+    features = np.concatenate(frame_features) if frame_features else np.zeros(0, dtype=FEATURE_DTYPE)
+    features = features[np.argsort(features['frame'], kind='stable')]
+
+    # Same stores as the baseline, so that its linking (--mode 2) can run on them
+    store.save_array(args.outdir + '/frame_features.npy', features)
+    store.save_array(args.outdir + '/frame_info.npy', counter_to_og_rt_ms)
+    write_features(args, features, counter_to_og_rt_ms)
+
+    print("Found", len(features), "features in", len(frames), "frames")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='FragToPre Clustering Baseline')
     parser.add_argument('--infile', action='store', required=True, type=str)
     parser.add_argument('--outfile', action='store', required=True, type=str)
     parser.add_argument('--outdir', action='store', required=True, type=str)
-    parser.add_argument('--mz_epsilon', action='store', required=False, type=float)
-    parser.add_argument('--im_epsilon', action='store', required=False, type=float)
+    parser.add_argument('--start_frame', action='store', required=False, type=int, default=0)
     parser.add_argument('--num_frames', action='store', required=False, type=int)
-    parser.add_argument('--window_size', action='store', required=False, type=int)
-    parser.add_argument('--rt_length', action='store', required=False, type=int)
+    parser.add_argument('--num_workers', action='store', required=False, type=int, default=1)
+    parser.add_argument('--cluster_mz_tol', action='store', required=False, type=float,
+                        default=cfi.MZ_TOLERANCE)
+    parser.add_argument('--cluster_im_tol', action='store', required=False, type=float,
+                        default=cfi.IM_TOLERANCE)
+    parser.add_argument('--cluster_min_samples', action='store', required=False, type=int,
+                        default=cfi.MIN_SAMPLES)
+    parser.add_argument('--cluster_background_threshold', action='store', required=False,
+                        type=float, default=None)
 
     args = parser.parse_args()
 
     init(args)
-    #driver(args, find_features=False)
@@ -34,7 +34,8 @@ def estimate(xyzs):
     return np.linalg.svd(axyz)[-1][-1, :]
 
 def is_inlier(coeffs, xyz, threshold):
-    return np.abs(coeffs.dot(augment([xyz]).T)) < threshold
+    # Works on a single point or an array of points, without building an augmented copy
+    return np.abs(np.dot(xyz, coeffs[:3]) + coeffs[3]) < threshold
 
 if __name__ == '__main__':
     import matplotlib
@@ -21,21 +21,18 @@
 
 # https://github.com/falcondai/py-ransac
 
-import random
+import numpy as np
 
 def run_ransac(data, estimate, is_inlier, sample_size, goal_inliers, max_iterations, stop_at_goal=True, random_seed=None):
     best_ic = 0
     best_model = None
-    random.seed(random_seed)
-    # random.sample cannot deal with "data" being a numpy array
-    data = list(data)
+    rng = np.random.default_rng(random_seed)
+    data = np.asarray(data)
     for i in range(max_iterations):
-        s = random.sample(data, int(sample_size))
+        s = data[rng.choice(len(data), int(sample_size), replace=False)]
         m = estimate(s)
-        ic = 0
-        for j in range(len(data)):
-            if is_inlier(m, data[j]):
-                ic += 1
+        # is_inlier is evaluated on all points at once (it must accept an array of points)
+        ic = int(np.count_nonzero(is_inlier(m, data)))
 
         #print(s)
         #print('estimate:', m,)
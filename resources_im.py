@@ -0,0 +1,127 @@
+"""Splitting of the available cores between worker processes and the OpenMP threads of OpenMS.
+
+Some OpenMS algorithms (e.g. PeakPickerHiRes and the feature finders) are parallelized with OpenMP,
+which by default starts one thread per core in every process. Running them in several worker
+processes at once then oversubscribes the cores, so each of W workers is given T threads, with
+W * T no more than the available cores. The split is either given, derived from one of its halves,
+or tuned by timing a sample task with each thread count (see calibrate).
+
+The OpenMP runtime reads OMP_NUM_THREADS only when it is loaded (i.e. when pyOpenMS is imported),
+so thread counts are applied to the running process through threadpoolctl if it is installed.
+Without it, every process (forked workers included) keeps the thread count the runtime was loaded
+with, so the split is fitted to that: OMP_NUM_THREADS as it was set when the program started, or a
+thread per core. The thread count set at runtime only holds for the thread that sets it (and the
+processes it forks), so every thread that runs OpenMS algorithms has to set its own.
+"""
+
+import os
+import time
+from typing import Any, Callable, List, Optional, Tuple
+
+try:
+    import threadpoolctl  # Optional, for changing the thread count of an already loaded OpenMP runtime
+except ImportError:
+    threadpoolctl = None
+
+# OMP_NUM_THREADS as it was when the program started (before limit_threads changed it), which is
+# what the OpenMP runtime of pyOpenMS was loaded with
+STARTUP_OMP_NUM_THREADS = os.environ.get('OMP_NUM_THREADS')
+
+
+def available_cores() -> int:
+    """Returns the number of cores this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def startup_threads(cores: int) -> int:
+    """Returns the number of OpenMP threads that the runtime was loaded with, which is the number
+    every process runs with when it cannot be changed (i.e. without threadpoolctl).
+    """
+    try:
+        # A list of thread counts is one per nesting level, of which only the first is used
+        threads = int(STARTUP_OMP_NUM_THREADS.split(',')[0])
+    except (AttributeError, ValueError):
+        return cores
+    return threads if threads > 0 else cores
+
+
+def split_cores(cores: int, workers: int = 0, threads: int = 0) -> Tuple[int, int]:
+    """Splits cores between worker processes and the OpenMP threads of each worker.
+
+    Keyword arguments:
+    cores: the number of cores to split
+    workers: the number of worker processes (0 to fit as many as the threads allow)
+    threads: the number of OpenMP threads per worker (0 to share the cores between the workers)
+
+    Returns: the number of workers and of threads per worker. If neither is given, there is a
+        single worker with a thread per core (OpenMP's own default). Without threadpoolctl, the
+        threads are those of startup_threads, and there are no more workers than fit them.
+    """
+    requested = workers > 0 or threads > 0
+    if workers <= 0:
+        workers = max(cores // threads, 1) if threads > 0 else 1
+    if threads <= 0:
+        threads = max(cores // workers, 1)
+
+    if threadpoolctl is None:
+        fixed_threads = startup_threads(cores)
+        fixed_workers = min(workers, max(cores // fixed_threads, 1))
+        if requested and (fixed_workers, fixed_threads) != (workers, threads):
+            print(f'threadpoolctl is not installed, so the OpenMP thread count cannot be changed: using '
+                  f'{fixed_workers} worker(s) with {fixed_threads} thread(s) each instead of {workers} with '
+                  f'{threads} (set OMP_NUM_THREADS before starting, or install threadpoolctl)', flush=True)
+        workers, threads = fixed_workers, fixed_threads
+    return workers, threads
+
+
+def limit_threads(threads: int) -> None:
+    """Sets the number of OpenMP threads of the calling thread and of the processes it starts
+    (without threadpoolctl, only of new programs it runs, as forked processes keep its runtime).
+    """
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    if threadpoolctl is not None:
+        threadpoolctl.threadpool_limits(threads, user_api='openmp')
+
+
+def calibrate(task: Callable[[int, Any], Any], cores: int, candidates: Optional[List[int]] = None,
+              prepare: Optional[Callable[[], Any]] = None) -> Tuple[int, int]:
+    """Picks the split of cores with the highest throughput for a sample task, by timing it once
+    with each candidate thread count: with T threads, cores // T workers each take that long.
+
+    Keyword arguments:
+    task: the sample task, called with the thread count it is timed with and its input (once per
+        candidate, so it should be short); OpenMS algorithms that it runs on other threads must be
+        limited by it
+    cores: the number of cores to split
+    candidates: the thread counts to try (defaults to the powers of two up to cores, and cores)
+    prepare: makes a fresh input for each run of the task, outside of the timed part (e.g. a copy
+        of an experiment that the task modifies); without it, the input is None
+
+    Returns: the number of workers and of threads per worker. Without threadpoolctl, the thread
+        count cannot be changed, so no task is timed and the threads of startup_threads are given
+        as many workers as fit them.
+    """
+    if threadpoolctl is None:
+        return split_cores(cores, threads=startup_threads(cores))
+    if cores <= 1:
+        return split_cores(cores, threads=1)
+
+    if candidates is None:
+        candidates = sorted({2 ** k for k in range(cores.bit_length()) if 2 ** k <= cores} | {cores})
+
+    best, best_throughput = (cores, 1), 0.0
+    for threads in candidates:
+        sample = prepare() if prepare is not None else None
+        with threadpoolctl.threadpool_limits(threads, user_api='openmp'):
+            start_t = time.perf_counter()
+            task(threads, sample)
+            task_t = time.perf_counter() - start_t
+
+        workers = max(cores // threads, 1)
+        print(f'Calibration: {threads} threads per task took {task_t}s ({workers} workers)', flush=True)
+        if workers / task_t > best_throughput:
+            best, best_throughput = (workers, threads), workers / task_t
+
+    return best
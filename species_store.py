@@ -0,0 +1,107 @@
+"""Columnar storage for the species (precursors and fragments) linked by the baseline.
+
+Species are stored as flat structured arrays with one row per linked point, grouped by species id
+(rows of a species stay in linking order). Arrays are saved as .npy files so that they can be
+memory-mapped instead of unpickled.
+"""
+
+from typing import Dict, List
+
+import numpy as np
+
+
+SPECIES_DTYPE = np.dtype([('species', np.int64), ('frame', np.int32), ('mz', np.float64), ('im', np.float64),
+                          ('intensity', np.float64), ('charge', np.int32)])
+
+# Indexed by frame (the counter of the spectrum in the original experiment)
+FRAME_INFO_DTYPE = np.dtype([('rt', np.float64), ('ms_level', np.int32)])
+
+
+def species_to_array(species: Dict[int, List[list]]) -> np.ndarray:
+    """Flattens species into a structured array.
+
+    Keyword arguments:
+    species: maps species ids to [frames, points], where each point is [m/z, IM, intensity, charge]
+
+    Returns: a SPECIES_DTYPE array, grouped by species in the iteration order of species.
+    """
+    num_rows = sum(len(species[key][0]) for key in species)
+    array = np.zeros(num_rows, dtype=SPECIES_DTYPE)
+
+    ids, frames, points = [], [], []
+    for key in species:
+        ids.extend([key] * len(species[key][0]))
+        frames.extend(species[key][0])
+        points.extend(species[key][1])
+
+    if num_rows > 0:
+        points = np.asarray(points, dtype=np.float64)
+        array['species'], array['frame'] = ids, frames
+        array['mz'], array['im'], array['intensity'] = points[:, 0], points[:, 1], points[:, 2]
+        array['charge'] = points[:, 3]
+
+    return array
+
+
+def species_bounds(array: np.ndarray) -> np.ndarray:
+    """Finds where each species starts in a grouped species array.
+
+    Keyword arguments:
+    array: a SPECIES_DTYPE array, grouped by species
+
+    Returns: the row offsets of each species, followed by the total number of rows.
+    """
+    starts = np.flatnonzero(np.diff(array['species'])) + 1
+    if len(array) > 0:
+        starts = np.concatenate(([0], starts))
+    return np.append(starts, len(array))
+
+
+def summarize_species(array: np.ndarray) -> Dict[str, np.ndarray]:
+    """Computes per-species summaries with grouped reductions.
+
+    Keyword arguments:
+    array: a SPECIES_DTYPE array, grouped by species
+
+    Returns: a dictionary of arrays (one entry per species, in storage order) holding the species
+    ids, their first, smallest and largest frames, their mean m/z and IM, and their sizes.
+    """
+    bounds = species_bounds(array)
+    starts, sizes = bounds[:-1], np.diff(bounds)
+    frames = np.asarray(array['frame'], dtype=np.float64)
+
+    if len(starts) == 0:
+        empty = np.zeros(0)
+        return {'id': np.zeros(0, dtype=np.int64), 'rt_first': empty, 'rt_min': empty, 'rt_max': empty,
+                'mz': empty, 'im': empty, 'size': np.zeros(0, dtype=np.int64)}
+
+    return {'id': np.asarray(array['species'][starts]),
+            'rt_first': frames[starts],
+            'rt_min': np.minimum.reduceat(frames, starts),
+            'rt_max': np.maximum.reduceat(frames, starts),
+            'mz': np.add.reduceat(array['mz'], starts) / sizes,
+            'im': np.add.reduceat(array['im'], starts) / sizes,
+            'size': sizes}
+
+
+def save_array(filename: str, array: np.ndarray) -> None:
+    """Writes a structured array to a .npy file."""
+    np.save(filename, array, allow_pickle=False)
+
+
+def load_array(filename: str, mmap: bool = True) -> np.ndarray:
+    """Reads a structured array from a .npy file, memory-mapping it by default."""
+    return np.load(filename, mmap_mode='r' if mmap else None, allow_pickle=False)
+
+
+def write_species_text(filename: str, array: np.ndarray) -> None:
+    """Writes a human-readable dump of a species array (one species per line)."""
+    bounds = species_bounds(array)
+
+    with open(filename, 'w') as outfile:
+        outfile.write(str(len(bounds) - 1) + '\r\n')
+        for i in range(len(bounds) - 1):
+            rows = array[bounds[i]:bounds[i + 1]]
+            points = [[float(row['mz']), float(row['im']), float(row['intensity']), int(row['charge'])]
+                      for row in rows]
+            outfile.write(str(int(rows['species'][0])) + ': ' + str([rows['frame'].tolist(), points]) + '\r\n')
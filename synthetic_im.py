@@ -0,0 +1,108 @@
+"""Generates synthetic LC-IMS-MS data for benchmarking the LC-IMS-MS/MS feature finder.
+
+Each MS1 frame holds the isotope peaks of a set of peptides (Gaussian in RT and IM) on top of
+uniform noise, with the IM of every peak in the first float data array (as in converted timsTOF
+data). Optional MS2 spectra of pure noise are interleaved after each frame.
+"""
+
+import argparse
+
+import numpy as np
+import pyopenms as ms
+
+
+def make_spectrum(rt: float, ms_level: int, mzs: np.ndarray, intensities: np.ndarray, ims: np.ndarray) -> \
+        ms.MSSpectrum:
+    """Builds a spectrum (sorted by m/z) with IM values in its first float data array."""
+    order = np.argsort(mzs, kind='stable')
+
+    spec = ms.MSSpectrum()
+    spec.setRT(rt)
+    spec.setMSLevel(ms_level)
+    spec.set_peaks((mzs[order], intensities[order].astype(np.float32)))
+
+    im_fda = ms.FloatDataArray()
+    im_fda.setName('Ion Mobility')
+    im_fda.set_data(ims[order].astype(np.float32))
+    spec.setFloatDataArrays([im_fda])
+
+    return spec
+
+
+def make_experiment(num_frames: int = 60, num_peptides: int = 30, num_noise_peaks: int = 2000,
+                    num_ms2: int = 3, rt_sigma: float = 3.0, im_sigma: float = 0.01, num_scans: int = 400,
+                    seed: int = 0) -> ms.MSExperiment:
+    """Generates a synthetic LC-IMS-MS experiment.
+
+    Keyword arguments:
+    num_frames: the number of MS1 frames (one per second of RT)
+    num_peptides: the number of peptides (each with three isotope peaks)
+    num_noise_peaks: the number of noise peaks in each spectrum
+    num_ms2: the number of MS2 spectra to interleave after each MS1 frame
+    rt_sigma: the RT standard deviation of the peptide elution profiles
+    im_sigma: the IM standard deviation of the peptide mobility profiles
+    num_scans: the number of IM scans (distinct IM values) per frame
+    seed: the random seed
+
+    Returns: the synthetic experiment.
+    """
+    rng = np.random.default_rng(seed)
+    margin = min(10.0, num_frames / 4.0)
+
+    mz_centers = rng.uniform(400, 1200, num_peptides)
+    charges = rng.integers(1, 4, num_peptides)
+    rt_centers = rng.uniform(margin, num_frames - margin, num_peptides)
+    im_centers = rng.uniform(0.75, 1.25, num_peptides)
+    abundances = rng.uniform(1e3, 1e5, num_peptides)
+    im_axis = np.linspace(0.6, 1.4, num_scans)
+
+    exp = ms.MSExperiment()
+    for frame in range(num_frames):
+        rt = float(frame)
+        mzs = [rng.uniform(400, 1250, num_noise_peaks)]
+        intensities = [rng.uniform(1, 20, num_noise_peaks)]
+        ims = [rng.choice(im_axis, num_noise_peaks)]
+
+        for p in range(num_peptides):
+            elution = abundances[p] * np.exp(-0.5 * ((rt - rt_centers[p]) / rt_sigma) ** 2)
+            if elution < 5:
+                continue
+
+            scans = im_axis[np.abs(im_axis - im_centers[p]) < 4 * im_sigma]
+            for isotope in range(3):
+                profile = elution * 0.6 ** isotope * np.exp(-0.5 * ((scans - im_centers[p]) / im_sigma) ** 2)
+                keep = profile > 1
+                mzs.append(mz_centers[p] + isotope * 1.00335 / charges[p] + rng.normal(0, 0.0003, keep.sum()))
+                intensities.append(profile[keep])
+                ims.append(scans[keep])
+
+        exp.addSpectrum(make_spectrum(rt, 1, np.concatenate(mzs), np.concatenate(intensities), np.concatenate(ims)))
+
+        for k in range(num_ms2):
+            mzs2 = rng.uniform(100, 1500, num_noise_peaks)
+            exp.addSpectrum(make_spectrum(rt + 0.1 * (k + 1), 2, mzs2, rng.uniform(1, 100, num_noise_peaks),
+                                          rng.choice(im_axis, num_noise_peaks)))
+
+    return exp
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic LC-IMS-MS data generator.')
+    parser.add_argument('-o', '--out', action='store', required=True, type=str,
+                        help='the output (indexed) mzML file')
+    parser.add_argument('-f', '--num_frames', action='store', required=False, type=int, default=60,
+                        help='the number of MS1 frames')
+    parser.add_argument('-p', '--num_peptides', action='store', required=False, type=int, default=30,
+                        help='the number of peptides')
+    parser.add_argument('-n', '--num_noise_peaks', action='store', required=False, type=int, default=2000,
+                        help='the number of noise peaks per spectrum')
+    parser.add_argument('-m', '--num_ms2', action='store', required=False, type=int, default=3,
+                        help='the number of MS2 spectra after each MS1 frame')
+    parser.add_argument('-s', '--seed', action='store', required=False, type=int, default=0,
+                        help='the random seed')
+
+    args = parser.parse_args()
+
+    exp = make_experiment(args.num_frames, args.num_peptides, args.num_noise_peaks, args.num_ms2, seed=args.seed)
+    ms.MzMLFile().store(args.out, exp)
+    print('Wrote', exp.getNrSpectra(), 'spectra to', args.out)
@@ -0,0 +1,169 @@
+"""RT and m/z tiling of the feature finding of a single IM bin.
+
+A bin experiment is split into a grid of tiles. Each tile owns a core range of RT and m/z, and is
+extended by a halo on every side, so that a feature near the edge of a core is still found whole
+in the tile that owns it. The tiles are feature found independently (in parallel) and stitched
+back together: a tile keeps only the features centred in its core, and features that were found
+on both sides of a core boundary are deduplicated.
+"""
+
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+import numpy as np
+import pyopenms as ms
+
+import common_utils_im as util
+import resources_im as rsc
+
+
+# The RT and m/z ranges of a tile: its core (as half-open intervals) and its extent (core plus halo)
+Tile = Tuple[Tuple[float, float], Tuple[float, float], Tuple[float, float], Tuple[float, float]]
+
+
+def split_range(start: float, end: float, size: float, halo: float) -> List[Tuple[Tuple[float, float],
+                                                                                  Tuple[float, float]]]:
+    """Splits a range into cores of (at most) a given size, each extended by a halo.
+
+    Keyword arguments:
+    start: the start of the range
+    end: the end of the range (inclusive)
+    size: the size of each core (0 for a single core)
+    halo: the distance each core is extended by on both sides
+
+    Returns: a list of (core, extent) pairs of intervals. The first and last cores are unbounded,
+        so that the cores cover every value.
+    """
+    num = max(math.ceil((end - start) / size), 1) if size > 0 else 1
+    bounds = [start + k * size for k in range(num + 1)]
+    bounds[0], bounds[-1] = float('-inf'), float('inf')
+
+    return [((bounds[k], bounds[k + 1]), (max(bounds[k], start) - halo, min(bounds[k + 1], end) + halo))
+            for k in range(num)]
+
+
+def make_tiles(exp: ms.MSExperiment, rt_size: float, mz_size: float, rt_halo: float, mz_halo: float) -> List[Tile]:
+    """Splits the RT and m/z range of an experiment into a grid of tiles (see split_range)."""
+    rts, mz_start, mz_end = [], float('inf'), float('-inf')
+    for spec in exp:
+        rts.append(spec.getRT())
+        if spec.size() > 0:
+            mzs = spec.get_peaks()[0]
+            mz_start, mz_end = min(mz_start, mzs[0]), max(mz_end, mzs[-1])
+    if not rts or mz_start > mz_end:
+        return []
+
+    return [(rt_core, mz_core, rt_extent, mz_extent)
+            for rt_core, rt_extent in split_range(min(rts), max(rts), rt_size, rt_halo)
+            for mz_core, mz_extent in split_range(mz_start, mz_end, mz_size, mz_halo)]
+
+
+def tile_experiment(exp: ms.MSExperiment, tile: Tile) -> ms.MSExperiment:
+    """Extracts the spectra and peaks (with their IM values) of an experiment within the extent of
+    a tile. Spectra without peaks in the tile's m/z range are kept (empty), so that gaps between
+    spectra are the same as in the whole experiment.
+    """
+    (rt_start, rt_end), (mz_start, mz_end) = tile[2], tile[3]
+    new_exp = ms.MSExperiment()
+
+    for spec in exp:
+        if not rt_start <= spec.getRT() <= rt_end:
+            continue
+
+        mzs, intensities = spec.get_peaks()
+        start, end = np.searchsorted(mzs, mz_start, side='left'), np.searchsorted(mzs, mz_end, side='right')
+
+        new_spec = ms.MSSpectrum()
+        new_spec.setRT(spec.getRT())
+        new_spec.set_peaks((mzs[start:end], intensities[start:end]))
+        im_fda = ms.FloatDataArray()
+        im_fda.set_data(np.asarray(spec.getFloatDataArrays()[0].get_data()[start:end], dtype=np.float32))
+        new_spec.setFloatDataArrays([im_fda])
+        new_exp.addSpectrum(new_spec)
+
+    return new_exp
+
+
+def in_core(feature: ms.Feature, tile: Tile) -> bool:
+    """Checks if a feature is centred in the core of a tile."""
+    (rt_start, rt_end), (mz_start, mz_end) = tile[0], tile[1]
+    return rt_start <= feature.getRT() < rt_end and mz_start <= feature.getMZ() < mz_end
+
+
+def near_boundary(feature: ms.Feature, tile: Tile, rt_threshold: float, mz_threshold: float) -> bool:
+    """Checks if a feature is close enough to the edge of a tile's core to also be found (with a
+    slightly different centre) by a neighbouring tile.
+    """
+    (rt_start, rt_end), (mz_start, mz_end) = tile[0], tile[1]
+    rt, mz = feature.getRT(), feature.getMZ()
+    return (rt - rt_start < rt_threshold or rt_end - rt < rt_threshold or
+            mz - mz_start < mz_threshold or mz_end - mz < mz_threshold)
+
+
+def stitch_features(tiles: List[Tile], tile_features: List[ms.FeatureMap], rt_threshold: float,
+                    mz_threshold: float) -> ms.FeatureMap:
+    """Combines the features found in each tile into a single feature map.
+
+    Each tile contributes the features centred in its core. Of the features near a core boundary,
+    those similar to a more intense feature of another tile (see common_utils_im.similar_features)
+    are dropped as duplicates.
+
+    Keyword arguments:
+    tiles: the tiles
+    tile_features: the features found in each tile
+    rt_threshold: the RT threshold for duplicate features
+    mz_threshold: the m/z threshold for duplicate features
+
+    Returns: the stitched features.
+    """
+    features, boundary = ms.FeatureMap(), []
+    for k, (tile, tile_map) in enumerate(zip(tiles, tile_features)):
+        for feature in tile_map:
+            if not in_core(feature, tile):
+                continue
+            if near_boundary(feature, tile, rt_threshold, mz_threshold):
+                boundary.append((feature, k))
+            else:
+                features.push_back(feature)
+
+    kept = []
+    for feature, k in sorted(boundary, key=lambda item: -item[0].getIntensity()):
+        if not any(k != other_k and util.similar_features(feature, other, rt_threshold, mz_threshold)
+                   for other, other_k in kept):
+            kept.append((feature, k))
+            features.push_back(feature)
+
+    features.sortByRT()
+    return features
+
+
+def run_tiled(exp: ms.MSExperiment, run: Callable[[ms.MSExperiment], ms.FeatureMap], tiles: List[Tile],
+              num_threads: int, rt_threshold: float, mz_threshold: float, omp_threads: int = 0) -> ms.FeatureMap:
+    """Runs a feature finder on each tile of an experiment, in parallel, and stitches the results.
+
+    pyOpenMS releases the GIL while OpenMS algorithms run, so tiles are run on threads and share
+    the experiment (each tile is only extracted when its thread starts on it).
+
+    Keyword arguments:
+    exp: the experiment to feature find
+    run: the feature finder to run on each tile
+    tiles: the tiles to split the experiment into (see make_tiles)
+    num_threads: the number of tiles to feature find at once
+    rt_threshold: the RT threshold for duplicate features (see stitch_features)
+    mz_threshold: the m/z threshold for duplicate features
+    omp_threads: the number of OpenMP threads of each tile's feature finder (0 for OpenMP's default)
+
+    Returns: the features of the experiment.
+    """
+    def run_tile(tile: Tile) -> ms.FeatureMap:
+        tile_exp = tile_experiment(exp, tile)
+        return run(tile_exp) if util.has_peaks(tile_exp) else ms.FeatureMap()
+
+    initializer = (lambda: rsc.limit_threads(omp_threads)) if omp_threads > 0 else None
+    with ThreadPoolExecutor(max(num_threads, 1), initializer=initializer) as executor:
+        tile_features = list(executor.map(run_tile, tiles))
+
+    features = stitch_features(tiles, tile_features, rt_threshold, mz_threshold)
+    features.setUniqueIds()
+    return features
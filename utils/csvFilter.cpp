@@ -1,7 +1,6 @@
 #include <algorithm>
 #include <fstream>
 #include <iostream>
-#include <sstream>
 #include <string>
 #include <unordered_map>
 #include <vector>
@@ -17,7 +16,36 @@
 
 using namespace std;
 
-vector<vector<string>> table(1);
+// The [begin, end) offsets of each field of a line (reused between lines to avoid reallocating)
+typedef vector<pair<size_t, size_t>> Fields;
+
+// Splits a line on a delimiter in place; like repeated getline calls, n delimiters give n + 1 fields
+void split(const string &line, char delim, Fields &fields) {
+	fields.clear();
+	size_t begin = 0, end;
+	while ((end = line.find(delim, begin)) != string::npos) {
+		fields.push_back({ begin, end });
+		begin = end + 1;
+	}
+	fields.push_back({ begin, line.size() });
+}
+
+string get_field(const string &line, const Fields &fields, int i) {
+	return line.substr(fields[i].first, fields[i].second - fields[i].first);
+}
+
+void write_field(fstream &outfile, const string &line, const Fields &fields, int i) {
+	outfile.write(line.data() + fields[i].first, fields[i].second - fields[i].first);
+}
+
+int get_column(const unordered_map<string, int> &headers, const string &name) {
+	auto it = headers.find(name);
+	if (it == headers.end()) {
+		cout << "Error: input csv file has no " << name << " column\n";
+		exit(2);
+	}
+	return it->second;
+}
 
 int main(int argc, char *argv[]) {
 	// Speed up input
@@ -80,100 +108,84 @@ int main(int argc, char *argv[]) {
 		exit(2);
 	}
 
+	// Rows are whitespace-delimited tokens (as read by operator>>)
 	string input;
 	infile >> input;
 
 	// Get the headers
 	unordered_map<string, int> headers;
-	int idx = 0;
+	Fields fields;
 
-	stringstream ss1(input);
-	while (ss1.good()) {
-		getline(ss1, input, ',');
-		table[0].push_back(input);
-		headers.insert({ input, idx++ });
+	split(input, ',', fields);
+	for (int i = 0; i < fields.size(); i++) {
+		headers.insert({ get_field(input, fields, i), i });
 	}
 
 	// Projection only requires these three columns
 	if (mode == 1) {
-		vector<string> header{ "RT", "m/z", "Intensity" };
-		table.push_back(header);
+		outfile << "RT,m/z,Intensity\n";
+	}
+	else {
+		outfile << input << '\n';
+	}
+
+	int rt_col = -1, q_col = -1, decoy_col = -1, pgr_col = -1, mz_col = -1, int_col = -1;
+	if (mode == 0) {
+		rt_col = get_column(headers, "RT");
+		// Use initialPeakQuality on non-scored tsv files
+		q_col = get_column(headers, "q_value");
+		decoy_col = get_column(headers, "decoy");
+		pgr_col = get_column(headers, "peak_group_rank");
 	}
+	else if (mode == 1) {
+		rt_col = get_column(headers, "RT");
+		mz_col = get_column(headers, "m/z");
+		int_col = get_column(headers, "aggr_prec_Peak_Area");
+	}
+	else {
+		int_col = get_column(headers, "aggr_prec_Peak_Area");
+	}
+
+	// Sorting only needs to keep the rows and their intensities; everything else is written as it is read
+	vector<string> lines;
+	vector<pair<double, size_t>> sorted;
 
-	// Simultaneously read and filter the input
+	// Simultaneously read, filter and write the input
 	cout << "Processing input...";
-	for (int i = 0; infile >> input; i++) {
-		vector<string> line;
-		stringstream ss2(input);
-		while (ss2.good()) {
-			getline(ss2, input, ',');
-			line.push_back(input);
-		}
+	while (infile >> input) {
+		split(input, ',', fields);
 
 		if (mode == 0) {
-			double rt = stod(line[headers.find("RT")->second]);
-			// Use initialPeakQuality on non-scored tsv files
-			double q = stod(line[headers.find("q_value")->second]);
-			double d = stoi(line[headers.find("decoy")->second]);
-			int pgr = stoi(line[headers.find("peak_group_rank")->second]);
+			double rt = stod(get_field(input, fields, rt_col));
+			double q = stod(get_field(input, fields, q_col));
+			double d = stoi(get_field(input, fields, decoy_col));
+			int pgr = stoi(get_field(input, fields, pgr_col));
 
 			if (rt >= min_rt && rt <= max_rt && q <= Q_THRESHOLD && !d && pgr == PEAK_GROUP_RANK) {
-				table.push_back(line);
+				outfile << input << '\n';
 			}
 		}
 		else if (mode == 1) {
-			string rt = line[headers.find("RT")->second];
-			string mz = line[headers.find("m/z")->second];
-			string intensity = line[headers.find("aggr_prec_Peak_Area")->second];
-
-			vector<string> projection{ rt, mz, intensity };
-			table.push_back(projection);
+			write_field(outfile, input, fields, rt_col);
+			outfile << ',';
+			write_field(outfile, input, fields, mz_col);
+			outfile << ',';
+			write_field(outfile, input, fields, int_col);
+			outfile << '\n';
 		}
 		else {
-			table.push_back(line);
-		}
-	}
-
-	idx = mode == 1 ? 1 : 0;
-	for (int i = 0; i < table[idx].size(); i++) {
-		outfile << table[idx][i];
-		if (i < table[idx].size() - 1) {
-			outfile << ',';
+			sorted.push_back({ stod(get_field(input, fields, int_col)), lines.size() });
+			lines.push_back(input);
 		}
 	}
-	outfile << '\n';
 
 	if (mode == 2) {
-		vector<pair<double, vector<string> *>> sorted;
-		for (int i = 1; i < table.size(); i++) {
-			double intensity = stod(table[i][headers.find("aggr_prec_Peak_Area")->second]);
-			sorted.push_back({ intensity, &table[i] });
-		}
-
 		sort(sorted.begin(), sorted.end(), [](const auto &a, const auto &b) {
 			return b.first < a.first;
 		});
 
 		for (int i = 0; i < sorted.size(); i++) {
-			vector<string> *temp = sorted[i].second;
-			for (int j = 0; j < temp->size(); j++) {
-				outfile << (*temp)[j];
-				if (j < temp->size() - 1) {
-					outfile << ',';
-				}
-			}
-			outfile << '\n';
-		}
-	}
-	else {
-		for (int i = idx + 1; i < table.size(); i++) {
-			for (int j = 0; j < table[i].size(); j++) {
-				outfile << table[i][j];
-				if (j < table[i].size() - 1) {
-					outfile << ',';
-				}
-			}
-			outfile << '\n';
+			outfile << lines[sorted[i].second] << '\n';
 		}
 	}
 
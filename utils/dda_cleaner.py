@@ -1,6 +1,11 @@
 import argparse
 import csv
-from operator import itemgetter
+import itertools
+
+import numpy as np
+
+# Columns that are parsed as numbers (and written back out as floats)
+NUMERIC_COLUMNS = {'Retention time', 'm/z', 'Intensity', 'PEP'}
 
 def checkFloat(val):
     try:
@@ -8,50 +13,156 @@ def checkFloat(val):
     except ValueError:
         return False
 
+def to_float(values):
+    """Parses a column of strings, with unparsable values (e.g. '') becoming NaN."""
+    try:
+        return np.array(values, dtype=np.float64)
+    except ValueError:
+        parsed = [checkFloat(val) for val in values]
+        return np.array([np.nan if val is False else val for val in parsed], dtype=np.float64)
+
+def read_chunks(filename, delimiter, chunk_size):
+    """Yields the header of a MaxQuant table, followed by lists of up to chunk_size rows."""
+    with open(filename, 'r', newline='') as infile:
+        reader = csv.reader(infile, delimiter=delimiter)
+        yield next(reader)
+
+        while True:
+            chunk = list(itertools.islice(reader, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+def filter_chunk(header, chunk, args, stats):
+    """Filters a chunk of rows column-wise.
+
+    Returns the projected columns of the remaining rows (numeric columns as float arrays).
+    """
+    def column(name):
+        idx = header[name]
+        return [row[idx] for row in chunk]
+
+    keep = np.ones(len(chunk), dtype=bool)
+    if args.file is not None:
+        keep &= np.array(column('Raw file')) == args.file
+
+    numeric = {name: to_float(column(name)) for name in NUMERIC_COLUMNS | set(args.qvalue_column)
+               if name in header}
+
+    valid = np.ones(len(chunk), dtype=bool)
+    for name in ('Retention time', 'm/z', 'Intensity'):
+        if name in numeric:
+            valid &= ~np.isnan(numeric[name])
+    stats['False'] += int(np.count_nonzero(keep & ~valid))
+    keep &= valid
+
+    small = np.zeros(len(chunk), dtype=bool)
+    if 'm/z' in numeric:
+        small |= numeric['m/z'] <= args.min_mz
+    if 'Intensity' in numeric:
+        small |= numeric['Intensity'] <= args.min_intensity
+    stats['Small'] += int(np.count_nonzero(keep & small))
+    keep &= ~small
+
+    # Missing PEPs and q-values never pass a threshold (NaN comparisons are False)
+    if args.start is not None:
+        keep &= numeric['Retention time'] >= args.start
+    if args.stop is not None:
+        keep &= numeric['Retention time'] <= args.stop
+    if args.pep is not None:
+        keep &= numeric['PEP'] < args.pep
+    if args.qvalue is not None:
+        keep &= numeric[args.qvalue_column[0]] <= args.qvalue
+
+    stats['Total'] += int(np.count_nonzero(keep))
+
+    rows = np.flatnonzero(keep)
+    projected = []
+    for name in args.columns:
+        if name in numeric:
+            projected.append(numeric[name][rows])
+        else:
+            values = column(name)
+            projected.append(np.array([values[i] for i in rows], dtype=object))
+
+    return projected
+
+def write_rows(writer, projected):
+    writer.writerows(zip(*[col.tolist() for col in projected]))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Projection')
     parser.add_argument('--input', action='store', required=True, type=str)
     parser.add_argument('--output', action='store', required=True, type=str)
-    parser.add_argument('--file', action='store', required=True, type=str)
-    parser.add_argument('--start', action='store', required=True, type=float)
-    parser.add_argument('--stop', action='store', required=True, type=float)
-    parser.add_argument('--pep', action='store', required=False, type=float)
-    
+    parser.add_argument('--file', action='store', required=False, type=str,
+                        help='only keep rows from this raw file')
+    parser.add_argument('--start', action='store', required=False, type=float,
+                        help='the start of the RT window to keep')
+    parser.add_argument('--stop', action='store', required=False, type=float,
+                        help='the end of the RT window to keep')
+    parser.add_argument('--pep', action='store', required=False, type=float,
+                        help='only keep rows with a smaller PEP')
+    parser.add_argument('--qvalue', action='store', required=False, type=float,
+                        help='only keep rows with a q-value that is at most this')
+    parser.add_argument('--qvalue_column', action='store', required=False, type=str, default='Q-value')
+    parser.add_argument('--min_mz', action='store', required=False, type=float, default=10)
+    parser.add_argument('--min_intensity', action='store', required=False, type=float, default=10)
+    parser.add_argument('--columns', action='store', required=False, type=str,
+                        default='Retention time,m/z,Intensity',
+                        help='comma-separated list of the columns to output')
+    parser.add_argument('--sort', action='store', required=False, type=str, default='Intensity',
+                        help="the output column to sort by ('none' to write rows as they are read)")
+    parser.add_argument('--header', action='store_true', required=False, default=False,
+                        help='write a header row')
+    parser.add_argument('--delimiter', action='store', required=False, type=str,
+                        help='the input delimiter (defaults to tabs for .txt files and commas otherwise)')
+    parser.add_argument('--chunk_size', action='store', required=False, type=int, default=100000)
+
     args = parser.parse_args()
-    PEP = args.pep if args.pep is not None else float('inf')
-    
-    data = []
-    errorFalse, errorSmall = 0, 0
-    cleanRows = 0
-    
-    with open(args.input, 'r', newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            rf = row['Raw file']
-            rt = checkFloat(row['Retention time'])
-            mz = checkFloat(row['m/z'])
-            intensity = checkFloat(row['Intensity'])
-            pep = checkFloat(row['PEP'])
-            
-            if rf != args.file:
-                continue
-            if rt is False or mz is False or intensity is False:
-                errorFalse += 1
-                continue
-            if mz <= 10 or intensity <= 10:
-                errorSmall += 1
-                continue
-            if args.start <= rt <= args.stop and pep < PEP:
-                data.append([rt, mz, intensity])
-                cleanRows += 1
-                
-    data = sorted(data, key=itemgetter(2))
-            
+    args.columns = args.columns.split(',')
+    args.qvalue_column = [args.qvalue_column] if args.qvalue is not None else []
+    if args.delimiter is None:
+        args.delimiter = '\t' if args.input.endswith('.txt') else ','
+    sort = args.sort != 'none'
+    if sort and args.sort not in args.columns:
+        parser.error('--sort must be one of --columns')
+
+    chunks = read_chunks(args.input, args.delimiter, args.chunk_size)
+    header = {name: i for i, name in enumerate(next(chunks))}
+
+    required = set(args.columns)
+    if args.file is not None:
+        required.add('Raw file')
+    if args.start is not None or args.stop is not None:
+        required.add('Retention time')
+    if args.pep is not None:
+        required.add('PEP')
+    required.update(args.qvalue_column)
+    missing = required - set(header)
+    if missing:
+        parser.error('missing columns: ' + ', '.join(sorted(missing)))
+
+    stats = {'False': 0, 'Small': 0, 'Total': 0}
+    results = []
+
     with open(args.output, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile)
-        writer.writerows(data)
-    
-    print("'False' errors:", errorFalse)
-    print("'Small' errors:", errorSmall)
-    print("Total rows:", cleanRows)
-    
\ No newline at end of file
+        if args.header:
+            writer.writerow(args.columns)
+
+        for chunk in chunks:
+            projected = filter_chunk(header, chunk, args, stats)
+            if sort:
+                results.append(projected)  # Only the projected columns are kept in memory
+            else:
+                write_rows(writer, projected)
+
+        if sort:
+            columns = [np.concatenate([res[i] for res in results]) if results else np.zeros(0)
+                       for i in range(len(args.columns))]
+            order = np.argsort(columns[args.columns.index(args.sort)], kind='stable')
+            write_rows(writer, [col[order] for col in columns])
+
+    print("'False' errors:", stats['False'])
+    print("'Small' errors:", stats['Small'])
+    print("Total rows:", stats['Total'])
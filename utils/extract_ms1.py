@@ -3,22 +3,116 @@ import argparse
 import pyopenms as ms
 import numpy as np
 
+class SpectrumFilter:
+    """Consumer that streams the spectra of an mzML file to a writing consumer, dropping the
+    spectra outside of the requested MS level and RT range and the peaks outside of the
+    requested IM range (IM values are read from the first float data array of each spectrum).
+    """
+
+    def __init__(self, writer, ms_level=1, rt_range=None, im_range=None, num_expected=None):
+        self.writer = writer
+        self.num_expected = num_expected
+        self.ms_level = ms_level
+        self.rt_range = rt_range
+        self.im_range = im_range
+        self.num_spectra = 0
+
+    def setExperimentalSettings(self, settings):
+        self.writer.setExperimentalSettings(settings)
+
+    def setExpectedSize(self, num_spectra, num_chromatograms):
+        # The number of spectra given by the parser counts the filtered spectra too
+        if self.num_expected is not None:
+            num_spectra = self.num_expected
+        self.writer.setExpectedSize(num_spectra, num_chromatograms)
+
+    def consumeChromatogram(self, chrom):
+        self.writer.consumeChromatogram(chrom)
+
+    def consumeSpectrum(self, spec):
+        if spec.getMSLevel() != self.ms_level:
+            return
+        if self.rt_range is not None and not self.rt_range[0] <= spec.getRT() <= self.rt_range[1]:
+            return
+
+        if self.im_range is not None:
+            arrays = spec.getFloatDataArrays()
+            mzs, intensities = spec.get_peaks()
+
+            # Spectra without IM values have no peaks known to be in the IM range
+            if len(arrays) == 0:
+                keep = np.zeros(len(mzs), dtype=bool)
+            else:
+                ims = arrays[0].get_data()
+                keep = (ims >= self.im_range[0]) & (ims <= self.im_range[1])
+
+            for array in arrays:
+                array.set_data(array.get_data()[keep])
+            spec.setFloatDataArrays([])  # Detached while the peaks are resized
+            spec.set_peaks((mzs[keep], intensities[keep]))
+            spec.setFloatDataArrays(arrays)
+
+        self.writer.consumeSpectrum(spec)
+        self.num_spectra += 1
+
+def count_spectra(input, ms_level=1, rt_range=None):
+    """Counts the spectra of an MS level (in an RT range) from the metadata of an indexed mzML
+    file, without decoding any peaks. Returns None if the file is not indexed.
+    """
+    exp = ms.OnDiscMSExperiment()
+    if not exp.openFile(input):
+        return None
+
+    count = 0
+    for spec in exp.getMetaData().getSpectra():
+        if spec.getMSLevel() != ms_level:
+            continue
+        if rt_range is None or rt_range[0] <= spec.getRT() <= rt_range[1]:
+            count += 1
+
+    return count
+
+def extract_ms1(input, output, ms_level=1, rt_range=None, im_range=None, write_index=True):
+    """Streams the spectra of one MS level (optionally restricted to an RT and IM range) from an
+    mzML file to another, without loading either file into memory.
+
+    Returns the number of spectra written.
+    """
+    writer = ms.PlainMSDataWritingConsumer(output)
+    write_options = writer.getOptions()
+    write_options.setWriteIndex(write_index)  # So that the output can be opened on disk
+    writer.setOptions(write_options)
+
+    # Let the parser skip (and not decode) spectra of other MS levels or outside the RT range. Its
+    # RT range excludes the upper bound, so it is widened to the next double and the consumer keeps
+    # the inclusive range (as count_spectra counts it)
+    mzml = ms.MzMLFile()
+    read_options = mzml.getOptions()
+    read_options.setMSLevels([ms_level])
+    if rt_range is not None:
+        read_options.setRTRange(ms.DRange1(rt_range[0], float(np.nextafter(rt_range[1], np.inf))))
+    mzml.setOptions(read_options)
+
+    consumer = SpectrumFilter(writer, ms_level, rt_range, im_range, count_spectra(input, ms_level, rt_range))
+    mzml.transform(input, consumer)
+
+    del writer  # Finishes (and indexes) the output file
+    return consumer.num_spectra
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Extract MS1 spectra from an mzML file.')
     parser.add_argument('--input', action='store', required=True, type=str)
     parser.add_argument('--output', action='store', required=True, type=str)
+    parser.add_argument('--ms_level', action='store', required=False, type=int, default=1)
+    parser.add_argument('--rt_range', action='store', required=False, type=float, nargs=2,
+                        metavar=('MIN_RT', 'MAX_RT'))
+    parser.add_argument('--im_range', action='store', required=False, type=float, nargs=2,
+                        metavar=('MIN_IM', 'MAX_IM'))
+    parser.add_argument('--no_index', action='store_true', required=False, default=False,
+                        help='do not write an indexed mzML file')
 
     args = parser.parse_args()
 
-    exp = ms.MSExperiment()
-    ms.MzMLFile().load(args.input, exp)
-
-    spectra = exp.getSpectra()
-    new_spectra = []
-
-    for spec in spectra:
-        if spec.getMSLevel() == 1:
-             new_spectra.append(spec)
-
-    exp.setSpectra(new_spectra)
-    ms.MzMLFile().store(args.output, exp)
+    num_spectra = extract_ms1(args.input, args.output, args.ms_level, args.rt_range, args.im_range,
+                              not args.no_index)
+    print('Extracted', num_spectra, 'spectra')
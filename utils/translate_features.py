@@ -1,8 +1,17 @@
 import argparse
 import csv
+import os
 
+import numpy as np
 import pyopenms as ms
-from operator import itemgetter
+
+# The columnar feature format (one row per feature, saved as a .npy file)
+FEATURE_DTYPE = np.dtype([('rt', np.float64), ('mz', np.float64), ('im', np.float64),
+                          ('intensity', np.float64), ('charge', np.int32)])
+
+# csv header names of each column (the first name is the one that is written)
+CSV_NAMES = {'rt': ['RT', 'Retention time'], 'mz': ['m/z'], 'intensity': ['Intensity'],
+             'im': ['im', 'IM']}
 
 def checkFloat(val):
     try:
@@ -10,62 +19,162 @@ def checkFloat(val):
     except ValueError:
         return False
 
+def to_float(values, block_size=4096):
+    """Parses a column of strings, with unparsable values (e.g. '') becoming NaN. Only the blocks
+    that contain unparsable values are parsed value by value.
+    """
+    blocks = []
+    for i in range(0, len(values), block_size):
+        block = values[i:i + block_size]
+        try:
+            blocks.append(np.array(block, dtype=np.float64))
+        except ValueError:
+            parsed = [checkFloat(val) for val in block]
+            blocks.append(np.array([np.nan if val is False else val for val in parsed], dtype=np.float64))
+
+    return np.concatenate(blocks) if blocks else np.zeros(0)
+
+def read_csv(filename):
+    """Reads the feature columns of a csv file (e.g. features-im.csv).
+
+    Columns are found by their header names; without any known names, the first three columns
+    are taken to be RT, m/z and intensity. Rows with unparsable values are skipped.
+    """
+    with open(filename, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(reader)
+
+    indices = {}
+    for key, names in CSV_NAMES.items():
+        for name in names:
+            if name in header:
+                indices[key] = header.index(name)
+                break
+    if 'rt' not in indices or 'mz' not in indices:
+        indices = {'rt': 0, 'mz': 1, 'intensity': 2}
+
+    columns = {key: to_float([row[idx] for row in rows]) for key, idx in indices.items()}
+
+    valid = np.ones(len(rows), dtype=bool)
+    for values in columns.values():
+        valid &= ~np.isnan(values)
+
+    return {key: values[valid] for key, values in columns.items()}
+
+def write_csv(filename, columns, im_layout=False):
+    """Writes feature columns to a csv file, either as RT, m/z, intensity and IM (those that are
+    known) or, with im_layout, as RT, m/z, IM (the layout of features-im.csv).
+    """
+    keys = ['rt', 'mz', 'im'] if im_layout else [k for k in ('rt', 'mz', 'intensity', 'im') if k in columns]
+
+    with open(filename, 'w', newline='') as f:
+        f.write(','.join(CSV_NAMES[key][0] for key in keys) + '\n')
+        csv.writer(f, lineterminator='\n').writerows(zip(*[columns[key].tolist() for key in keys]))
+
+def read_npy(filename):
+    """Reads the feature columns of a columnar feature file.
+
+    Besides FEATURE_DTYPE arrays, this accepts the baseline's frame_features.npy, whose frames are
+    mapped to RTs through the frame_info.npy next to it.
+    """
+    array = np.load(filename, mmap_mode='r', allow_pickle=False)
+    columns = {key: np.asarray(array[key]) for key in FEATURE_DTYPE.names if key in array.dtype.names}
+
+    if 'rt' not in columns:
+        frame_info = np.load(os.path.join(os.path.dirname(filename), 'frame_info.npy'), allow_pickle=False)
+        columns['rt'] = frame_info['rt'][array['frame']]
+
+    return columns
+
+def write_npy(filename, columns):
+    array = np.zeros(len(columns['rt']), dtype=FEATURE_DTYPE)
+    for key in columns:
+        array[key] = columns[key]
+    np.save(filename, array, allow_pickle=False)
+
+def columns_to_feature_map(columns):
+    """Builds a FeatureMap from feature columns (IM is stored as the 'im' meta value)."""
+    num_features = len(columns['rt'])
+    rts, mzs = columns['rt'].tolist(), columns['mz'].tolist()
+    intensities = columns['intensity'].tolist() if 'intensity' in columns else [0.0] * num_features
+    charges = columns['charge'].tolist() if 'charge' in columns else None
+    ims = columns['im'].tolist() if 'im' in columns else None
+
+    feature_list = []
+    for i in range(num_features):
+        f = ms.Feature()
+        f.setRT(rts[i])
+        f.setMZ(mzs[i])
+        f.setIntensity(intensities[i])
+        if charges is not None:
+            f.setCharge(charges[i])
+        if ims is not None:
+            f.setMetaValue('im', ims[i])
+        feature_list.append(f)
+
+    features = ms.FeatureMap()
+    features.extend(feature_list)
+    features.setUniqueIds()
+    return features
+
+def feature_map_to_columns(features):
+    """Extracts the columns of a FeatureMap, in bulk through get_df if pandas is available."""
+    columns = None
+    try:
+        df = features.to_df() if hasattr(features, 'to_df') else features.get_df()
+        names = {'rt': 'RT' if 'RT' in df else 'rt', 'mz': 'mz', 'intensity': 'intensity', 'charge': 'charge'}
+        columns = {key: df[name].to_numpy() for key, name in names.items()}
+    except (AttributeError, ImportError, KeyError):
+        pass
+
+    if columns is None:
+        values = np.array([(f.getRT(), f.getMZ(), f.getIntensity(), f.getCharge()) for f in features],
+                          dtype=np.float64).reshape(-1, 4)
+        columns = {key: values[:, i] for i, key in enumerate(['rt', 'mz', 'intensity', 'charge'])}
+
+    if features.size() > 0 and features[0].metaValueExists('im'):
+        columns['im'] = np.array([f.getMetaValue('im') for f in features], dtype=np.float64)
+
+    return columns
+
 if __name__ == '__main__':
     print('Starting feature translation', flush=True)
     parser = argparse.ArgumentParser(description='Feature translator.')
     parser.add_argument('--input', action='store', required=True, type=str)
     parser.add_argument('--output', action='store', required=True, type=str)
+    parser.add_argument('--im_layout', action='store_true', required=False, default=False,
+                        help='write csv output as RT, m/z, IM (like features-im.csv)')
 
     args = parser.parse_args()
-    
-    if args.input[-3:] == 'csv':
-        csv_list = []
-        with open(args.input, 'r') as f:
-            reader = csv.reader(f)
-            csv_list = list(reader)
-        
-        features = ms.FeatureMap()
-        print('Processing feature 1 of', len(csv_list) - 1)
-        for i in range(1, len(csv_list)):
-            if i % 50 == 0:
-                print('Processing feature', i, 'of', len(csv_list) - 1)
-                
-            rt = checkFloat(csv_list[i][0])
-            mz = checkFloat(csv_list[i][1])
-            intensity = checkFloat(csv_list[i][2])
-            if rt is False or mz is False or intensity is False:
-                continue
-            
-            f = ms.Feature()
-            f.setRT(float(csv_list[i][0]))
-            f.setMZ(float(csv_list[i][1]))
-            f.setIntensity(float(csv_list[i][2]))
-            features.push_back(f)
-
-        features.setUniqueIds()
-        ms.FeatureXMLFile().store(args.output, features)
-        print('Done.')
-
-    elif args.input[-10:] == 'featureXML':
-        features = ms.FeatureMap()
-        ms.FeatureXMLFile().load(args.input, features)
-
-        data_points = []
-        for feature in features:
-            data_points.append([feature.getRT(), feature.getMZ(), feature.getIntensity()])
 
-        with open(args.output, 'w') as f:
-            f.write('RT,m/z,Intensity\n')
-            print('Processing feature 1 of', features.size())
+    formats = ['csv', 'featureXML', 'npy']
+    in_format = next((fmt for fmt in formats if args.input.endswith(fmt)), None)
+    out_format = next((fmt for fmt in formats if args.output.endswith(fmt)), None)
+    if in_format is None or out_format is None:
+        print("Error: input and output file formats must be csv, featureXML or npy")
+        exit(1)
 
-            for i in range(features.size()):
-                if i % 50 == 0:
-                    print('Processing feature', i + 1, 'of', features.size())
+    if in_format == 'csv':
+        columns = read_csv(args.input)
+    elif in_format == 'npy':
+        columns = read_npy(args.input)
+    else:
+        features = ms.FeatureMap()
+        ms.FeatureXMLFile().load(args.input, features)
+        columns = feature_map_to_columns(features)
 
-                f.write(str.format('{0},{1},{2}\n', data_points[i][0], data_points[i][1],
-                                   data_points[i][2]))
+    if args.im_layout and 'im' not in columns:
+        print("Error: the input features have no IM values")
+        exit(1)
 
-        print('Done.')
+    print('Translating', len(columns['rt']), 'features')
 
+    if out_format == 'csv':
+        write_csv(args.output, columns, args.im_layout)
+    elif out_format == 'npy':
+        write_npy(args.output, columns)
     else:
-        print("Error: input file format must be csv or featureXML")
+        ms.FeatureXMLFile().store(args.output, columns_to_feature_map(columns))
+
+    print('Done.')
@@ -1,7 +1,6 @@
 #include <algorithm>
 #include <fstream>
 #include <iostream>
-#include <sstream>
 #include <string>
 #include <unordered_map>
 #include <vector>
@@ -14,7 +13,27 @@
 
 using namespace std;
 
-vector<vector<string>> table(1);
+// The [begin, end) offsets of each field of a line (reused between lines to avoid reallocating)
+typedef vector<pair<size_t, size_t>> Fields;
+
+// Splits a line on a delimiter in place; like repeated getline calls, n delimiters give n + 1 fields
+void split(const string &line, char delim, Fields &fields) {
+	fields.clear();
+	size_t begin = 0, end;
+	while ((end = line.find(delim, begin)) != string::npos) {
+		fields.push_back({ begin, end });
+		begin = end + 1;
+	}
+	fields.push_back({ begin, line.size() });
+}
+
+string get_field(const string &line, const Fields &fields, int i) {
+	return line.substr(fields[i].first, fields[i].second - fields[i].first);
+}
+
+void write_field(fstream &outfile, const string &line, const Fields &fields, int i) {
+	outfile.write(line.data() + fields[i].first, fields[i].second - fields[i].first);
+}
 
 int main(int argc, char *argv[]) {
 	cin.sync_with_stdio(0);
@@ -84,58 +103,49 @@ int main(int argc, char *argv[]) {
 
 	int is_csv = (input_filename.substr(input_filename.size() - 3) == "csv") ? 1 : 0;
 
+	char delim = is_csv ? ',' : '\t';
+
 	unordered_map<string, int> headers;
-	int idx = 0;
+	Fields fields;
 
 	string input;
 	getline(infile, input);
 
-	stringstream ss(input);
-	while (ss.good()) {
-		if (is_csv) getline(ss, input, ',');
-		else getline(ss, input, '\t');
-		table[0].push_back(input);
-		headers.insert({ input, idx++ });
+	split(input, delim, fields);
+	for (int i = 0; i < fields.size(); i++) {
+		headers.insert({ get_field(input, fields, i), i });
 	}
 
-	while (1) {
-		getline(infile, input);
-		if (input == "") break;
-		vector<string> line;
+	// Rows are written with as many columns as the header, separated by commas
+	size_t num_columns = fields.size();
+	for (int i = 0; i < num_columns; i++) {
+		write_field(outfile, input, fields, i);
+		if (i < num_columns - 1)
+			outfile << ',';
+	}
+	outfile << '\n';
 
-		stringstream ss(input);
-		while (ss.good()) {
-			if (is_csv) getline(ss, input, ',');
-			else getline(ss, input, '\t');
-			line.push_back(input);
-		}
+	int rf_col = mode == 1 ? headers.find("Raw file")->second : -1;
+	int pep_col = mode == 2 ? headers.find("PEP")->second : -1;
 
-		if (mode == 0) {
-			table.push_back(line);
-		}
-		else if (mode == 1) {
-			string rf = line[headers.find("Raw file")->second];
-			if (rf == raw_filename)
-				table.push_back(line);
+	// Rows are filtered and written as they are read, up to the first empty line
+	while (getline(infile, input) && input != "") {
+		split(input, delim, fields);
+
+		if (mode == 1) {
+			if (input.compare(fields[rf_col].first, fields[rf_col].second - fields[rf_col].first, raw_filename) != 0)
+				continue;
 		}
 		else if (mode == 2) {
-			string pep_str = line[headers.find("PEP")->second];
-			if (pep_str != "NaN" && pep_str != "" && stod(pep_str) <= pep_threshold)
-				table.push_back(line);
+			string pep_str = get_field(input, fields, pep_col);
+			if (pep_str == "NaN" || pep_str == "" || !(stod(pep_str) <= pep_threshold))
+				continue;
 		}
-	}
-
-	for (int i = 0; i < table[0].size(); i++) {
-		outfile << table[0][i];
-		if (i < table[0].size() - 1)
-			outfile << ',';
-	}
-	outfile << '\n';
 
-	for (int i = 1; i < table.size(); i++) {
-		for (int j = 0; j < table[0].size(); j++) {
-			outfile << table[i][j];
-			if (j < table[0].size() - 1)
+		for (int j = 0; j < num_columns; j++) {
+			if (j < fields.size())
+				write_field(outfile, input, fields, j);
+			if (j < num_columns - 1)
 				outfile << ',';
 		}
 		outfile << '\n';